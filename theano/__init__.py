@@ -65,7 +65,7 @@ from compile import \
     SymbolicOutput, Out, \
     Mode, \
     predefined_modes, predefined_linkers, predefined_optimizers, \
-    FunctionMaker, function, OpFromGraph, \
+    FunctionMaker, function, function_group, OpFromGraph, \
     Component, External, Member, Method, \
     Composite, ComponentList, ComponentDict, Module, \
     ProfileMode, \
@@ -85,14 +85,27 @@ FancyModule = Module
 
 from printing import \
     pprint, pp
-import scan_module
-from scan_module import scan, map, reduce, foldl, foldr, clone
+
+# The scan module is only imported when it is first used, to keep
+# `import theano` fast (see theano.misc.lazy_import). Importing it also
+# registers the scan optimizations, which are only needed by graphs
+# containing Scan ops, i.e. after it has been used.
+from misc.lazy_import import LazyModule, LazyFunction
+scan_module = LazyModule('theano.scan_module')
+scan = LazyFunction('theano.scan_module', 'scan')
+map = LazyFunction('theano.scan_module', 'map')
+reduce = LazyFunction('theano.scan_module', 'reduce')
+foldl = LazyFunction('theano.scan_module', 'foldl')
+foldr = LazyFunction('theano.scan_module', 'foldr')
+clone = LazyFunction('theano.scan_module', 'clone')
+del LazyModule, LazyFunction
 
 from updates import Updates
 
 import tensor
 import scalar
 #we don't import by default as we don't want to force having scipy installed.
+#(This also keeps `import theano` fast.)
 #import sparse
 import gradient
 from gradient import Rop, Lop, grad
@@ -22,5 +22,5 @@ from profilemode import ProfileMode
 from theano.compile.sharedvalue import shared, shared_constructor, SharedVariable
 from theano.compile.pfunc import pfunc, Param, rebuild_collect_shared
 
-from function import function
+from function import function, function_group
 
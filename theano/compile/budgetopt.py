@@ -0,0 +1,404 @@
+"""
+An optimizer that spends a limited time optimizing each graph, guided by
+the history of the optimizations applied to similar graphs.
+
+It is used by the 'budgeted' optimizer of `Mode` (`optimizer=budgeted`).
+"""
+import cPickle
+import logging
+import os
+import sys
+import time
+
+from theano import gof
+from theano.configparser import (config, AddConfigVar, FloatParam, IntParam,
+                                 StrParam)
+from theano.gof import compilelock
+from theano.gof.cc import hash_from_code
+
+_logger = logging.getLogger('theano.compile.budgetopt')
+
+AddConfigVar('optimizer_budget.time',
+        ("Time (in seconds) that the 'budgeted' optimizer can spend on a "
+         "graph. Once it is spent, only the optimizations of fast_compile "
+         "and stabilize are applied."),
+        FloatParam(5, lambda t: t >= 0),
+        in_c_key=False)
+
+AddConfigVar('optimizer_budget.explore',
+        ("The 'budgeted' optimizer tries all its optimizations once every "
+         "that many compilations of graphs of the same family, including "
+         "those that never changed them. 0 disables it."),
+        IntParam(10, lambda n: n >= 0),
+        in_c_key=False)
+
+AddConfigVar('optimizer_budget.history',
+        ("File in which the 'budgeted' optimizer keeps the history of the "
+         "optimizations. If empty, optimizer_history.pkl in the "
+         "compiledir."),
+        StrParam(""),
+        in_c_key=False)
+
+# Version of the format of the history file. Increment it if the content of
+# the history changes.
+history_version = 1
+
+
+def graph_family(fgraph):
+    """
+    Return a string identifying the family of `fgraph`: the graphs made of
+    the same kinds of ops, whatever their number and connections.
+    """
+    kinds = set()
+    for node in fgraph.nodes:
+        op = node.op
+        kinds.add('%s.%s' % (type(op).__module__, type(op).__name__))
+        scalar_op = getattr(op, 'scalar_op', None)
+        if scalar_op is not None:
+            kinds.add('%s.%s' % (type(scalar_op).__module__,
+                                 type(scalar_op).__name__))
+    return hash_from_code('\n'.join(sorted(kinds)))
+
+
+class OptimizerHistory(object):
+    """
+    What the optimizations did to the graphs of each family, stored in a
+    file shared by all the processes.
+
+    For each family, `data` maps
+      - 'runs' to the number of graphs optimized,
+      - 'opts' to a dict: optimizer name -> [runs, changes, time],
+      - 'lopts' to a dict: (EquilibriumOptimizer name, local optimizer name)
+        -> [runs, number of times applied, time].
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+        self.loaded = False
+
+    def get_path(self):
+        if self.path:
+            return self.path
+        if config.optimizer_budget.history:
+            return config.optimizer_budget.history
+        return os.path.join(config.compiledir, 'optimizer_history.pkl')
+
+    def _read(self):
+        path = self.get_path()
+        if not os.path.exists(path):
+            return {}
+        try:
+            f = open(path, 'rb')
+            try:
+                version, data = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            _logger.info('Could not load the optimizer history %s: %s',
+                         path, e)
+            return {}
+        if version != history_version:
+            return {}
+        return data
+
+    def family(self, family):
+        """Return the history of `family` (an empty one if it is new)."""
+        if not self.loaded:
+            self.data = self._read()
+            self.loaded = True
+        return self.data.get(family, {'runs': 0, 'opts': {}, 'lopts': {}})
+
+    def record(self, family, opts, lopts):
+        """
+        Add a run on a graph of `family` to the history, and store it.
+
+        :param opts: dict: optimizer name -> (changes, time)
+        :param lopts: dict: (EquilibriumOptimizer name, local optimizer name)
+                      -> (number of times applied, time)
+
+        Errors are only logged, as the history is not required to optimize
+        graphs.
+        """
+        path = self.get_path()
+        lock_dir = path + '.lock_dir'
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            compilelock.lock(lock_dir, min_wait=0.1, max_wait=1)
+        except Exception, e:
+            _logger.info('Could not lock the optimizer history %s: %s',
+                         path, e)
+            return
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            try:
+                # Other processes may have updated the file.
+                self.data = self._read()
+                self.loaded = True
+                fam = self.data.setdefault(
+                        family, {'runs': 0, 'opts': {}, 'lopts': {}})
+                fam['runs'] += 1
+                for stats, new in ((fam['opts'], opts),
+                                   (fam['lopts'], lopts)):
+                    for name, (count, t) in new.iteritems():
+                        s = stats.setdefault(name, [0, 0, 0.])
+                        s[0] += 1
+                        s[1] += count
+                        s[2] += t
+                f = open(tmp_path, 'wb')
+                try:
+                    cPickle.dump((history_version, self.data), f,
+                                 protocol=cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                if os.path.exists(path) and sys.platform == 'win32':
+                    os.remove(path)
+                os.rename(tmp_path, path)
+            except Exception, e:
+                _logger.info('Could not store the optimizer history %s: %s',
+                             path, e)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        finally:
+            compilelock.ExplicitUnlocker(lock_dir).unlock()
+
+
+# The history shared by the BudgetedOptimizers that do not have their own.
+default_history = OptimizerHistory()
+
+
+class ChangeCounter(object):
+    """Count the nodes imported and the inputs changed in a FunctionGraph."""
+
+    def __init__(self):
+        self.count = 0
+
+    def on_import(self, fgraph, node):
+        self.count += 1
+
+    def on_change_input(self, fgraph, node, i, r, new_r, reason=None):
+        self.count += 1
+
+
+def _opt_name(opt):
+    name = getattr(opt, 'name', None)
+    if name is None:
+        name = getattr(opt, '__name__', None)
+    if name is None:
+        name = str(opt)
+    return name
+
+
+class BudgetedOptimizer(gof.Optimizer):
+    """
+    Apply the optimizations of the optdb selected by a `gof.Query`, like
+    `Mode` does, but within a time budget and guided by what these
+    optimizations did to the previous graphs of the same family (see
+    `graph_family`).
+
+    The optimizations with one of the `required_tags` (those of
+    fast_compile, and the stabilize phase, without which the results could
+    be numerically wrong) are always applied in full. The others are
+    skipped when they never changed the graphs of the family, after being
+    applied to `min_runs` of them, and when the budget is spent. If the sum
+    of their average times exceeds the budget, those that changed the
+    graphs the least per second are skipped. The local optimizers of their
+    EquilibriumOptimizers are filtered the same way, and tried by
+    decreasing number of times applied per second.
+
+    Once every `config.optimizer_budget.explore` graphs of a family, all
+    the optimizations are tried, so that those that became useful are
+    found again.
+    """
+
+    # Number of graphs of a family an optimization must not have changed to
+    # be skipped.
+    min_runs = 3
+
+    # Tags of the optdb entries that are never skipped nor pruned. Register
+    # an optimization needed for correctness with one of them to protect it.
+    required_tags = ['fast_compile', 'stabilize']
+
+    def __init__(self, query, budget=None, history=None):
+        """
+        :param query: a `gof.Query` of the optdb.
+        :param budget: time in seconds (config.optimizer_budget.time if
+                       None).
+        :param history: an `OptimizerHistory` (`default_history` if None).
+        """
+        self.query = query
+        self.budget = budget
+        if history is None:
+            history = default_history
+        self.history = history
+
+    def including(self, *tags):
+        return self.__class__(self.query.including(*tags), self.budget,
+                              self.history)
+
+    def excluding(self, *tags):
+        return self.__class__(self.query.excluding(*tags), self.budget,
+                              self.history)
+
+    def requiring(self, *tags):
+        return self.__class__(self.query.requiring(*tags), self.budget,
+                              self.history)
+
+    def required_names(self):
+        """
+        Return the names of the optimizations of the optdb that are always
+        applied in full.
+        """
+        from theano.compile.mode import optdb
+        return set(_opt_name(o)
+                   for o in optdb.query(gof.Query(include=self.required_tags)))
+
+    def _skipped(self, stats):
+        return (stats is not None and stats[0] >= self.min_runs and
+                stats[1] == 0)
+
+    def _prune(self, eq_opt, fam, explore):
+        """
+        Return a copy of the EquilibriumOptimizer `eq_opt` without the local
+        optimizers that never fired, and the others sorted by payoff.
+        """
+        name = _opt_name(eq_opt)
+        keep = []
+        for lopt in eq_opt.local_optimizers:
+            stats = fam['lopts'].get((name, _opt_name(lopt)))
+            if explore or not self._skipped(stats):
+                keep.append((stats, lopt))
+
+        def payoff(item):
+            stats = item[0]
+            if stats is None:
+                # Never tried: try it first to learn what it does.
+                return -float('inf')
+            return -stats[1] / max(stats[2], 1e-6)
+        keep.sort(key=payoff)
+        new = gof.EquilibriumOptimizer(
+                [lopt for stats, lopt in keep] + eq_opt.global_optimizers,
+                failure_callback=eq_opt.failure_callback,
+                max_depth=eq_opt.max_depth,
+                max_use_ratio=eq_opt.max_use_ratio)
+        new.name = name
+        return new
+
+    def plan(self, fgraph):
+        """
+        Return the list of (optimizer, required) to apply to `fgraph`, and
+        the family of `fgraph`.
+        """
+        from theano.compile.mode import optdb
+        seq = optdb.query(self.query)
+        required = self.required_names()
+        budget = self.budget
+        if budget is None:
+            budget = config.optimizer_budget.time
+
+        family = graph_family(fgraph)
+        fam = self.history.family(family)
+        explore = (config.optimizer_budget.explore and
+                   fam['runs'] % config.optimizer_budget.explore == 0)
+
+        plan = []
+        optional = []
+        for opt in seq:
+            name = _opt_name(opt)
+            stats = fam['opts'].get(name)
+            if name not in required:
+                if not explore and self._skipped(stats):
+                    continue
+                optional.append((stats, len(plan)))
+                if isinstance(opt, gof.EquilibriumOptimizer):
+                    opt = self._prune(opt, fam, explore)
+            plan.append((opt, name in required))
+
+        # Drop the optional optimizations with the lowest payoff until their
+        # average times fit in the budget.
+        def avg_time(stats):
+            if stats is None:
+                return 0
+            return stats[2] / stats[0]
+
+        def payoff(item):
+            stats = item[0]
+            if stats is None:
+                return float('inf')
+            return stats[1] / max(stats[2], 1e-6)
+        total = sum(avg_time(stats) for stats, i in optional)
+        if total > budget:
+            optional.sort(key=payoff)
+            dropped = set()
+            for stats, i in optional:
+                if total <= budget:
+                    break
+                dropped.add(i)
+                total -= avg_time(stats)
+            plan = [p for i, p in enumerate(plan) if i not in dropped]
+        return plan, family, budget, seq.failure_callback
+
+    def apply(self, fgraph):
+        t_start = time.time()
+        plan, family, budget, failure_callback = self.plan(fgraph)
+
+        if fgraph.profile:
+            validate_before = fgraph.profile.validate_time
+        nb_node_before = len(fgraph.nodes)
+        counter = ChangeCounter()
+        fgraph.extend(counter)
+        applied = []
+        times = []
+        sub_profs = []
+        opts_stats = {}
+        lopts_stats = {}
+        try:
+            for opt, required in plan:
+                if not required and time.time() - t_start > budget:
+                    continue
+                count_before = counter.count
+                try:
+                    t0 = time.time()
+                    sub_prof = opt.optimize(fgraph)
+                    t = time.time() - t0
+                except AssertionError:
+                    # do not catch Assertion failures
+                    raise
+                except Exception, e:
+                    if failure_callback:
+                        failure_callback(e, self, opt)
+                        continue
+                    else:
+                        raise
+                applied.append(opt)
+                times.append(t)
+                sub_profs.append(sub_prof)
+                opts_stats[_opt_name(opt)] = (counter.count - count_before, t)
+                if isinstance(opt, gof.EquilibriumOptimizer):
+                    process_count, time_lopts = sub_prof[2], sub_prof[6]
+                    for lopt in opt.local_optimizers:
+                        lopts_stats[(_opt_name(opt), _opt_name(lopt))] = (
+                                process_count[lopt], time_lopts[lopt])
+        finally:
+            fgraph.remove_feature(counter)
+        self.history.record(family, opts_stats, lopts_stats)
+
+        if fgraph.profile:
+            validate_time = fgraph.profile.validate_time - validate_before
+        else:
+            validate_time = None
+        return (gof.SeqOptimizer(applied), times, validate_time,
+                nb_node_before, len(fgraph.nodes), sub_profs)
+
+    def add_requirements(self, fgraph):
+        # The optimizers add their requirements when they are applied.
+        pass
+
+    def print_summary(self, stream=sys.stdout, level=0, depth=-1):
+        print >> stream, "%s%s %s id=%i" % (
+                (' ' * level), self.__class__.__name__,
+                getattr(self, 'name', None), id(self))
+
+    print_profile = staticmethod(gof.SeqOptimizer.print_profile)
+    merge_profile = staticmethod(gof.SeqOptimizer.merge_profile)
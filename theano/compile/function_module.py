@@ -3,10 +3,15 @@
 """
 __docformat__ = "restructuredtext en"
 
+import collections
 import copy
 import copy_reg
 import cPickle
 import itertools
+import operator
+import os
+import sys
+import threading
 import time
 import warnings
 
@@ -14,13 +19,22 @@ import numpy
 
 import theano
 from theano import gof
-from theano.gof.python25 import partial
+from theano.configparser import AddConfigVar, BoolParam
+from theano.gof.python25 import all, partial
 import mode as mode_module
+from profiling import CompileProfile
 from io import In, SymbolicInput, SymbolicInputKit, SymbolicOutput
 
 import logging
 _logger = logging.getLogger('theano.compile.function_module')
 
+AddConfigVar('optimized_graph_cache',
+        ("If True, the optimized graphs of compiled functions are stored in "
+         "the compiledir, and reused instead of optimizing again an "
+         "identical graph with the same mode and optimizer settings."),
+        BoolParam(False),
+        in_c_key=False)
+
 
 class UnusedInputError(Exception):
     """
@@ -320,6 +334,13 @@ class Function(object):
     return_none = None
     """Bool: whether the function should return None or not"""
 
+    trust_input = False
+    """Bool: if True, the positional arguments of a call that provides all
+    the explicit inputs are stored as they are: they are not filtered, and
+    not checked for aliasing. The caller must pass values of the right
+    type (e.g. ndarrays of the right dtype and number of dimensions) that
+    do not share memory."""
+
     maker = None
     """FunctionMaker instance"""
 
@@ -518,6 +539,42 @@ class Function(object):
             if input.update is not None:
                 self.n_returned_outputs -= 1
 
+        # The storage of the explicit inputs, to which the arguments are
+        # bound when trust_input is True. Kits are not supported there.
+        self._trusted_storage = []
+        if all(indices is None for _, indices, _ in self.indices):
+            for c in self.input_storage:
+                if c.implicit:
+                    break
+                self._trusted_storage.append(c.storage)
+        self._trusted_zeros = [0] * len(self._trusted_storage)
+        # Storage emptied after each call.
+        self._required_storage = [c.storage for c in self.input_storage
+                                  if c.required]
+        self._gc_output_storage = []
+        if getattr(self.fn, 'allow_gc', False):
+            output_variables = self.maker.output_variables
+            assert len(self.output_storage) == len(output_variables)
+            for o_container, o_variable in zip(self.output_storage,
+                                               output_variables):
+                if o_variable.owner is not None:
+                    # this node is the variable of computation
+                    self._gc_output_storage.append(o_container.storage)
+        # Containers of the inputs updated from the last outputs, last first.
+        self._update_containers = [
+                storage for input, storage in reversed(zip(
+                    self.maker.expanded_inputs, self.input_storage))
+                if input.update is not None]
+        self._refeed = [(i, value)
+                        for i, (required, refeed, value)
+                        in enumerate(self.defaults) if refeed]
+
+        # The calls made by async_call that did not start yet, and whether
+        # a thread is running them.
+        self._async_lock = threading.Lock()
+        self._async_calls = collections.deque()
+        self._async_running = False
+
     def __contains__(self, item):
         return self.value.__contains__(item)
 
@@ -542,6 +599,312 @@ class Function(object):
         profile = self.profile
         t0 = time.time()
 
+        if (self.trust_input and not kwargs and
+                len(args) == len(self._trusted_storage)):
+            # Store the arguments as they are, without a Python loop.
+            map(operator.setitem, self._trusted_storage, self._trusted_zeros,
+                args)
+        else:
+            self._bind_inputs(args, kwargs)
+
+        outputs = self._run_fn()
+        #
+        # NOTE: This logic needs to be replicated in
+        #       scan.
+        #       grep for 'PROFILE_CODE'
+        #
+
+        dt_call = time.time() - t0
+        self.maker.mode.call_time += dt_call
+        if profile:
+            profile.fct_callcount += 1
+            profile.fct_call_time += dt_call
+            if hasattr(self.fn, 'update_profile'):
+                self.fn.update_profile(profile)
+
+        return self._returned(outputs)
+
+    def _returned(self, outputs):
+        """Return what a call returns, given the list of its outputs."""
+        if self.return_none:
+            return None
+        elif self.unpack_single and len(outputs) == 1:
+            return outputs[0]
+        else:
+            return outputs
+
+    def _can_bind_directly(self):
+        """
+        Return True if the arguments of a call given for all the explicit
+        inputs can be stored directly in their storage, once filtered
+        unless `trust_input` is set, instead of going through `__call__`.
+        """
+        if (self.profile or not self._trusted_storage or
+                type(self).__call__.im_func is not Function.__call__.im_func):
+            # The profile is updated, and subclasses may bind the inputs
+            # differently, in __call__.
+            return False
+        # The aliased arguments are only copied by _bind_inputs, which is
+        # needed if an input can be destroyed.
+        return (self.trust_input or
+                not getattr(self, '_check_for_aliased_inputs', True) or
+                not any(inp.mutable for inp in self.maker.inputs))
+
+    def _run_fn(self):
+        """
+        Run self.fn on the inputs already in the storage, and return the
+        list of the outputs of the call.
+
+        The storage of the inputs and outputs is then emptied, the inputs
+        that have an update receive their new value, and the default values
+        are put back.
+        """
+        # Do the actual work
+        t0_fn = time.time()
+        try:
+            outputs = self.fn()
+        except Exception:
+            if hasattr(self.fn, 'position_of_error'):
+                # this is a new vm-provided function
+                # the C VM needs this because the exception manipulation
+                # done by raise_with_op is not implemented in C.
+                gof.vm.raise_with_op(self.fn.nodes[self.fn.position_of_error])
+            else:
+                # old-style linkers raise their own exceptions
+                raise
+
+        dt_fn = time.time() - t0_fn
+        self.maker.mode.fn_time += dt_fn
+        if self.profile:
+            self.profile.vm_call_time += dt_fn
+
+        # Retrieve the values that were computed
+        if outputs is None:
+            outputs = [x.data for x in self.output_storage]
+        assert len(outputs) == len(self.output_storage)
+
+        # Remove internal references to required inputs.
+        # These cannot be re-used anyway.
+        for storage in self._required_storage:
+            storage[0] = None
+
+        # if we are allowing garbage collection, remove the output
+        # references from the internal storage cells
+        # WARNING: This circumvents the 'readonly' attribute of the outputs
+        for storage in self._gc_output_storage:
+            storage[0] = None
+
+        if getattr(self.fn, 'need_update_inputs', True):
+            # Update the inputs that have an update function
+            for storage in self._update_containers:
+                storage.data = outputs.pop()
+        else:
+            outputs = outputs[:self.n_returned_outputs]
+
+        # Put default values back in the storage
+        for i, value in self._refeed:
+            if isinstance(value, gof.Container):
+                value = value.storage[0]
+            self[i] = value
+        return outputs
+
+    def imap(self, iterable_of_args):
+        """
+        Return an iterator over the results of calling the function on
+        each element of `iterable_of_args`.
+
+        Each element is a tuple or list of positional arguments, or a dict
+        of keyword arguments. The arguments are bound as in `__call__`, so
+        with `trust_input` they are stored without any check.
+
+        When all the explicit inputs are given as positional arguments,
+        these are stored directly in their storage, without going through
+        `__call__`.
+        """
+        if not self._can_bind_directly():
+            call = self.__call__
+            for args in iterable_of_args:
+                if isinstance(args, dict):
+                    yield call(**args)
+                else:
+                    yield call(*args)
+            return
+
+        mode = self.maker.mode
+        trusted_storage = self._trusted_storage
+        trusted_zeros = self._trusted_zeros
+        n_args = len(trusted_storage)
+        filter_args = not self.trust_input
+
+        for args in iterable_of_args:
+            t0 = time.time()
+            if isinstance(args, dict):
+                self._bind_inputs((), args)
+            elif len(args) != n_args:
+                self._bind_inputs(args, {})
+            elif filter_args:
+                for i, arg in enumerate(args):
+                    trusted_storage[i][0] = self._filter_arg(i, arg)
+            else:
+                map(operator.setitem, trusted_storage, trusted_zeros, args)
+            outputs = self._run_fn()
+            mode.call_time += time.time() - t0
+            yield self._returned(outputs)
+
+    def map(self, iterable_of_args, stack=True):
+        """
+        Call the function on each element of `iterable_of_args`, like
+        `imap`, and return all the results.
+
+        If `stack` is True, the values of an output are written in a
+        preallocated array, whose first dimension indexes the calls, as
+        long as they are ndarrays of the same shape and dtype. Otherwise
+        (or if `stack` is False), the values of that output are returned
+        in a list.
+
+        Like for `__call__`, a function with a single output returns the
+        array or list of its values, and a function with several outputs
+        returns one array or list per output.
+        """
+        if self.return_none:
+            for outputs in self.imap(iterable_of_args):
+                pass
+            return None
+        single = self.unpack_single and self.n_returned_outputs == 1
+        args_list = list(iterable_of_args)
+        n_calls = len(args_list)
+        results = None
+        for i, outputs in enumerate(self.imap(args_list)):
+            if single:
+                outputs = [outputs]
+            if results is None:
+                results = []
+                for o in outputs:
+                    if stack and isinstance(o, numpy.ndarray):
+                        results.append(numpy.empty((n_calls,) + o.shape,
+                                                   dtype=o.dtype))
+                    else:
+                        results.append([None] * n_calls)
+            for j, o in enumerate(outputs):
+                res = results[j]
+                if isinstance(res, numpy.ndarray):
+                    if (isinstance(o, numpy.ndarray) and
+                            o.shape == res.shape[1:] and
+                            o.dtype == res.dtype):
+                        res[i] = o
+                        continue
+                    # The values cannot be stacked: keep them in a list.
+                    res = results[j] = list(res[:i]) + [None] * (n_calls - i)
+                res[i] = o
+        if results is None:
+            # There was no call, so the shapes of the outputs are not known.
+            results = [[] for i in xrange(self.n_returned_outputs)]
+        if single:
+            return results[0]
+        return results
+
+    def async_call(self, *args, **kwargs):
+        """
+        Start a call to the function in another thread, and return a
+        `CallFuture` that gives its result.
+
+        The positional arguments are filtered before returning, in the
+        calling thread, while the previous calls may still run. If they are
+        given for all the explicit inputs, the call then stores them
+        directly in their storage, without filtering them again. The calls
+        are run one after the other, in the order of async_call. Do not
+        call the function directly until they are done.
+
+        The computation only runs at the same time as the calling thread
+        while the thunks release the GIL (see `CLinkerOp.c_code_gil_free`).
+        """
+        direct = (not kwargs and len(args) == len(self._trusted_storage) and
+                  self._can_bind_directly())
+        if not self.trust_input and len(args) <= len(self.input_storage):
+            args = [self._filter_arg(i, arg) for i, arg in enumerate(args)]
+        future = CallFuture()
+        self._async_lock.acquire()
+        try:
+            self._async_calls.append((future, args, kwargs, direct))
+            if not self._async_running:
+                # The thread stops when there is no call left, so that it
+                # does not keep the function alive.
+                self._async_running = True
+                thread = threading.Thread(target=self._run_async_calls)
+                thread.daemon = True
+                thread.start()
+        finally:
+            self._async_lock.release()
+        return future
+
+    def async_imap(self, iterable_of_args, prefetch=1):
+        """
+        Like `imap`, but the arguments of the next `prefetch` calls are
+        taken from `iterable_of_args` and filtered while the current call
+        runs (see `async_call`).
+
+        This lets the computation overlap with the preparation of the data
+        by a Python generator, for instance.
+        """
+        pending = collections.deque()
+        for args in iterable_of_args:
+            if isinstance(args, dict):
+                pending.append(self.async_call(**args))
+            else:
+                pending.append(self.async_call(*args))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _run_async_calls(self):
+        while True:
+            self._async_lock.acquire()
+            try:
+                if not self._async_calls:
+                    self._async_running = False
+                    return
+                future, args, kwargs, direct = self._async_calls.popleft()
+            finally:
+                self._async_lock.release()
+            try:
+                if direct:
+                    t0 = time.time()
+                    map(operator.setitem, self._trusted_storage,
+                        self._trusted_zeros, args)
+                    outputs = self._run_fn()
+                    self.maker.mode.call_time += time.time() - t0
+                    future._set_result(self._returned(outputs))
+                else:
+                    future._set_result(self(*args, **kwargs))
+            except:
+                future._set_exc_info(sys.exc_info())
+
+    def _filter_arg(self, i, arg):
+        """
+        Return `arg` filtered by the type of the i-th input.
+        """
+        s = self.input_storage[i]
+        # see this emails for a discuation about None as input
+        # https://groups.google.com/group/theano-dev/browse_thread/thread/920a5e904e8a8525/4f1b311a28fc27e5
+        if arg is None:
+            return arg
+        try:
+            return s.type.filter(arg, strict=s.strict,
+                    allow_downcast=s.allow_downcast)
+        except Exception, e:
+            function_name="theano function"
+            if self.name:
+                function_name += 'with name "'+self.name+'" '
+            e.args = tuple(["Bad input argument to " + function_name +
+                            " at index %d(0-based)" % i] + list(e.args))
+            raise
+
+    def _bind_inputs(self, args, kwargs):
+        """
+        Filter the arguments of a call and store them in the input storage,
+        and check that every required input was provided once.
+        """
         # Reinitialize each container's 'provided' counter
         for c in self.input_storage:
             c.provided = 0
@@ -555,25 +918,7 @@ class Function(object):
             #TODO: provide a Param option for skipping the filter if we
             #      really want speed.
             s = self.input_storage[i]
-            # see this emails for a discuation about None as input
-            # https://groups.google.com/group/theano-dev/browse_thread/thread/920a5e904e8a8525/4f1b311a28fc27e5
-            if arg is None:
-                s.storage[0] = arg
-            else:
-                try:
-                    s.storage[0] = s.type.filter(arg, strict=s.strict,
-                            allow_downcast=s.allow_downcast)
-
-                except Exception, e:
-                    function_name="theano function"
-                    if self.name:
-                        function_name += 'with name "'+self.name+'" '
-                    #end if
-                    e.args = tuple(["Bad input argument to " + function_name +
-                                    " at index %d(0-based)" % i] + list(e.args))
-                    raise
-                #end except
-            #end if
+            s.storage[0] = self._filter_arg(i, arg)
             s.provided += 1
             i+=1
 
@@ -637,81 +982,6 @@ class Function(object):
                         % getattr(self.inv_finder[c], 'variable',
                             self.inv_finder[c]))
 
-        # Do the actual work
-        t0_fn = time.time()
-        try:
-            outputs = self.fn()
-        except Exception:
-            if hasattr(self.fn, 'position_of_error'):
-                # this is a new vm-provided function
-                # the C VM needs this because the exception manipulation
-                # done by raise_with_op is not implemented in C.
-                gof.vm.raise_with_op(self.fn.nodes[self.fn.position_of_error])
-            else:
-                # old-style linkers raise their own exceptions
-                raise
-
-        dt_fn = time.time() - t0_fn
-        self.maker.mode.fn_time += dt_fn
-        if profile:
-            profile.vm_call_time += dt_fn
-
-        # Retrieve the values that were computed
-        if outputs is None:
-            outputs = [x.data for x in self.output_storage]
-        assert len(outputs) == len(self.output_storage)
-
-        # Remove internal references to required inputs.
-        # These cannot be re-used anyway.
-        for c in self.input_storage:
-            if c.required:
-                c.storage[0] = None
-
-        # if we are allowing garbage collection, remove the input and output reference from the internal
-        # storage cells
-        if getattr(self.fn, 'allow_gc', False):
-            assert len(self.output_storage) == len(self.maker.fgraph.outputs)
-            for o_container, o_variable in zip(self.output_storage, self.maker.fgraph.outputs):
-                if o_variable.owner is not None:
-                    # this node is the variable of computation
-                    # WARNING: This circumvents the 'readonly' attribute in x
-                    o_container.storage[0] = None
-
-        if getattr(self.fn, 'need_update_inputs', True):
-            # Update the inputs that have an update function
-            for input, storage in reversed(zip(self.maker.expanded_inputs, self.input_storage)):
-                if input.update is not None:
-                    storage.data = outputs.pop()
-        else:
-            outputs = outputs[:self.n_returned_outputs]
-
-        # Put default values back in the storage
-        for i, (required, refeed, value) in enumerate(self.defaults):
-            if refeed:
-                if isinstance(value, gof.Container):
-                    value = value.storage[0]
-                self[i] = value
-        #
-        # NOTE: This logic needs to be replicated in
-        #       scan.
-        #       grep for 'PROFILE_CODE'
-        #
-
-        dt_call = time.time() - t0
-        self.maker.mode.call_time += dt_call
-        if profile:
-            profile.fct_callcount += 1
-            profile.fct_call_time += dt_call
-            if hasattr(self.fn, 'update_profile'):
-                self.fn.update_profile(profile)
-
-        if self.return_none:
-            return None
-        elif self.unpack_single and len(outputs) == 1:
-            return outputs[0]
-        else:
-            return outputs
-
     value = property(
         lambda self: self._value,
         None, # this property itself is not settable
@@ -721,6 +991,46 @@ class Function(object):
         None, # this property itself is not settable
         doc="""dictionary-like access to the containers associated with Variables""")
 
+
+class CallFuture(object):
+    """
+    The result of a call started by `Function.async_call`.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        """Return True if the call is finished."""
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish, and return its result, or raise the
+        exception it raised.
+
+        :param timeout: maximum time to wait, in seconds. None means to
+        wait until the call finishes.
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise RuntimeError('The call did not finish in %s seconds' %
+                               timeout)
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_trace = self._exc_info
+            raise exc_type, exc_value, exc_trace
+        return self._result
+
+    def _set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+
 # pickling/deepcopy support for Function
 
 def _pickle_Function(f):
@@ -916,6 +1226,203 @@ def insert_deepcopy(fgraph, wrapped_inputs, wrapped_outputs):
                                          reason="insert_deepcopy")
                         break
 
+# Version of the format of the optimized graph cache. Increment it if the
+# content of the key or of the stored graph changes.
+optimized_graph_cache_version = 1
+
+
+def _query_signature(query):
+    """Return a hashable description of an optimizer `gof.Query`."""
+    return (tuple(sorted(query.include)),
+            tuple(sorted(query.require)),
+            tuple(sorted(query.exclude)),
+            query.position_cutoff,
+            tuple(sorted((name, _query_signature(sub))
+                         for name, sub in query.subquery.items())))
+
+
+def optimized_graph_key(fgraph, input_specs, mode, accept_inplace):
+    """
+    Return a (digest, key) pair identifying the optimization of the
+    (not yet optimized) `fgraph` with `mode`, or None if the result of this
+    optimization cannot be cached.
+
+    The key is a structural description of the graph, which does not depend
+    on the identity of its variables, together with the optimizer query of
+    the mode and the configuration options. The digest is only used to name
+    the file the optimized graph is stored in: the full key is compared
+    when loading it.
+
+    Only modes whose optimizer is a `gof.Query` (e.g. 'fast_run' and the
+    other predefined optimizers) are supported, since arbitrary optimizers
+    cannot be compared across processes.
+    """
+    query = getattr(mode, '_optimizer', None)
+    if not isinstance(query, gof.Query):
+        return None
+    # The digest is computed from a textual description of the key. It is
+    # only required to be stable across processes, not to be unique.
+    text = []
+    key = ['FunctionMaker.optimized_graph_key',
+           optimized_graph_cache_version,
+           theano.__version__,
+           _query_signature(query),
+           theano.configparser.get_config_md5(),
+           bool(accept_inplace)]
+    text.extend(map(str, key))
+
+    input_pos = {}
+    for i, (spec, r) in enumerate(zip(input_specs, fgraph.inputs)):
+        input_pos[r] = ('input', i)
+        key.append((r.type, bool(spec.mutable), spec.update is not None))
+        text.append('%s %s %s' % key[-1])
+
+    node_pos = {}
+
+    def in_sig(r):
+        if r in input_pos:
+            return input_pos[r]
+        elif isinstance(r, gof.Constant):
+            sig = r.signature()
+            # As in CLinker.cmodule_key, use the strong hash of big
+            # constants when available to keep the key small.
+            if hasattr(sig, 'theano_hash'):
+                sig = sig.theano_hash()
+            hash(sig)
+            return ('constant', r.type, sig)
+        else:
+            return ('node', node_pos[r.owner], r.index)
+
+    try:
+        for pos, node in enumerate(fgraph.toposort()):
+            key.append((node.op,
+                        tuple(in_sig(r) for r in node.inputs),
+                        tuple(r.type for r in node.outputs)))
+            text.append('%s.%s %s %s' % (type(node.op).__module__,
+                                         type(node.op).__name__,
+                                         node.op, key[-1][1:]))
+            node_pos[node] = pos
+        key.append(tuple(in_sig(r) for r in fgraph.outputs))
+        text.append(str(key[-1]))
+        key = tuple(key)
+        hash(key)
+    except Exception:
+        # Some constants or ops are not hashable.
+        return None
+    return gof.cc.hash_from_code('\n'.join(text)), key
+
+
+def _optimized_graph_path(digest):
+    return os.path.join(theano.config.compiledir, 'optimized_graphs',
+                        digest + '.pkl')
+
+
+def load_optimized_graph(graph_key):
+    """
+    Return the (inputs, outputs) of the optimized graph stored for
+    `graph_key` (as returned by `optimized_graph_key`), or None if there is
+    no such graph in the cache.
+    """
+    digest, key = graph_key
+    path = _optimized_graph_path(digest)
+    if not os.path.exists(path):
+        return None
+    try:
+        f = open(path, 'rb')
+        try:
+            stored_key, inputs, outputs = cPickle.load(f)
+        finally:
+            f.close()
+    except Exception, e:
+        # The graph may need classes that are not imported anymore, or may
+        # have been written by an incompatible version.
+        _logger.info('Could not load the optimized graph %s: %s', path, e)
+        return None
+    if stored_key != key:
+        # Collision of the digests.
+        return None
+    return inputs, outputs
+
+
+def save_optimized_graph(graph_key, fgraph):
+    """
+    Store a copy of the optimized `fgraph` under `graph_key`.
+
+    Errors are only logged, as this cache is not required to compile
+    functions.
+    """
+    digest, key = graph_key
+    # The inputs are replaced by variables without value (shared variables
+    # would otherwise store their content).
+    memo = dict((r, r.type(name=r.name)) for r in fgraph.inputs)
+    equiv = gof.graph.clone_get_equiv(fgraph.inputs, fgraph.outputs,
+                                      memo=memo)
+    for obj in equiv.itervalues():
+        for attr in ('test_value', 'trace'):
+            if hasattr(obj.tag, attr):
+                delattr(obj.tag, attr)
+    inputs = [equiv[r] for r in fgraph.inputs]
+    outputs = [equiv[r] for r in fgraph.outputs]
+    path = _optimized_graph_path(digest)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another process may have created it.
+                assert os.path.isdir(os.path.dirname(path))
+        f = open(tmp_path, 'wb')
+        try:
+            cPickle.dump((key, inputs, outputs), f,
+                         protocol=cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        # Readers never see a partially written file.
+        if os.path.exists(path) and sys.platform == 'win32':
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except Exception, e:
+        _logger.info('Could not store the optimized graph %s: %s', path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _add_optimizer_requirements(optimizer, fgraph):
+    """
+    Add to `fgraph` the features that `optimizer` would have added when
+    optimizing it.
+    """
+    if isinstance(optimizer, gof.SeqOptimizer):
+        for opt in optimizer:
+            _add_optimizer_requirements(opt, fgraph)
+    else:
+        optimizer.add_requirements(fgraph)
+
+
+def install_optimized_graph(fgraph, optimizer, inputs, outputs):
+    """
+    Replace the outputs of `fgraph` by the optimized graph going from
+    `inputs` to `outputs`, as returned by `load_optimized_graph`.
+
+    The inputs of `fgraph` are substituted to `inputs` in that graph, and
+    the features required by `optimizer` (e.g. the DestroyHandler) are
+    added to `fgraph`, as if it had optimized it.
+    """
+    assert len(inputs) == len(fgraph.inputs)
+    assert len(outputs) == len(fgraph.outputs)
+    givens = dict(zip(inputs, fgraph.inputs))
+    for node in gof.graph.io_toposort(inputs, outputs):
+        for i, r in enumerate(node.inputs):
+            if r in givens:
+                node.inputs[i] = givens[r]
+    for i, r in enumerate(outputs):
+        fgraph.change_input('output', i, givens.get(r, r),
+                            reason='optimized_graph_cache')
+    _add_optimizer_requirements(optimizer, fgraph)
+    fgraph.validate()
+
+
 NODEFAULT = ['NODEFAULT']
 class FunctionMaker(object):
     """`FunctionMaker` is the class to `create` `Function` instances.
@@ -971,6 +1478,13 @@ class FunctionMaker(object):
 
     env = property(env_getter, env_setter, env_deleter)
 
+    compile_profile = None
+    # CompileProfile instance when config.profile_compile is True
+
+    output_variables = property(
+            lambda self: self.fgraph.outputs,
+            doc="the variables computed by the functions of this maker")
+
 
     @staticmethod
     def wrap_out(output):
@@ -1018,7 +1532,10 @@ class FunctionMaker(object):
             raise TypeError(
                     'profile passed via both "mode" and "profile" arguments')
         self.profile = profile = profile or mode_profile
-        if profile:
+        if theano.config.profile_compile:
+            self.compile_profile = CompileProfile()
+        compile_profile = self.compile_profile
+        if profile or compile_profile:
             # We preload the cache here to don't have its timming
             # included in optimization that compile function.
             theano.gof.cc.get_module_cache()
@@ -1050,8 +1567,12 @@ class FunctionMaker(object):
         assert expanded_inputs == inputs  # JB - I added this to make sure we could delete above
 
         # make the fgraph (copies the graph, creates NEW INPUT AND OUTPUT VARIABLES)
+        start_std_fgraph = time.time()
         fgraph, additional_outputs = std_fgraph(expanded_inputs, outputs, accept_inplace)
         fgraph.profile = profile
+        if compile_profile:
+            compile_profile.record('std_fgraph',
+                                   time.time() - start_std_fgraph)
 
         self.fgraph = fgraph
 
@@ -1061,26 +1582,82 @@ class FunctionMaker(object):
         # optimize the fgraph
         compute_test_value_orig = theano.config.compute_test_value
         add_stack_trace_on_call = gof.Op.add_stack_trace_on_call
+        if compile_profile:
+            gof.utils.compile_profilers.append(compile_profile)
         try:
             theano.config.compute_test_value = "off"
             gof.Op.add_stack_trace_on_call = False
             start_optimizer = time.time()
-            optimizer_profile = optimizer(fgraph)
+            graph_key = None
+            optimized_graph = None
+            if theano.config.optimized_graph_cache:
+                graph_key = optimized_graph_key(fgraph, inputs, mode,
+                                                accept_inplace)
+                if graph_key is not None:
+                    optimized_graph = load_optimized_graph(graph_key)
+                    if compile_profile:
+                        if optimized_graph is None:
+                            phase = 'optimized graph cache miss'
+                        else:
+                            phase = 'optimized graph cache hit'
+                        compile_profile.record(
+                                phase, time.time() - start_optimizer)
+            if optimized_graph is not None:
+                try:
+                    install_optimized_graph(fgraph, optimizer,
+                                            *optimized_graph)
+                except Exception, e:
+                    _logger.warning('Could not use the cached optimized '
+                                    'graph, optimizing again: %s', e)
+                    optimized_graph = None
+                    fgraph, additional_outputs = std_fgraph(
+                            expanded_inputs, outputs, accept_inplace)
+                    fgraph.profile = profile
+                    self.fgraph = fgraph
+            if optimized_graph is None:
+                optimizer_profile = optimizer(fgraph)
+                if graph_key is not None:
+                    save_optimized_graph(graph_key, fgraph)
             end_optimizer = time.time()
             opt_time = end_optimizer - start_optimizer
             mode.optimizer_time += opt_time
 
             if profile:
                 profile.optimizer_time += opt_time
-                if theano.config.profile_optimizer:
+                if (theano.config.profile_optimizer and
+                        optimized_graph is None):
                     profile.optimizer_profile = (optimizer, optimizer_profile)
-            _logger.debug('Optimizing took %f seconds', opt_time)
+            if compile_profile:
+                compile_profile.record('optimizer', opt_time)
+                if (optimized_graph is None and
+                        isinstance(optimizer, gof.SeqOptimizer) and
+                        len(optimizer_profile[1]) == len(optimizer)):
+                    # Time of each phase of the optdb. (If one of them
+                    # failed, we cannot match the times to the phases.)
+                    for opt, sub_time in zip(optimizer, optimizer_profile[1]):
+                        name = getattr(opt, 'name', None)
+                        if name is None:
+                            name = getattr(opt, '__name__',
+                                           opt.__class__.__name__)
+                        compile_profile.record('optimizer: %s' % name,
+                                               sub_time)
+            if optimized_graph is None:
+                _logger.debug('Optimizing took %f seconds', opt_time)
+            else:
+                _logger.debug('Loading the optimized graph took %f seconds',
+                              opt_time)
 
             #Add deep copy to respect the memory interface
+            start_deepcopy = time.time()
             insert_deepcopy(fgraph, inputs, outputs + additional_outputs)
+            if compile_profile:
+                compile_profile.record('insert_deepcopy',
+                                       time.time() - start_deepcopy)
         finally:
             theano.config.compute_test_value = compute_test_value_orig
             gof.Op.add_stack_trace_on_call = add_stack_trace_on_call
+            if compile_profile:
+                gof.utils.compile_profilers.remove(compile_profile)
 
         # initialize the linker
         if not hasattr(linker, 'accept'):
@@ -1089,11 +1666,15 @@ class FunctionMaker(object):
 
         #the 'no_borrow' outputs are the ones for which that we can't return the internal storage pointer.
         assert len(fgraph.outputs) == len(outputs + additional_outputs)
+        start_accept = time.time()
         no_borrow = [output for output, spec in zip(fgraph.outputs, outputs + additional_outputs) if not spec.borrow]
         if no_borrow:
             self.linker = linker.accept(fgraph, no_recycling=infer_reuse_pattern(fgraph, no_borrow))
         else:
             self.linker = linker.accept(fgraph)
+        if compile_profile:
+            compile_profile.record('linker.accept',
+                                   time.time() - start_accept)
 
         if hasattr(linker, 'accept_var_updates'):
             # hacky thing so VMLinker knows about updates
@@ -1118,7 +1699,8 @@ class FunctionMaker(object):
                 for i in self.inputs
         ]
 
-    def _check_unused_inputs(self, inputs, outputs, on_unused_input):
+    @staticmethod
+    def _check_unused_inputs(inputs, outputs, on_unused_input):
         if on_unused_input is None:
             on_unused_input = theano.config.on_unused_input
 
@@ -1223,8 +1805,16 @@ class FunctionMaker(object):
                 storage))
 
         # Get a function instance
+        compile_profile = self.compile_profile
+        if compile_profile:
+            gof.utils.compile_profilers.append(compile_profile)
         start_linker = time.time()
-        _fn, _i, _o = self.linker.make_thunk(input_storage=input_storage_lists)
+        try:
+            _fn, _i, _o = self.linker.make_thunk(
+                    input_storage=input_storage_lists)
+        finally:
+            if compile_profile:
+                gof.utils.compile_profilers.remove(compile_profile)
         end_linker = time.time()
 
         linker_time = end_linker - start_linker
@@ -1233,6 +1823,8 @@ class FunctionMaker(object):
         if self.profile:
             self.profile.linker_time += linker_time
             _fn.time_thunks = self.profile.flag_time_thunks
+        if compile_profile:
+            compile_profile.record('linker.make_thunk', linker_time)
 
         fn = self.function_builder(_fn, _i, _o, self.indices, self.outputs,
                 defaults, self.unpack_single, self.return_none, self)
@@ -1258,6 +1850,230 @@ def _constructor_FunctionMaker(kwargs):
 copy_reg.pickle(FunctionMaker, _pickle_FunctionMaker)
 
 
+def _input_storage(input):
+    """
+    Return the storage of a SymbolicInput whose value is a Container (or a
+    shared variable), or None.
+    """
+    value = input.value
+    if isinstance(value, gof.Variable):
+        value = value.container
+    if isinstance(value, gof.Container):
+        return value.storage
+    return None
+
+
+class GroupFunction(Function):
+    """
+    A Function of a FunctionGroup.
+
+    Its input storage is shared with the other functions of the group, which
+    may have left their own values in it. So the default values of its
+    inputs are put back before each call, and not only after it.
+    """
+
+    def __call__(self, *args, **kwargs):
+        for c, (required, refeed, value) in zip(self.input_storage,
+                                                self.defaults):
+            if refeed:
+                if isinstance(value, gof.Container):
+                    value = value.storage[0]
+                c.value = value
+        return super(GroupFunction, self).__call__(*args, **kwargs)
+
+
+class FunctionGroupMember(object):
+    """
+    The `maker` of a Function of a FunctionGroup.
+
+    It has the attributes of a FunctionMaker used by the Function. Its
+    `fgraph` is the FunctionGraph of the whole group, and its
+    `output_variables` are the outputs of that graph computed by the
+    function.
+    """
+
+    def __init__(self, group, inputs, outputs, output_variables,
+                 unpack_single, return_none):
+        self.group = group
+        self.fgraph = group.maker.fgraph
+        self.mode = group.maker.mode
+        self.profile = group.maker.profile
+        self.compile_profile = group.maker.compile_profile
+        self.inputs = inputs
+        self.expanded_inputs = inputs
+        self.indices = [[input, None, [input]] for input in inputs]
+        self.outputs = outputs
+        self.output_variables = output_variables
+        self.unpack_single = unpack_single
+        self.return_none = return_none
+
+    def create(self, input_storage=None, trustme=False):
+        raise NotImplementedError(
+                "The functions of a FunctionGroup cannot be copied")
+
+    def __reduce__(self):
+        raise NotImplementedError(
+                "The functions of a FunctionGroup cannot be pickled")
+
+
+class FunctionGroup(object):
+    """
+    Compile several functions of the same graph together.
+
+    The outputs and the update expressions of all the functions are put in
+    one FunctionGraph, which is optimized and linked once. The subgraphs
+    that the functions have in common are merged by the optimizer, and
+    their thunks and storage are shared: each function only runs the
+    thunks of the nodes that it needs.
+
+    The mode must use a VM_Linker. An input can only be destroyed, or
+    aliased to an output, by the group if all its functions allow it.
+    """
+
+    def __init__(self, members, mode=None, accept_inplace=False,
+                 profile=None, on_unused_input=None):
+        """
+        :param members: list of pairs (inputs, outputs), one for each
+            function. `inputs` is a list of SymbolicInput instances, and
+            `outputs` is like for FunctionMaker.
+
+        The other parameters are like for FunctionMaker.
+        """
+        mode = mode_module.get_mode(mode)
+        if not isinstance(mode.linker, gof.vm.VM_Linker):
+            raise TypeError('FunctionGroup needs a VM_Linker', mode.linker)
+
+        group_inputs = []
+        input_index = {}  # variable -> index in group_inputs
+        group_outputs = []
+        self.members = []
+        for inputs, outputs in members:
+            unpack_single = False
+            return_none = False
+            if outputs is None:
+                return_none = True
+                outputs = []
+            if not isinstance(outputs, (list, tuple)):
+                unpack_single = True
+                outputs = [outputs]
+            inputs = map(FunctionMaker.wrap_in, inputs)
+            outputs = map(FunctionMaker.wrap_out, outputs)
+            FunctionMaker._check_unused_inputs(inputs, outputs,
+                                               on_unused_input)
+
+            for input in inputs:
+                if isinstance(input, SymbolicInputKit):
+                    raise TypeError('FunctionGroup does not support '
+                                    'SymbolicInputKit', input)
+                if input.variable not in input_index:
+                    group_input = copy.copy(input)
+                    # The updates are outputs of the group, and are done by
+                    # the function that has them.
+                    group_input.update = None
+                    input_index[input.variable] = len(group_inputs)
+                    group_inputs.append(group_input)
+                    continue
+                group_input = group_inputs[input_index[input.variable]]
+                if _input_storage(group_input) is not _input_storage(input):
+                    raise ValueError('The functions of a FunctionGroup must '
+                                     'use the same storage for an input',
+                                     input.variable)
+                group_input.mutable = group_input.mutable and input.mutable
+                group_input.borrow = group_input.borrow and input.borrow
+
+            output_indices = range(len(group_outputs),
+                                   len(group_outputs) + len(outputs))
+            group_outputs.extend(outputs)
+            for input in inputs:
+                if input.update is not None:
+                    output_indices.append(len(group_outputs))
+                    group_outputs.append(SymbolicOutput(input.update))
+            self.members.append((inputs, outputs,
+                                 [input_index[i.variable] for i in inputs],
+                                 output_indices, unpack_single, return_none))
+
+        self.maker = FunctionMaker(group_inputs, group_outputs, mode,
+                                   accept_inplace=accept_inplace,
+                                   profile=profile, on_unused_input='ignore')
+
+    def create(self):
+        """
+        Return the list of the Function instances of the group.
+        """
+        maker = self.maker
+        fgraph = maker.fgraph
+
+        subsets = []
+        for inputs, outputs, input_indices, output_indices, _, _ in \
+                self.members:
+            output_variables = [fgraph.outputs[i] for i in output_indices]
+            updated_vars = {}
+            updated = [(j, input) for j, input in zip(input_indices, inputs)
+                       if input.update is not None]
+            for (j, input), new_value in zip(
+                    updated, output_variables[len(outputs):]):
+                updated_vars[fgraph.inputs[j]] = new_value
+            subsets.append((output_variables, updated_vars))
+
+        input_storage = []
+        for input in maker.inputs:
+            storage = _input_storage(input)
+            if storage is None:
+                storage = [None]
+            input_storage.append(storage)
+
+        compile_profile = maker.compile_profile
+        if compile_profile:
+            gof.utils.compile_profilers.append(compile_profile)
+        start_linker = time.time()
+        try:
+            vms, input_containers, output_containers, _, _ = \
+                    maker.linker.make_all_subsets(subsets, input_storage)
+        finally:
+            if compile_profile:
+                gof.utils.compile_profilers.remove(compile_profile)
+        linker_time = time.time() - start_linker
+        _logger.debug('Linker took %f seconds', linker_time)
+        maker.mode.linker_time += linker_time
+        if maker.profile:
+            maker.profile.linker_time += linker_time
+        if compile_profile:
+            compile_profile.record('linker.make_thunk', linker_time)
+
+        functions = []
+        for (inputs, outputs, input_indices, output_indices, unpack_single,
+             return_none), (output_variables, _), vm, o_containers in zip(
+                     self.members, subsets, vms, output_containers):
+            # Each function has its own containers, on the storage of the
+            # group.
+            i_containers = [
+                    gof.Container(fgraph.inputs[j],
+                                  input_containers[j].storage)
+                    for j in input_indices]
+            defaults = []
+            for input in inputs:
+                required = input.value is None
+                refeed = (input.value is not None and
+                          not isinstance(input.value, gof.Container) and
+                          input.update is None)
+                if required or input.shared or _input_storage(input):
+                    storage = None
+                else:
+                    storage = input.value
+                defaults.append((required, refeed, storage))
+            member = FunctionGroupMember(self, inputs, outputs,
+                                         output_variables, unpack_single,
+                                         return_none)
+            if maker.profile:
+                vm.time_thunks = maker.profile.flag_time_thunks
+            fn = GroupFunction(vm, i_containers, o_containers, member.indices,
+                               outputs, defaults, unpack_single, return_none,
+                               member)
+            fn.profile = maker.profile
+            functions.append(fn)
+        return functions
+
+
 try:
     # Pickle of slice is implemented on python 2.6.  To enabled be
     # compatible with python 2.4, we implement pickling of slice
@@ -1401,11 +2217,69 @@ def orig_function(inputs, outputs, mode=None, accept_inplace=False,
     t2 = time.time()
     if profile:
         profile.compile_time += t2 - t1
+    compile_profile = getattr(fn.maker, 'compile_profile', None)
+    if compile_profile:
+        compile_profile.compile_time += t2 - t1
+        compile_profile.message = name
 
     fn.name = name
     return fn
 
 
+def orig_function_group(members, mode=None, accept_inplace=False,
+                        names=None, profile=None, on_unused_input=None):
+    """
+    Return a list of Functions, one for each pair (inputs, outputs) of
+    `members`, compiled together by a `FunctionGroup`.
+
+    :param members: list of pairs (inputs, outputs), like the parameters of
+        `orig_function`.
+
+    :param names: None, or a list with an optional name for each function.
+
+    The other parameters are like for `orig_function`. If the linker of the
+    mode is not a VM_Linker, the functions are compiled separately.
+    """
+    t1 = time.time()
+    mode = mode_module.get_mode(mode)
+    if names is None:
+        names = [None] * len(members)
+
+    converted = []
+    for inputs, outputs in members:
+        inputs = map(convert_function_input, inputs)
+        if isinstance(outputs, (list, tuple)):
+            outputs = map(FunctionMaker.wrap_out, outputs)
+        elif outputs is not None:
+            outputs = FunctionMaker.wrap_out(outputs)
+        converted.append((inputs, outputs))
+
+    if not isinstance(mode.linker, gof.vm.VM_Linker):
+        _logger.debug('The linker %s is not a VM_Linker, compiling the '
+                      'functions of the group separately', mode.linker)
+        return [orig_function(inputs, outputs, mode,
+                              accept_inplace=accept_inplace, name=name,
+                              profile=profile,
+                              on_unused_input=on_unused_input)
+                for (inputs, outputs), name in zip(converted, names)]
+
+    group = FunctionGroup(converted, mode, accept_inplace=accept_inplace,
+                          profile=profile, on_unused_input=on_unused_input)
+    fns = group.create()
+
+    t2 = time.time()
+    if profile:
+        profile.compile_time += t2 - t1
+    compile_profile = group.maker.compile_profile
+    if compile_profile:
+        compile_profile.compile_time += t2 - t1
+        compile_profile.message = ', '.join(str(name) for name in names)
+
+    for fn, name in zip(fns, names):
+        fn.name = name
+    return fns
+
+
 def convert_function_input(input):
     """
     Upgrade a input shortcut to an In instance.
@@ -7,6 +7,7 @@ import numpy
 import  theano
 from theano import gof
 import theano.gof.vm
+from theano.compile.budgetopt import BudgetedOptimizer
 from theano.configparser import config, AddConfigVar, StrParam
 
 
@@ -70,6 +71,8 @@ predefined_linkers = {
     'cvm': gof.vm.VM_Linker(use_cloop=True),
     'vm_nogc': gof.vm.VM_Linker(allow_gc=False, use_cloop=False),
     'cvm_nogc': gof.vm.VM_Linker(allow_gc=False, use_cloop=True),
+    'pvm': gof.vm.VM_Linker(parallel=True),
+    'pvm_nogc': gof.vm.VM_Linker(allow_gc=False, parallel=True),
     }
 
 
@@ -100,7 +103,8 @@ predefined_optimizers = {
     'fast_run': OPT_FAST_RUN,
     'fast_run_stable': OPT_FAST_RUN_STABLE,
     'fast_compile': OPT_FAST_COMPILE,
-    'stabilize': OPT_STABILIZE
+    'stabilize': OPT_STABILIZE,
+    'budgeted': BudgetedOptimizer(OPT_FAST_RUN),
     }
 
 
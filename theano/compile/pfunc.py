@@ -2,11 +2,12 @@
 
 __docformat__ = 'restructuredtext en'
 
+import time
 
 from profiling import ProfileStats
 
 from theano import config
-from theano.compile import orig_function, In, Out
+from theano.compile import orig_function, orig_function_group, In, Out
 from theano.compile import UnusedInputError
 from theano.compile.sharedvalue import SharedVariable, shared
 from theano.gof import Container, Variable, generic, graph, Constant
@@ -429,6 +430,86 @@ def pfunc(params, outputs=None, mode=None, updates=None, givens=None,
     # No need to block other objects being passed through though. It might be
     # useful.
 
+    inputs, cloned_outputs, rebuild_time = _pfunc_inputs_outputs(
+            params, outputs, updates, givens, no_default_updates,
+            allow_input_downcast)
+
+    fn = orig_function(inputs, cloned_outputs, mode,
+            accept_inplace=accept_inplace, name=name, profile=profile,
+            on_unused_input=on_unused_input)
+    compile_profile = getattr(fn.maker, 'compile_profile', None)
+    if compile_profile:
+        compile_profile.compile_time += rebuild_time
+        compile_profile.record('rebuild_collect_shared', rebuild_time)
+    return fn
+
+
+def pfunc_group(functions, mode=None, accept_inplace=False, profile=None,
+                on_unused_input=None):
+    """Function-constructor for several functions compiled together.
+
+    :type functions: list of dict
+    :param functions: the parameters of each function: `params`, `outputs`,
+    and optionally `updates`, `givens`, `no_default_updates`, `name` and
+    `allow_input_downcast`, like for pfunc.
+
+    The other parameters are like for pfunc.
+
+    :rtype: list of theano.compile.Function
+    :returns: the functions, that share their optimized graph and the
+    storage of their intermediate results (see
+    `theano.compile.function_module.FunctionGroup`).
+    """
+    if profile is None:
+        profile = config.profile
+    if profile == True:
+        profile = ProfileStats(message='function group')
+    if type(profile) == str:
+        profile = ProfileStats(message=profile)
+
+    members = []
+    names = []
+    rebuild_time = 0
+    for kwargs in functions:
+        kwargs = dict(kwargs)
+        params = kwargs.pop('params')
+        outputs = kwargs.pop('outputs', None)
+        names.append(kwargs.pop('name', None))
+        updates = kwargs.pop('updates', None)
+        givens = kwargs.pop('givens', None)
+        no_default_updates = kwargs.pop('no_default_updates', False)
+        allow_input_downcast = kwargs.pop('allow_input_downcast', None)
+        if kwargs:
+            raise TypeError('Unknown parameters of a function of the group',
+                            kwargs.keys())
+        if updates is None:
+            updates = []
+        if givens is None:
+            givens = []
+        inputs, cloned_outputs, rebuild_time_i = _pfunc_inputs_outputs(
+                params, outputs, updates, givens, no_default_updates,
+                allow_input_downcast)
+        members.append((inputs, cloned_outputs))
+        rebuild_time += rebuild_time_i
+
+    fns = orig_function_group(members, mode, accept_inplace=accept_inplace,
+                              names=names, profile=profile,
+                              on_unused_input=on_unused_input)
+    compile_profile = None
+    if fns:
+        compile_profile = getattr(fns[0].maker, 'compile_profile', None)
+    if compile_profile:
+        compile_profile.compile_time += rebuild_time
+        compile_profile.record('rebuild_collect_shared', rebuild_time)
+    return fns
+
+
+def _pfunc_inputs_outputs(params, outputs, updates, givens,
+                          no_default_updates, allow_input_downcast):
+    """
+    Return the In instances and the cloned outputs to compile for pfunc,
+    and the time taken to clone the graph.
+    """
     if not isinstance(params, (list, tuple)):
         raise Exception("in pfunc() the first argument must be a list or a tuple")
 
@@ -451,6 +532,7 @@ def pfunc(params, outputs=None, mode=None, updates=None, givens=None,
                      "provided for it being ignored. Please do not duplicate "
                      "variables in the inputs list." % (v, i, dup_v_i)))
 
+    start_rebuild = time.time()
     output_vars = rebuild_collect_shared(outputs,
                                          in_variables,
                                          replace=givens,
@@ -458,6 +540,7 @@ def pfunc(params, outputs=None, mode=None, updates=None, givens=None,
                                          rebuild_strict=True,
                                          copy_inputs_over=True,
                                          no_default_updates=no_default_updates)
+    rebuild_time = time.time() - start_rebuild
     # extracting the arguments
     input_variables, cloned_outputs, other_stuff = output_vars
     clone_d, update_d, update_expr, shared_inputs = other_stuff
@@ -477,9 +560,7 @@ def pfunc(params, outputs=None, mode=None, updates=None, givens=None,
                     mutable=False, borrow=True, shared=True)
         inputs.append(si)
 
-    return orig_function(inputs, cloned_outputs, mode,
-            accept_inplace=accept_inplace, name=name, profile=profile,
-            on_unused_input=on_unused_input)
+    return inputs, cloned_outputs, rebuild_time
 
 
 def _pfunc_param_to_in(param, strict=False, allow_downcast=None):
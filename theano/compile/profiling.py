@@ -17,6 +17,7 @@ __docformat__ = "restructuredtext en"
 import atexit
 import copy
 import sys
+import threading
 import time
 
 import numpy
@@ -79,6 +80,115 @@ def _atexit_print_fn():
 atexit.register(_atexit_print_fn)
 
 
+_atexit_compile_print_list = []
+
+
+def _atexit_compile_print_fn():
+    """Print CompileProfile objects in _atexit_compile_print_list to
+    _atexit_print_file, followed by their sum if there are several of them.
+    """
+    profiles = [cp for cp in _atexit_compile_print_list if cp.phase_time]
+    for cp in profiles:
+        cp.summary(file=_atexit_print_file)
+    if len(profiles) > 1:
+        cum = profiles[0]
+        for cp in profiles[1:]:
+            cum = cum.merge(cp)
+        cum.message = "Sum of all printed compile profiles at exit"
+        cum.summary(file=_atexit_print_file)
+
+
+atexit.register(_atexit_compile_print_fn)
+
+
+# CompileProfile.record can be called from the threads compiling C modules.
+_compile_profile_lock = threading.Lock()
+
+
+class CompileProfile(object):
+    """
+    Object to store where the time goes when compiling a function.
+
+    This is the `compile_profile` attribute of `Function.maker` when
+    `config.profile_compile` is True. While the function is being compiled,
+    it is in `theano.gof.utils.compile_profilers`, so that it receives the
+    phases reported by gof (C code generation, g++, dlimport, module cache
+    refresh, lock waits, ...) on top of those of the FunctionMaker (graph
+    cloning, each optimizer of the optdb, insert_deepcopy, linking, ...).
+
+    Each phase is given the total wall time spent in it and the number of
+    times it happened. Cache hits and misses are recorded as phases too.
+    Note that phases can be nested (e.g. g++ runs during the linker phase),
+    and that the times of modules compiled in parallel are added up, so
+    phase times do not sum to `compile_time`.
+    """
+
+    compile_time = 0.0
+    # Total time spent compiling the function(s)
+
+    message = None
+    # pretty string to print in summary, to identify this output
+
+    phase_time = None
+    # dict from phase name -> total wall time
+
+    phase_count = None
+    # dict from phase name -> number of occurrences
+
+    def __init__(self, atexit_print=True, **kwargs):
+        """
+        atexit_print - bool. True means that this object will be printed to
+                       stderr (using .summary()) at the end of the program.
+        **kwargs - misc initializers. These should (but need not) match the
+                   names of the class vars declared in this class.
+        """
+        self.phase_time = {}
+        self.phase_count = {}
+        self.__dict__.update(kwargs)
+        if atexit_print:
+            _atexit_compile_print_list.append(self)
+
+    def record(self, phase, elapsed=0.0):
+        """Add `elapsed` seconds and one occurrence to `phase`."""
+        _compile_profile_lock.acquire()
+        try:
+            self.phase_time[phase] = self.phase_time.get(phase, 0) + elapsed
+            self.phase_count[phase] = self.phase_count.get(phase, 0) + 1
+        finally:
+            _compile_profile_lock.release()
+
+    def merge(self, other):
+        """Return a new CompileProfile summing `self` and `other`."""
+        rval = CompileProfile(atexit_print=False, message=self.message,
+                              compile_time=self.compile_time +
+                              other.compile_time)
+        for cp in (self, other):
+            for phase, t in cp.phase_time.iteritems():
+                rval.phase_time[phase] = rval.phase_time.get(phase, 0) + t
+            for phase, n in cp.phase_count.iteritems():
+                rval.phase_count[phase] = rval.phase_count.get(phase, 0) + n
+        return rval
+
+    def summary(self, file=sys.stderr):
+        print >> file, 'Compile profiling'
+        print >> file, '================='
+        print >> file, '  Message: %s' % self.message
+        print >> file, '  Total compile time: %es' % self.compile_time
+        print >> file, ('  Phases (they can be nested, and the times of '
+                        'parallel compilations add up):')
+        print >> file, '    <time> <% compile time> <count> <phase>'
+        phases = sorted(self.phase_time.items(),
+                        key=lambda item: (-item[1], item[0]))
+        for phase, t in phases:
+            if self.compile_time > 0:
+                pct = '%6.1f%%' % (100 * t / self.compile_time)
+            else:
+                pct = '    n/a'
+            print >> file, '    %.3es %s %6i %s' % (
+                    t, pct, self.phase_count[phase], phase)
+        print >> file, ''
+
+
 class ProfileStats(object):
     """
     Object to store runtime and memory profiling information for all of
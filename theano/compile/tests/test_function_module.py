@@ -1,6 +1,8 @@
 import copy
 import cPickle
 import numpy
+import os
+import StringIO
 import unittest
 
 
@@ -386,6 +388,90 @@ class T_function(unittest.TestCase):
         self.assertRaises(UnusedInputError, function, [m, mt], mt*2)
         f = function([m, mt], mt*2, on_unused_input='ignore')
 
+    def test_trust_input(self):
+        x, y = T.vectors('xy')
+        s = theano.shared(numpy.asarray(1., dtype=config.floatX))
+        f = function([x, y], x * y + s, updates=[(s, s + 1)])
+        x_val = numpy.asarray([1, 2], dtype=config.floatX)
+        y_val = numpy.asarray([3, 4], dtype=config.floatX)
+        f.trust_input = True
+        assert numpy.allclose(f(x_val, y_val), [4, 9])
+        assert numpy.allclose(s.get_value(), 2)
+        assert numpy.allclose(f(x_val, y_val), [5, 10])
+        # Calls that do not give all the explicit inputs positionally are
+        # still checked.
+        self.assertRaises(TypeError, f, x_val)
+        assert numpy.allclose(f(x_val, y=y_val), [6, 11])
+
+    def test_map(self):
+        x = T.vector('x')
+        s = theano.shared(numpy.asarray(0., dtype=config.floatX))
+        f = function([x], [x * 2, x.sum() + s], updates=[(s, s + 1)])
+        args = [(numpy.asarray([i, i + 1], dtype=config.floatX),)
+                for i in range(4)]
+        doubled, sums = f.map(args)
+        assert isinstance(doubled, numpy.ndarray)
+        assert doubled.shape == (4, 2)
+        assert numpy.allclose(doubled, [[0, 2], [2, 4], [4, 6], [6, 8]])
+        # The updates are done after each call.
+        assert numpy.allclose(sums, [1, 4, 7, 10])
+        assert numpy.allclose(s.get_value(), 4)
+
+        # Values of different shapes are returned in a list.
+        g = function([x], x * 2)
+        vals = [numpy.asarray(v, dtype=config.floatX)
+                for v in [[1.], [1., 2.], [3.]]]
+        res = g.map([(vals[0],), (vals[1],), dict(x=vals[2])])
+        assert isinstance(res, list)
+        assert [list(r) for r in res] == [[2.], [2., 4.], [6.]]
+        assert g.map([], stack=False) == []
+        assert [list(r) for r in g.imap([(vals[0],), (vals[2],)])] == [
+            [2.], [6.]]
+        g.trust_input = True
+        assert numpy.allclose(g.map([(vals[0],), (vals[2],)]), [[2.], [6.]])
+
+        # The default values are used when arguments are missing.
+        y = T.scalar('y')
+        h = function([x, theano.Param(y, default=1.)], x * y)
+        res = h.map([(vals[0], 3.), (vals[2],), (vals[0], 2.)])
+        assert numpy.allclose(res, [[3.], [3.], [2.]])
+        self.assertRaises(Exception, h.map, [('x',)])
+
+    def test_async_call(self):
+        x = T.vector('x')
+        s = theano.shared(numpy.asarray(0., dtype=config.floatX))
+        f = function([x], x.sum() + s, updates=[(s, s + 1)])
+        # The calls are run in order, and lists are filtered.
+        futures = [f.async_call([float(i), 1.]) for i in range(5)]
+        assert [float(fut.result()) for fut in futures] == [1, 3, 5, 7, 9]
+        assert futures[0].done()
+        assert numpy.allclose(s.get_value(), 5)
+
+        # The filtered arguments are not bound again by the call.
+        def bind_inputs(args, kwargs):
+            raise AssertionError('arguments bound twice')
+        f._bind_inputs = bind_inputs
+        assert float(f.async_call([1., 1.]).result()) == 7
+        del f._bind_inputs
+
+        # Errors of the filter are raised by async_call, and those of the
+        # computation by result().
+        self.assertRaises(Exception, f.async_call, 'x')
+        m = T.matrix('m')
+        g = function([m, x], T.dot(m, x))
+        mat = numpy.ones((2, 3), dtype=config.floatX)
+        fut = g.async_call(mat, numpy.ones(2, dtype=config.floatX))
+        self.assertRaises(Exception, fut.result)
+        assert numpy.allclose(
+            g.async_call(mat, numpy.ones(3, dtype=config.floatX)).result(),
+            [3, 3])
+
+        def data():
+            for i in range(4):
+                yield (numpy.asarray([i, i], dtype=config.floatX),)
+        assert [float(r) for r in f.async_imap(data(), prefetch=2)] == [
+            5, 8, 11, 14]
+
 
 class T_picklefunction(unittest.TestCase):
 
@@ -680,6 +766,133 @@ class SomethingToPickle(object):
         self.f2 = function([x, In(a, value=1.0,name='a'), In(s, value=self.f1.container[s], update=s+a*x, mutable=True)], s+a*x)
 
 
+def test_optimized_graph_cache():
+    orig_optimized_graph_cache = config.optimized_graph_cache
+    graph_dir = os.path.join(config.compiledir, 'optimized_graphs')
+
+    def nb_graphs():
+        if not os.path.isdir(graph_dir):
+            return 0
+        return len(os.listdir(graph_dir))
+
+    try:
+        config.optimized_graph_cache = True
+        x = T.vector('x')
+        w = theano.shared(numpy.arange(3.), name='w')
+        # A random constant, so that this graph is not in the cache yet.
+        cst = numpy.random.rand(3)
+        out = T.exp(x * cst).sum()
+        mode = theano.compile.get_default_mode().excluding('gpu')
+
+        nb = nb_graphs()
+        f1 = function([x], out, updates=[(w, w + out)], mode=mode)
+        assert nb_graphs() == nb + 1
+        # The same graph, built again, is loaded from the cache.
+        f2 = function([x], out, updates=[(w, w + out)], mode=mode)
+        assert nb_graphs() == nb + 1
+        assert ([str(node.op) for node in f1.maker.fgraph.toposort()] ==
+                [str(node.op) for node in f2.maker.fgraph.toposort()])
+
+        x_val = numpy.ones(3)
+        r1 = f1(x_val)
+        w1 = w.get_value()
+        w.set_value(numpy.arange(3.))
+        r2 = f2(x_val)
+        assert numpy.allclose(r1, numpy.exp(cst).sum())
+        assert numpy.allclose(r1, r2)
+        assert numpy.allclose(w1, w.get_value())
+    finally:
+        config.optimized_graph_cache = orig_optimized_graph_cache
+
+
+def test_compile_profile():
+    orig_profile_compile = config.profile_compile
+    try:
+        config.profile_compile = True
+        x = T.vector('x')
+        f = function([x], T.exp(x * 2).sum(), name='profiled')
+        g = function([x], x + 1)
+    finally:
+        config.profile_compile = orig_profile_compile
+    cp = f.maker.compile_profile
+    assert cp.message == 'profiled'
+    assert cp.compile_time > 0
+    for phase in ['rebuild_collect_shared', 'std_fgraph', 'optimizer',
+                  'insert_deepcopy', 'linker.make_thunk']:
+        assert cp.phase_count[phase] == 1, phase
+    assert [p for p in cp.phase_time if p.startswith('optimizer: ')]
+
+    cum = cp.merge(g.maker.compile_profile)
+    assert cum.phase_count['optimizer'] == 2
+    assert numpy.allclose(cum.compile_time, cp.compile_time +
+                          g.maker.compile_profile.compile_time)
+    out = StringIO.StringIO()
+    cum.summary(file=out)
+    assert 'insert_deepcopy' in out.getvalue()
+
+    # Compiling without the flag does not record anything.
+    assert function([x], x + 2).maker.compile_profile is None
+
+
+def test_function_group():
+    x = T.vector('x')
+    y = T.vector('y')
+    w = theano.shared(numpy.ones(3), name='w')
+    h = T.tanh(x * w)
+    cost = (h - y).sum()
+    mode = theano.compile.get_default_mode()
+    if not isinstance(mode.linker, gof.vm.VM_Linker):
+        mode = theano.compile.Mode('cvm', mode.optimizer)
+    train, valid, predict = theano.function_group([
+            dict(inputs=[x, y], outputs=cost, updates=[(w, w + cost)],
+                 name='train'),
+            dict(inputs=[x, y], outputs=[cost]),
+            dict(inputs=[x, theano.Param(y, default=numpy.zeros(3))],
+                 outputs=h - y)],
+            mode=mode)
+    assert train.name == 'train'
+    # The functions share one optimized graph.
+    assert train.maker.fgraph is valid.maker.fgraph is predict.maker.fgraph
+
+    x_val = numpy.asarray([.5, 1., 2.])
+    y_val = numpy.ones(3)
+    h_val = numpy.tanh(x_val)
+    assert numpy.allclose(predict(x_val), h_val)
+    assert numpy.allclose(valid(x_val, y_val), [(h_val - 1).sum()])
+    # The default value of y is used, even after another function
+    # received y.
+    assert numpy.allclose(predict.map([(x_val,)]), [h_val])
+    valid(x_val, y_val)
+    assert numpy.allclose(predict(x_val), h_val)
+    # Only the function with the update changes w.
+    assert numpy.allclose(w.get_value(), 1)
+    assert numpy.allclose(train(x_val, y_val), (h_val - 1).sum())
+    assert numpy.allclose(w.get_value(), 1 + (h_val - 1).sum())
+    h_val = numpy.tanh(x_val * w.get_value())
+    assert numpy.allclose(predict(x_val, y_val), h_val - 1)
+    assert numpy.allclose(predict(x_val), h_val)
+
+    # predict does not run the nodes that compute the cost and the update.
+    assert len(predict.fn.nodes) < len(train.fn.nodes)
+    assert set(predict.fn.nodes).issubset(predict.maker.fgraph.nodes)
+
+    # The functions can share intermediate results that are not outputs.
+    z = T.vector('z')
+    l = T.log(T.exp(x) + 1)
+    f, g = theano.function_group([dict(inputs=[x], outputs=l * 2),
+                                  dict(inputs=[x, z], outputs=l + z)],
+                                 mode=mode)
+    l_val = numpy.log(numpy.exp(x_val) + 1)
+    assert numpy.allclose(f(x_val), l_val * 2)
+    assert numpy.allclose(g(x_val, y_val), l_val + 1)
+    assert numpy.allclose(f(x_val + 1),
+                          numpy.log(numpy.exp(x_val + 1) + 1) * 2)
+    f, g = theano.function_group([dict(inputs=[x], outputs=l * 2),
+                                  dict(inputs=[x, z], outputs=l + z)],
+                                 mode=mode.excluding('inplace'))
+    assert numpy.allclose(g(x_val, y_val), l_val + 1)
+    assert numpy.allclose(f(x_val), l_val * 2)
+
 if __name__ == '__main__':
 
     if 1:
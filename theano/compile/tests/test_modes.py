@@ -2,11 +2,19 @@
 Test compilation modes
 """
 import copy
+import os
+import shutil
+import tempfile
 import unittest
 
+import numpy
+
 import theano
 import theano.tensor as T
 from theano.compile import Mode, ProfileMode
+from theano.compile.budgetopt import (BudgetedOptimizer, OptimizerHistory,
+                                      graph_family)
+from theano.compile.mode import OPT_FAST_RUN
 
 
 class T_bunch_of_modes(unittest.TestCase):
@@ -44,6 +52,78 @@ class T_bunch_of_modes(unittest.TestCase):
         assert 5 == len(set(linker_classes_involved))
 
 
+class T_budgeted_optimizer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = OptimizerHistory(
+                os.path.join(self.tmp_dir, 'history.pkl'))
+        self.explore = theano.config.optimizer_budget.explore
+        theano.config.optimizer_budget.explore = 0
+
+    def tearDown(self):
+        theano.config.optimizer_budget.explore = self.explore
+        shutil.rmtree(self.tmp_dir)
+
+    def compile(self, opt):
+        x = T.vector()
+        f = theano.function([x], T.exp(x * 1) + 0, mode=Mode('py', opt))
+        assert numpy.allclose(f([1, 2]), numpy.exp([1, 2]))
+        return f
+
+    def test_history(self):
+        opt = BudgetedOptimizer(OPT_FAST_RUN, budget=100,
+                                history=self.history)
+        for i in range(BudgetedOptimizer.min_runs):
+            self.compile(opt)
+        fam, = self.history.data.values()
+        assert fam['runs'] == BudgetedOptimizer.min_runs
+        # The useless multiplication and addition were removed.
+        assert fam['opts']['canonicalize'][1] > 0
+        never = [name for name, stats in fam['opts'].items()
+                 if stats[1] == 0]
+        assert never
+
+        # The optimizations that never changed the graphs are now skipped,
+        # unless they are required.
+        x = T.vector()
+        fgraph = theano.gof.FunctionGraph([x], [T.exp(x * 1) + 0])
+        plan = opt.plan(fgraph)[0]
+        required = opt.required_names()
+        names = set(o.name for o, req in plan)
+        for name in never:
+            assert (name in names) == (name in required)
+
+        # The history is read back from the file.
+        history = OptimizerHistory(self.history.path)
+        assert history.family(graph_family(fgraph)) == fam
+
+    def test_no_budget(self):
+        opt = BudgetedOptimizer(OPT_FAST_RUN, budget=0,
+                                history=self.history)
+        self.compile(opt)
+        required = opt.required_names()
+        fam, = self.history.data.values()
+        assert set(fam['opts']).issubset(required)
+
+    def test_stabilize(self):
+        # The stabilize phase never changes log(x + y), but it must not be
+        # skipped on log(1 + x), of the same family.
+        opt = BudgetedOptimizer(OPT_FAST_RUN, budget=100,
+                                history=self.history)
+        x = T.vector()
+        y = T.vector()
+        for i in range(BudgetedOptimizer.min_runs + 1):
+            theano.function([x, y], T.log(x + y), mode=Mode('py', opt))
+        f = theano.function([x], T.log(1 + x), mode=Mode('py', opt))
+        assert numpy.allclose(f([1e-20]), 1e-20, rtol=1e-5, atol=0)
+
+    def test_mode(self):
+        mode = Mode('py', 'budgeted').excluding('inplace')
+        assert isinstance(mode.optimizer, BudgetedOptimizer)
+        assert 'inplace' in mode.optimizer.query.exclude
+
+
 class T_ProfileMode_WrapLinker(unittest.TestCase):
     def test_1(self):
         # First, compile a function with a new ProfileMode() object
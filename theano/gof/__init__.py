@@ -71,7 +71,7 @@ from optdb import \
 
 from toolbox import \
     Bookkeeper, History, Validator, ReplaceValidate, NodeFinder,\
-    PrintListener, ReplacementDidntRemovedError
+    TopoOrder, PrintListener, ReplacementDidntRemovedError
 
 from type import \
     Type, Generic, generic
@@ -6,8 +6,10 @@ Defines Linkers that deal with C implementations.
 from copy import copy
 import re  # for set_compiledir
 import os
+import shutil
 import StringIO
 import sys
+import time
 from itertools import izip
 
 
@@ -47,6 +49,7 @@ AddConfigVar('gcc.cxxflags',
 import graph
 import link
 import utils
+from utils import record_compile_phase
 
 from compilelock import get_lock, release_lock
 
@@ -81,6 +84,52 @@ def get_persistent_module_cache():
     return _persistent_module_cache
 
 
+# Map (op, input types, output types) -> the c_code_cache_version of the op
+# and of these types, as put in the module keys. See `_node_cache_version`.
+# It is emptied when it reaches _node_cache_versions_max entries, so that it
+# does not keep alive the ops of all the graphs of a long-running process.
+_node_cache_versions = {}
+_node_cache_versions_max = 10000
+
+
+def _node_cache_version(node):
+    """
+    Return the list of versions that `CLinker.cmodule_key_` puts in the key
+    for `node`: the version of its op, then those of its inputs and outputs
+    types.
+
+    These versions only depend on the op and on the types of the node, so
+    they are memoized: on graphs with many similar nodes (e.g. thousands of
+    identical Elemwise), computing them again for every node, and for every
+    module in OpWiseCLinker, would dominate the cost of a warm compilation.
+    """
+    memo_key = (node.op,
+                tuple(i.type for i in node.inputs),
+                tuple(o.type for o in node.outputs))
+    try:
+        return _node_cache_versions[memo_key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable op or type: do not memoize.
+        memo_key = None
+    version = []
+    try:
+        # Pure Ops do not have a c_code_cache_version_apply ...
+        version.append(node.op.c_code_cache_version_apply(node))
+    except AttributeError:
+        pass
+    for i in node.inputs:
+        version.append(i.type.c_code_cache_version())
+    for o in node.outputs:
+        version.append(o.type.c_code_cache_version())
+    if memo_key is not None:
+        if len(_node_cache_versions) >= _node_cache_versions_max:
+            _node_cache_versions.clear()
+        _node_cache_versions[memo_key] = version
+    return version
+
+
 class CodeBlock:
     """WRITEME
     Represents a computation unit composed of declare, behavior, and cleanup.
@@ -117,6 +166,26 @@ def failure_code(sub):
     return "{%(failure_var)s = %(id)s; goto __label_%(id)i;}" % sub
 
 
+def gil_code(sub):
+    """
+    Return the C code that declares the thread state of the code block
+    identified by sub['id'], and the code that releases and takes back
+    the GIL with it.
+
+    Both snippets can be used any number of times: releasing the GIL
+    while it is already released (or taking it back while it is held)
+    does nothing. This is what lets `failure_code` and the end of the
+    block take the GIL back without knowing what the Op's code did.
+    """
+    declare = "PyThreadState* __gil_state_%(id)i = NULL;\n" % sub
+    release = ("if (!__gil_state_%(id)i)"
+               " {__gil_state_%(id)i = PyEval_SaveThread();}" % sub)
+    acquire = ("if (__gil_state_%(id)i)"
+               " {PyEval_RestoreThread(__gil_state_%(id)i);"
+               " __gil_state_%(id)i = NULL;}" % sub)
+    return declare, release, acquire
+
+
 def code_gen(blocks):
     """WRITEME From a list of L{CodeBlock} instances, returns a string
     that executes them all in sequence. eg for C{(decl1, task1,
@@ -586,7 +655,9 @@ class CLinker(link.Linker):
 
             # Make the CodeBlock for c_code
             sub['id'] = id
-            sub['fail'] = failure_code(sub)
+            gil_declare, sub['release_gil'], sub['acquire_gil'] = \
+                    gil_code(sub)
+            sub['fail'] = "{%s %s}" % (sub['acquire_gil'], failure_code(sub))
 
             op = node.op
             # type-specific support code
@@ -616,6 +687,12 @@ class CLinker(link.Linker):
 
             _logger.info('compiling un-versioned Apply %s', str(node))
 
+            # The Op's code may release the GIL, and it must be held
+            # again before the cleanup code and the next node.
+            if op.c_code_gil_free(node):
+                behavior = "\n".join([sub['release_gil'], behavior])
+            behavior = "\n".join([gil_declare, behavior, sub['acquire_gil']])
+
             blocks.append(CodeBlock("", behavior, cleanup, sub))
             tasks.append((node, 'code', id))
             id += 1
@@ -985,7 +1062,8 @@ class CLinker(link.Linker):
         handles the outputs, and no_recycle is simply a list of
         booleans, indicating whether each output is in the
         no_recycling set. Older versions of compiled modules only have the
-        no_recycle list.
+        no_recycle list. The signature of a node whose Op runs without
+        the GIL (see `CLinkerOp.c_code_gil_free`) ends with 'gil_free'.
         """
         return self.cmodule_key_(self.fgraph, self.no_recycling,
                           compile_args=self.compile_args(),
@@ -1106,23 +1184,20 @@ class CLinker(link.Linker):
 
         version = []
         for node_pos, node in enumerate(order):
-            try:
-                # Pure Ops do not have a c_code_cache_version_apply ...
-                version.append(node.op.c_code_cache_version_apply(node))
-            except AttributeError:
-                pass
-            for i in node.inputs:
-                version.append(i.type.c_code_cache_version())
-            for o in node.outputs:
-                version.append(o.type.c_code_cache_version())
+            version.extend(_node_cache_version(node))
 
             #add the signature for this node
-            sig.append((
+            node_sig = (
                 node.op,
                 tuple((i.type, in_sig(i, node_pos, ipos))
                     for ipos, i in enumerate(node.inputs)),
                 (1,  # Increment if cmodule change its handling of outputs
-                    tuple(o in no_recycling for o in node.outputs))))
+                    tuple(o in no_recycling for o in node.outputs)))
+            # Only mark the nodes run without the GIL, so that the keys
+            # of the other modules do not change.
+            if node.op.c_code_gil_free(node):
+                node_sig += ('gil_free',)
+            sig.append(node_sig)
 
             if error_on_play[0]:
                 # if one of the signatures is not hashable
@@ -1166,6 +1241,7 @@ class CLinker(link.Linker):
         """
         if location is None:
             location = cmodule.dlimport_workdir(config.compiledir)
+        t0 = time.time()
         mod = self.build_dynamic_module()
         c_compiler = self.c_compiler()
         libs = self.libraries()
@@ -1185,8 +1261,13 @@ class CLinker(link.Linker):
             if 'amdlibm' in libs:
                 libs.remove('amdlibm')
         src_code = mod.code()
+        record_compile_phase('C code generation', time.time() - t0)
         yield src_code
-        get_lock()
+        # In the 'module' lock mode, the module cache takes care of locking
+        # what needs to be.
+        global_lock = config.cmodule.lock_mode == 'global'
+        if global_lock:
+            get_lock()
         try:
             _logger.debug("LOCATION %s", str(location))
             try:
@@ -1202,7 +1283,8 @@ class CLinker(link.Linker):
                 e.args += (str(self.fgraph),)
                 raise
         finally:
-            release_lock()
+            if global_lock:
+                release_lock()
 
         yield module
 
@@ -1266,10 +1348,12 @@ class CLinker(link.Linker):
         outputs in out_storage and if an error occurs will put the
         type, value and traceback of the exception in error_storage.
         """
+        t0 = time.time()
         try:
             key = self.cmodule_key()
         except KeyError:
             key = None
+        record_compile_phase('CLinker.cmodule_key', time.time() - t0)
         if key is None:
             # If we can't get a key, then forget the cache mechanism.
             module = self.compile_cmodule()
@@ -1369,6 +1453,206 @@ class _CThunk(object):
             raise exc_type, exc_value, exc_trace
 
 
+def precompile_nodes(nodes, no_recycling, force_c_code=False):
+    """
+    Compile up front the C modules needed by `nodes` that are not in the
+    module cache yet.
+
+    Linkers like OpWiseCLinker and VM_Linker build one C module per node,
+    each of them being compiled when the node's thunk is created. When the
+    cache is cold, this means compiling hundreds of modules one after the
+    other. This function finds up front all nodes whose module is missing
+    from the cache, compiles them in parallel (see
+    `config.cmodule.compile_jobs`), possibly several modules at once in the
+    same shared library (see `config.cmodule.compile_batch_size`), and adds
+    them to the cache, in the order of `nodes`. Creating the thunks
+    afterwards then only hits the cache.
+
+    Nodes for which we cannot (or do not need to) compile anything here are
+    silently skipped: they will go through the usual code path when their
+    thunk is created. This includes nodes whose compilation fails, so that
+    the error is reported as usual.
+
+    :param nodes: list of Apply nodes, typically in topological order.
+
+    :param no_recycling: the no_recycling list given to `Op.make_thunk`.
+
+    :param force_c_code: if True, consider the C code of all ops, as done by
+    OpWiseCLinker. Otherwise, only ops whose `_op_use_c_code` attribute is
+    True are considered.
+    """
+    n_jobs = cmodule.compile_jobs()
+    batch_size = config.cmodule.compile_batch_size
+    if (n_jobs <= 1 and batch_size <= 1) or len(nodes) <= 1:
+        return
+    # Lazy import to avoid circular dependency (op imports cc).
+    from theano.gof.op import Op
+    from theano.gof.fg import FunctionGraph
+    cache = get_module_cache()
+    # Modules to compile, grouped by compilation arguments.
+    to_compile = {}
+    all_compile_args = []
+    n_modules = 0
+    seen_hashes = set()
+    for node in nodes:
+        if not (force_c_code or getattr(node.op, '_op_use_c_code', False)):
+            continue
+        # Ops that define their own make_thunk may not use the CLinker.
+        if (getattr(node.op.make_thunk, 'im_func', None) is not
+                Op.make_thunk.im_func):
+            continue
+        try:
+            # This must be kept in sync with what Op.make_thunk does.
+            fgraph = FunctionGraph(*graph.clone(node.inputs, node.outputs))
+            fgraph_no_recycling = [new_o for (new_o, old_o)
+                                   in zip(fgraph.outputs, node.outputs)
+                                   if old_o in no_recycling]
+            cl = CLinker().accept(fgraph, no_recycling=fgraph_no_recycling)
+            c_compiler = cl.c_compiler()
+            if c_compiler is not cmodule.GCC_compiler:
+                # Other compilers (e.g. nvcc) keep the sequential path.
+                continue
+            t0 = time.time()
+            key = cl.cmodule_key()
+            record_compile_phase('CLinker.cmodule_key', time.time() - t0)
+            if key is None or key in cache.entry_from_key:
+                continue
+            t0 = time.time()
+            mod = cl.build_dynamic_module()
+            src_code = mod.code()
+            record_compile_phase('C code generation', time.time() - t0)
+        except (KeyError, NotImplementedError, utils.MethodNotDefined):
+            # There is no C implementation for this node.
+            continue
+        module_hash = cmodule.get_module_hash(src_code, key)
+        if (module_hash in cache.module_hash_to_key_data or
+                module_hash in seen_hashes):
+            # The module cache will re-use the existing module.
+            continue
+        seen_hashes.add(module_hash)
+        compile_args = (tuple(cl.header_dirs()), tuple(cl.lib_dirs()),
+                        tuple(cl.libraries()), tuple(cl.compile_args()))
+        if compile_args not in to_compile:
+            to_compile[compile_args] = []
+            all_compile_args.append(compile_args)
+        to_compile[compile_args].append((key, src_code, mod))
+        n_modules += 1
+
+    if n_modules <= 1:
+        # Nothing to gain, let the usual code path compile it.
+        return
+
+    # Split the modules into batches, small enough to keep all jobs busy.
+    batches = []
+    for compile_args in all_compile_args:
+        modules = to_compile[compile_args]
+        size = min(batch_size, max(1, -(-len(modules) // n_jobs)))
+        for i in xrange(0, len(modules), size):
+            batches.append((compile_args, modules[i:i + size]))
+
+    _logger.debug('Compiling %i modules in %i libraries with %i jobs',
+                  n_modules, len(batches), n_jobs)
+    # In the 'module' lock mode, the module cache will lock each module when
+    # adding it.
+    global_lock = config.cmodule.lock_mode == 'global'
+    if global_lock:
+        get_lock()
+    try:
+        while batches:
+            jobs = []
+            for (header_dirs, lib_dirs, libs, preargs), modules in batches:
+                if len(modules) == 1:
+                    module_name = modules[0][2].name
+                    src_code = modules[0][1]
+                else:
+                    module_name = 'batch'
+                    src_code = cmodule.batch_code([m for _, _, m in modules])
+                jobs.append(dict(
+                    module_name=module_name,
+                    src_code=src_code,
+                    location=cmodule.dlimport_workdir(config.compiledir),
+                    include_dirs=list(header_dirs),
+                    lib_dirs=list(lib_dirs),
+                    libs=list(libs),
+                    preargs=list(preargs)))
+            results = cmodule.parallel_compile_str(
+                    cmodule.GCC_compiler.compile_str, jobs, n_jobs=n_jobs)
+            failed_batches = []
+            for job, batch, lib_filename in zip(jobs, batches, results):
+                compile_args, modules = batch
+                if isinstance(lib_filename, Exception):
+                    if len(modules) == 1:
+                        # The error will be raised again (with a more
+                        # informative message) when the thunk of that node
+                        # is created.
+                        _logger.debug('Parallel compilation failed: %s',
+                                      lib_filename)
+                    else:
+                        # Typically, several modules define the same symbol.
+                        _logger.info('Batched compilation failed, compiling '
+                                     'the modules separately: %s',
+                                     lib_filename)
+                        failed_batches.extend(
+                                (compile_args, [m]) for m in modules)
+                else:
+                    for key, src_code, mod in modules:
+                        if len(modules) == 1:
+                            steps = _precompiled_module_steps(
+                                    src_code, lib_filename)
+                        else:
+                            steps = _precompiled_module_steps(
+                                    src_code, lib_filename, mod.name)
+                        cache.module_from_key(key=key, fn=steps)
+                cmodule._rmtree(job['location'], ignore_nocleanup=True,
+                                ignore_if_missing=True)
+            batches = failed_batches
+    finally:
+        if global_lock:
+            release_lock()
+
+
+def _precompiled_module_steps(src_code, lib_filename, module_name=None):
+    """
+    Return a callback for `ModuleCache.module_from_key` that adds to the cache
+    a module compiled beforehand in the directory of `lib_filename`.
+
+    :param module_name: if provided, `lib_filename` is a library compiled from
+    `cmodule.batch_code`, which defines the module of that name. The library
+    is then linked (or copied) into the cache directory of the module, with
+    the file name needed to import it.
+    """
+    def compile_steps(location):
+        yield src_code
+        if module_name is None:
+            # Move the compiled files to the directory chosen by the cache.
+            staging = os.path.dirname(lib_filename)
+            for filename in os.listdir(staging):
+                if filename == 'compiling':
+                    # `location` has its own (see cmodule.dlimport_workdir).
+                    continue
+                shutil.move(os.path.join(staging, filename), location)
+            module_filename = os.path.join(location,
+                                           os.path.basename(lib_filename))
+        else:
+            module_filename = os.path.join(location, '%s.%s' % (
+                module_name, cmodule.get_lib_extension()))
+            try:
+                # All the modules of the batch share the same file.
+                os.link(lib_filename, module_filename)
+            except (AttributeError, OSError):
+                # Hard links are not supported (on this file system).
+                shutil.copy(lib_filename, module_filename)
+            # Keep the code of this module, as for other modules.
+            cppfile = open(os.path.join(location, 'mod.cpp'), 'w')
+            try:
+                cppfile.write(src_code)
+            finally:
+                cppfile.close()
+            open(os.path.join(location, '__init__.py'), 'w').close()
+        yield cmodule.dlimport(module_filename)
+    return compile_steps
+
+
 class OpWiseCLinker(link.LocalLinker):
     """WRITEME
     Uses CLinker on the individual Ops that comprise an fgraph and loops
@@ -1444,6 +1728,8 @@ class OpWiseCLinker(link.LocalLinker):
             for k in storage_map:
                 compute_map[k] = [k.owner is None]
 
+            precompile_nodes(order, no_recycling, force_c_code=True)
+
             thunks = []
             for node in order:
                 # Maker sure we use the C version of the code whenever
@@ -12,6 +12,7 @@ import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import distutils.sysconfig
@@ -19,7 +20,7 @@ import distutils.sysconfig
 import numpy.distutils  # TODO: TensorType should handle this
 
 import theano
-from theano.gof.utils import flatten
+from theano.gof.utils import flatten, record_compile_phase
 from theano.configparser import config
 from theano.gof.cc import hash_from_code
 
@@ -27,7 +28,9 @@ from theano.gof.cc import hash_from_code
 import compilelock
 from compiledir import gcc_version_str
 
-from theano.configparser import AddConfigVar, BoolParam
+from theano.configparser import (AddConfigVar, BoolParam, EnumStr, IntParam,
+                                 StrParam)
+from theano.misc.cpucount import cpuCount
 
 AddConfigVar('cmodule.mac_framework_link',
         "If set to True, breaks certain MacOS installations with the infamous "
@@ -52,6 +55,75 @@ AddConfigVar('cmodule.compilation_warning',
              "If True, will print compilation warning.",
              BoolParam(False))
 
+AddConfigVar('cmodule.compile_jobs',
+             "Maximum number of C modules compiled at the same time when a "
+             "linker needs several modules that are not in the cache yet. "
+             "0 means to use the number of detected CPU cores, and 1 "
+             "disables parallel compilation.",
+             IntParam(0, lambda i: i >= 0),
+             in_c_key=False)
+
+
+AddConfigVar('cmodule.lock_mode',
+             "How processes sharing the same compiledir synchronize. With "
+             "'global', a single lock serializes all compilations. With "
+             "'module', the global lock is only held while updating the "
+             "cache, and each module is compiled while holding a lock "
+             "specific to it, so that processes only wait for each other "
+             "when they need the exact same module.",
+             EnumStr('global', 'module'),
+             in_c_key=False)
+
+
+AddConfigVar('cmodule.max_cache_size',
+             "Maximum size (in megabytes) of the versioned modules in the "
+             "cache. When a process exits, the least recently used modules "
+             "are deleted until the cache is below this size. 0 means no "
+             "limit.",
+             IntParam(0, lambda i: i >= 0),
+             in_c_key=False)
+
+
+AddConfigVar('cmodule.precompiled_headers',
+             "If True, g++ uses a precompiled header for the headers "
+             "included by all C modules (Python and numpy), built once in "
+             "the compiledir for each set of compilation flags.",
+             BoolParam(False),
+             in_c_key=False)
+
+
+AddConfigVar('cmodule.compile_batch_size',
+             "Maximum number of C modules compiled together, as a single "
+             "shared library, when a linker needs several modules that are "
+             "not in the cache yet. The includes and support code they have "
+             "in common are then only compiled once. Each module is still "
+             "cached individually. 1 disables batched compilation.",
+             IntParam(1, lambda i: i >= 1),
+             in_c_key=False)
+
+
+AddConfigVar('cmodule.base_compiledirs',
+             "List of read-only compilation directories, separated by '%s', "
+             "whose versioned modules are used before those of the "
+             "compiledir. They are never locked nor modified: modules found "
+             "there are loaded in place, and the other ones are compiled in "
+             "the compiledir as usual. This allows sharing a cache warmed "
+             "beforehand." % os.pathsep,
+             StrParam(''),
+             in_c_key=False)
+
+
+def compile_jobs():
+    """
+    Return the number of compilations that may run concurrently, as
+    defined by `config.cmodule.compile_jobs`.
+    """
+    n_jobs = config.cmodule.compile_jobs
+    if n_jobs == 0:
+        # cpuCount() returns -1 when it is unable to detect the cores.
+        n_jobs = max(cpuCount(), 1)
+    return n_jobs
+
 
 def local_bitwidth():
     """
@@ -175,34 +247,40 @@ class DynamicModule(object):
     def add_function(self, fn):
         self.functions.append(fn)
 
-    def code(self):
-        sio = StringIO.StringIO()
+    def print_includes(self, stream):
         for inc in self.includes:
             if not inc:
                 continue
             if inc[0] == '<' or inc[0] == '"':
-                print >> sio, "#include", inc
+                print >> stream, "#include", inc
             else:
-                print >> sio, '#include "%s"' % inc
+                print >> stream, '#include "%s"' % inc
 
-        print >> sio, "//////////////////////"
-        print >> sio, "////  Support Code"
-        print >> sio, "//////////////////////"
+    def print_support_code(self, stream):
+        print >> stream, "//////////////////////"
+        print >> stream, "////  Support Code"
+        print >> stream, "//////////////////////"
         for sc in self.support_code:
-            print >> sio, sc
+            print >> stream, sc
 
-        print >> sio, "//////////////////////"
-        print >> sio, "////  Functions"
-        print >> sio, "//////////////////////"
+    def print_functions(self, stream):
+        print >> stream, "//////////////////////"
+        print >> stream, "////  Functions"
+        print >> stream, "//////////////////////"
         for f in self.functions:
-            print >> sio, f.code_block
+            print >> stream, f.code_block
 
-        print >> sio, "//////////////////////"
-        print >> sio, "////  Module init"
-        print >> sio, "//////////////////////"
-        self.print_methoddef(sio)
-        self.print_init(sio)
+        print >> stream, "//////////////////////"
+        print >> stream, "////  Module init"
+        print >> stream, "//////////////////////"
+        self.print_methoddef(stream)
+        self.print_init(stream)
 
+    def code(self):
+        sio = StringIO.StringIO()
+        self.print_includes(sio)
+        self.print_support_code(sio)
+        self.print_functions(sio)
         return sio.getvalue()
 
     def list_code(self, ofile=sys.stdout):
@@ -214,6 +292,39 @@ class DynamicModule(object):
     #TODO: add_type
 
 
+def batch_code(modules):
+    """
+    Return the source code of a single shared library defining the Python
+    modules of all the DynamicModule instances in `modules`.
+
+    The includes and support code of the modules are merged, so that the
+    code they have in common is only compiled once. Each module defines
+    functions with the same names (e.g. 'instantiate'), so the functions and
+    init function of each module are put in a namespace of their own. The
+    init functions have C linkage, so that each module can still be imported
+    from the library under its own name (see `dlimport`).
+
+    This fails to compile if different modules define the same symbol in
+    their support code.
+    """
+    batch = DynamicModule('batch')
+    batch.includes = []
+    for mod in modules:
+        for inc in mod.includes:
+            if inc not in batch.includes:
+                batch.add_include(inc)
+        for code in mod.support_code:
+            batch.add_support_code(code)
+    sio = StringIO.StringIO()
+    batch.print_includes(sio)
+    batch.print_support_code(sio)
+    for mod in modules:
+        print >> sio, "namespace module_%s {" % mod.name
+        mod.print_functions(sio)
+        print >> sio, "}"
+    return sio.getvalue()
+
+
 def dlimport(fullpath, suffix=None):
     """Dynamically load a .so, .pyd, .dll, or .py file
 
@@ -249,6 +360,7 @@ def dlimport(fullpath, suffix=None):
     _logger.debug("WORKDIR %s", workdir)
     _logger.debug("module_name %s", module_name)
 
+    t0 = time.time()
     sys.path[0:0] = [workdir]  # insert workdir at beginning (temporarily)
     try:
         rval = __import__(module_name, {}, {}, [module_name])
@@ -256,6 +368,7 @@ def dlimport(fullpath, suffix=None):
             raise Exception('__import__ failed', fullpath)
     finally:
         del sys.path[0]
+        record_compile_phase('dlimport', time.time() - t0)
 
     assert fullpath.startswith(rval.__file__)
     return rval
@@ -266,8 +379,26 @@ def dlimport_workdir(basedir):
     Return a directory where you should put your .so file for dlimport
     to be able to load it, given a basedir which should normally be
     config.compiledir
+
+    The directory contains a 'compiling' file, so that it is not empty, and
+    thus not removed by `ModuleCache.refresh` in another process, before
+    the module is compiled in it. Remove it with `unmark_workdir` once the
+    module is there.
     """
-    return tempfile.mkdtemp(dir=basedir)
+    location = tempfile.mkdtemp(dir=basedir)
+    f = open(os.path.join(location, 'compiling'), 'w')
+    f.close()
+    return location
+
+
+def unmark_workdir(location):
+    """
+    Remove the 'compiling' file of a directory made by `dlimport_workdir`.
+    """
+    try:
+        os.remove(os.path.join(location, 'compiling'))
+    except OSError:
+        pass
 
 
 def last_access_time(path):
@@ -497,6 +628,10 @@ class ModuleCache(object):
     - possibly a delete.me file, meaning this directory has been marked
     for deletion.
 
+    The cache directory also contains a 'module_index' file listing the
+    directories of versioned modules (see ``read_index``). It allows
+    ``refresh`` to find new modules without walking the whole cache.
+
     Keys should be tuples of length 2: (version, rest). The
     ``rest`` can be anything hashable and picklable, that uniquely
     identifies the computation in the module. The key is returned by
@@ -552,7 +687,19 @@ class ModuleCache(object):
     """set of all key.pkl files that have been loaded.
     """
 
-    def __init__(self, dirname, check_for_broken_eq=True, do_refresh=True):
+    index_pending = []
+    """
+    List of cache directories found in the index, that have a key.pkl file
+    we could not load yet.
+    """
+
+    base_key_pkl = set()
+    """set of all key.pkl files that have been loaded from the base
+    directories.
+    """
+
+    def __init__(self, dirname, check_for_broken_eq=True, do_refresh=True,
+                 base_dirnames=None):
         """
         :param check_for_broken_eq: A bad __eq__ implementation can break this
         cache mechanism. This option turns on a not-too-expensive sanity check
@@ -560,8 +707,21 @@ class ModuleCache(object):
 
         :param do_refresh: If True, then the ``refresh`` method will be called
         in the constructor.
+
+        :param base_dirnames: List of read-only cache directories whose
+        modules are used in place (see `load_base_dirs`). Defaults to
+        `config.cmodule.base_compiledirs`.
         """
         self.dirname = dirname
+        if base_dirnames is None:
+            base_dirnames = [d for d in
+                             config.cmodule.base_compiledirs.split(os.pathsep)
+                             if d]
+        self.base_dirnames = [os.path.realpath(d) for d in base_dirnames]
+        # Cache directories of the base directories that have a key.pkl file
+        # we could not load yet (None until they are first listed).
+        self.base_pending = None
+        self.base_key_pkl = set()
         self.module_from_name = dict(self.module_from_name)
         self.entry_from_key = dict(self.entry_from_key)
         self.module_hash_to_key_data = dict(self.module_hash_to_key_data)
@@ -569,6 +729,13 @@ class ModuleCache(object):
         self.stats = [0, 0, 0]
         self.check_for_broken_eq = check_for_broken_eq
         self.loaded_key_pkl = set()
+        self.index_pending = []
+        self.index_file = os.path.join(dirname, 'module_index')
+        self.stats_file = os.path.join(dirname, 'cache_stats')
+        # Identity of the index file and position up to which we have read
+        # it, so that `read_index` only returns new records.
+        self.index_id = None
+        self.index_offset = 0
         self.time_spent_in_check_key = 0
 
         if do_refresh:
@@ -581,12 +748,176 @@ class ModuleCache(object):
     Older modules will be deleted in ``clear_old``.
     """
 
-    def refresh(self, age_thresh_use=None, delete_if_problem=False):
-        """Update cache data by walking the cache directory structure.
+    def read_index(self):
+        """
+        Return the records appended to the cache index since the last call.
+
+        The index is a text file in the cache directory, with one line per
+        versioned module: the name of its directory, followed by its module
+        hash ('-' when it is not known). Processes only ever append to it
+        (while holding the compilation lock), except when it is rebuilt by
+        `write_index`, which replaces the whole file.
+
+        :returns: a list of pairs (directory, module hash), or None if the
+        index is missing or corrupted and must be rebuilt.
+        """
+        try:
+            index = open(self.index_file, 'rb')
+        except IOError:
+            return None
+        try:
+            stat_info = os.fstat(index.fileno())
+            index_id = (stat_info.st_dev, stat_info.st_ino)
+            if (index_id != self.index_id or
+                    stat_info.st_size < self.index_offset):
+                # The index was rebuilt since last time: read it again from
+                # the start. Entries that were already loaded are skipped by
+                # refresh().
+                self.index_id = index_id
+                self.index_offset = 0
+            index.seek(self.index_offset)
+            data = index.read()
+        finally:
+            index.close()
+        # Ignore an incomplete last line, in case someone is writing it.
+        end = data.rfind('\n') + 1
+        records = []
+        for line in data[:end].splitlines():
+            fields = line.split()
+            if len(fields) != 2 or os.path.sep in fields[0]:
+                _logger.warning("Corrupted cache index %s, it will be "
+                                "rebuilt", self.index_file)
+                return None
+            records.append((os.path.join(self.dirname, fields[0]),
+                            fields[1]))
+        self.index_offset += end
+        return records
+
+    def write_index(self):
+        """
+        Rebuild the cache index from the entries currently known.
+
+        This should be called with the compilation lock held, right after a
+        refresh(), so that all entries are either loaded or in
+        `self.index_pending`.
+        """
+        module_hash_from_dir = {}
+        for module_hash, key_data in self.module_hash_to_key_data.iteritems():
+            if key_data.key_pkl in self.loaded_key_pkl:
+                module_hash_from_dir[os.path.dirname(key_data.key_pkl)] = \
+                        module_hash
+        for root in self.index_pending:
+            if os.path.isdir(root):
+                module_hash_from_dir.setdefault(root, '-')
+        tmp_file = '%s.%s' % (self.index_file, os.getpid())
+        index = open(tmp_file, 'wb')
+        try:
+            for root, module_hash in sorted(module_hash_from_dir.iteritems()):
+                index.write('%s %s\n' % (os.path.basename(root), module_hash))
+        finally:
+            index.close()
+        if sys.platform == 'win32' and os.path.exists(self.index_file):
+            # Windows cannot rename over an existing file.
+            os.remove(self.index_file)
+        os.rename(tmp_file, self.index_file)
+        # We know all the entries of the new index.
+        stat_info = os.stat(self.index_file)
+        self.index_id = (stat_info.st_dev, stat_info.st_ino)
+        self.index_offset = stat_info.st_size
+
+    def append_to_index(self, location, module_hash):
+        """
+        Add the module compiled in directory `location` to the cache index.
+
+        This should be called with the compilation lock held. If there is no
+        index yet, nothing is done, since the next refresh() will build it
+        from the whole cache directory anyway.
+        """
+        if os.path.exists(self.index_file):
+            index = open(self.index_file, 'ab')
+            try:
+                index.write('%s %s\n' % (os.path.basename(location),
+                                          module_hash))
+            finally:
+                index.close()
+
+    def load_base_dirs(self):
+        """
+        Load the versioned modules of the read-only base cache directories.
+
+        Base directories are neither locked nor modified, so they must not
+        be used by processes writing in them at the same time. Their modules
+        are loaded in place, and are never refreshed nor deleted. A module
+        is taken from the first directory it appears in, and modules already
+        known take precedence over the base ones.
+
+        The cache directories are listed from the index of each base
+        directory if it has one, and by listing its content otherwise.
+        Those whose key.pkl file cannot be loaded yet are tried again on the
+        next call.
+        """
+        if self.base_pending is None:
+            roots = []
+            for base_dirname in self.base_dirnames:
+                try:
+                    index = open(os.path.join(base_dirname, 'module_index'))
+                    try:
+                        names = [line.split()[0] for line in index
+                                 if line.strip()]
+                    finally:
+                        index.close()
+                except IOError:
+                    try:
+                        names = sorted(os.listdir(base_dirname))
+                    except OSError:
+                        _logger.warning("Cannot read base cache directory "
+                                        "%s", base_dirname)
+                        continue
+                roots.extend(os.path.join(base_dirname, name)
+                             for name in names
+                             if os.path.sep not in name)
+        else:
+            roots = self.base_pending
+        self.base_pending = []
+        for root in roots:
+            key_pkl = os.path.join(root, 'key.pkl')
+            if key_pkl in self.base_key_pkl or not os.path.exists(key_pkl):
+                continue
+            try:
+                entry = module_name_from_dir(root)
+                key_data = cPickle.load(open(key_pkl, 'rb'))
+            except Exception:
+                # Typically keys that refer to classes not imported yet.
+                _logger.debug("Could not load base cache entry %s", key_pkl)
+                self.base_pending.append(root)
+                continue
+            if (not isinstance(key_data, KeyData) or not key_data.keys or
+                    not all(key[0] for key in key_data.keys) or
+                    key_data.module_hash in self.module_hash_to_key_data):
+                continue
+            # The base directory may have been moved since it was built.
+            key_data.entry = entry
+            key_data.key_pkl = key_pkl
+            self.module_hash_to_key_data[key_data.module_hash] = key_data
+            for key in key_data.keys:
+                if key not in self.entry_from_key:
+                    self.entry_from_key[key] = entry
+                    self.similar_keys.setdefault(get_safe_part(key),
+                                                 []).append(key)
+            self.base_key_pkl.add(key_pkl)
+
+    def refresh(self, age_thresh_use=None, delete_if_problem=False,
+                rebuild_index=False, check_removed=True):
+        """Update cache data from the cache index.
 
         Load key.pkl files that have not been loaded yet.
         Remove entries which have been removed from the filesystem.
-        Also, remove malformed cache directories.
+
+        Only the entries appended to the index since the last call are
+        examined (see `read_index`), along with those that could not be
+        loaded so far. If the index is missing or corrupted, we instead walk
+        the whole cache directory structure, remove malformed cache
+        directories and rebuild the index.
 
         :param age_thresh_use: Do not use modules olther than this.
         Defaults to self.age_thresh_use.
@@ -596,6 +927,14 @@ class ModuleCache(object):
             - Those for which unpickling the KeyData file fails with an
               unknown exception.
             - Duplicated modules, regardless of their age.
+        This implies `rebuild_index`.
+
+        :param rebuild_index: If True, walk the cache directory structure and
+        rebuild the index even if it looks fine.
+
+        :param check_removed: If False, do not check whether the modules
+        already loaded are still on disk (which requires opening all of
+        them). This is used to quickly look for new modules.
 
         :returns: a list of modules of age higher than age_thresh_use.
         """
@@ -604,19 +943,41 @@ class ModuleCache(object):
         start_time = time.time()
         too_old_to_use = []
 
+        # The base directories do not need the lock, and are loaded first so
+        # that their modules are preferred.
+        if self.base_dirnames and (self.base_pending is None or
+                                   self.base_pending):
+            self.load_base_dirs()
+
         compilelock.get_lock()
         try:
             # add entries that are not in the entry_from_key dictionary
             time_now = time.time()
-            # Go through directories in alphabetical order to ensure consistent
-            # behavior.
-            root_dirs_files = sorted(os.walk(self.dirname),
-                                     key=operator.itemgetter(0))
-            for root, dirs, files in root_dirs_files:
+            records = None
+            if not (rebuild_index or delete_if_problem):
+                records = self.read_index()
+            if records is None:
+                # Go through directories in alphabetical order to ensure
+                # consistent behavior.
+                root_dirs_files = [
+                        (root, files) for root, dirs, files in
+                        sorted(os.walk(self.dirname),
+                               key=operator.itemgetter(0))]
+            else:
+                # Directories that were not loaded in a previous call are
+                # tried again (e.g. some classes needed to unpickle their key
+                # may have been imported since then).
+                roots = self.index_pending + [root for root, _ in records]
+                root_dirs_files = [(root, os.listdir(root))
+                                   for root in roots if os.path.isdir(root)]
+            for root, files in root_dirs_files:
                 key_pkl = os.path.join(root, 'key.pkl')
                 if key_pkl in self.loaded_key_pkl:
                     continue
                 elif 'delete.me' in files or not files:
+                    # The directories where a module is being compiled are
+                    # not empty: they contain a 'compiling' file (see
+                    # dlimport_workdir).
                     _rmtree(root, ignore_nocleanup=True,
                             msg="delete.me found in dir")
                 elif 'key.pkl' in files:
@@ -785,11 +1146,25 @@ class ModuleCache(object):
 
             # Clean up the name space to prevent bug.
             if root_dirs_files:
-                del root, dirs, files
+                del root, files
+
+            # Remember the entries we could not load, to try again next time.
+            self.index_pending = [
+                    root for root, files in root_dirs_files
+                    if ('key.pkl' in files and
+                        os.path.join(root, 'key.pkl') not in
+                        self.loaded_key_pkl and
+                        os.path.exists(os.path.join(root, 'key.pkl')))]
 
             # Remove entries that are not in the filesystem.
-            items_copy = list(self.module_hash_to_key_data.iteritems())
+            if check_removed:
+                items_copy = list(self.module_hash_to_key_data.iteritems())
+            else:
+                items_copy = []
             for module_hash, key_data in items_copy:
+                if key_data.key_pkl in self.base_key_pkl:
+                    # Base directories are not supposed to change.
+                    continue
                 entry = key_data.get_entry()
                 try:
                     # Test to see that the file is [present and] readable.
@@ -830,11 +1205,15 @@ class ModuleCache(object):
                                     pkl_file_to_remove)
                         self.loaded_key_pkl.remove(pkl_file_to_remove)
 
+            if records is None:
+                self.write_index()
+
         finally:
             compilelock.release_lock()
 
         _logger.debug('Time needed to refresh cache: %s',
                 (time.time() - start_time))
+        record_compile_phase('ModuleCache.refresh', time.time() - start_time)
 
         return too_old_to_use
 
@@ -855,6 +1234,7 @@ class ModuleCache(object):
         """
         # We should only use one of the two ways to get a module.
         assert key_data is None or key is None
+        start_time = time.time()
         rval = None
         if key is not None:
             try:
@@ -874,18 +1254,32 @@ class ModuleCache(object):
                 _logger.debug('loading name %s', name)
                 self.module_from_name[name] = dlimport(name)
                 self.stats[1] += 1
+                phase = 'ModuleCache hit (loaded from disk)'
             else:
                 self.stats[0] += 1
+                phase = 'ModuleCache hit (already loaded)'
             _logger.debug('returning compiled module from cache %s', name)
             rval = self.module_from_name[name]
+            if key is not None:
+                # Lookups by key_data are part of a miss for another key.
+                record_compile_phase(phase, time.time() - start_time)
         else:
             hash_key = hash(key)
             key_data = None
             # We have never seen this key before.
             # Acquire lock before creating things in the compile cache,
             # to avoid that other processes remove the compile dir while it
-            # is still empty.
+            # is still empty. In the 'module' lock mode, the 'compiling' file
+            # created by dlimport_workdir protects it once the lock is
+            # released.
             compilelock.get_lock()
+            # In the 'module' lock mode, we release the global lock while
+            # compiling, and only hold the lock specific to this module. We
+            # cannot do it if the global lock was already held by the caller
+            # (in which case it is simply kept).
+            lock_per_module = (config.cmodule.lock_mode == 'module' and
+                               compilelock.get_lock.n_lock == 1)
+            module_lock = None
             # This try/finally block ensures that the lock is released once we
             # are done writing in the cache file or after raising an exception.
             try:
@@ -909,6 +1303,18 @@ class ModuleCache(object):
                     # The first compilation step is to yield the source code.
                     src_code = compile_steps.next()
                     module_hash = get_module_hash(src_code, key)
+                    if lock_per_module:
+                        # Do not hold the global lock while waiting for
+                        # another process compiling the same module.
+                        compilelock.release_lock()
+                        try:
+                            module_lock = compilelock.get_module_lock(
+                                    module_hash)
+                        finally:
+                            compilelock.get_lock()
+                        # That other process may have added the module to
+                        # the cache by now.
+                        self.refresh(check_removed=False)
                     if module_hash in self.module_hash_to_key_data:
                         _logger.debug("Duplicated module! Will re-use the "
                                 "previous one")
@@ -925,7 +1331,13 @@ class ModuleCache(object):
                         # same module. We only save the KeyData object of
                         # versioned modules.
                         try:
-                            key_data.add_key(key, save_pkl=bool(_version))
+                            # The key may have been added by another process.
+                            # Modules from a base directory are only
+                            # associated to the key in memory.
+                            if key not in key_data.keys:
+                                key_data.add_key(key, save_pkl=(
+                                        bool(_version) and key_data.key_pkl
+                                        not in self.base_key_pkl))
                             key_broken = False
                         except cPickle.PicklingError:
                             # This should only happen if we tried to save the
@@ -937,7 +1349,8 @@ class ModuleCache(object):
                             key_broken = True
 
                         if (_version and not key_broken and
-                            self.check_for_broken_eq):
+                            self.check_for_broken_eq and
+                            key_data.key_pkl not in self.base_key_pkl):
                             self.check_key(key, key_data.key_pkl)
 
                         # We can delete the work directory.
@@ -948,14 +1361,21 @@ class ModuleCache(object):
                         # Will fail if there is an error compiling the C code.
                         # The exception will be caught and the work dir will be
                         # deleted.
-                        while True:
-                            try:
-                                # The module should be returned by the last
-                                # step of the compilation.
-                                module = compile_steps.next()
-                            except StopIteration:
-                                break
-
+                        if lock_per_module:
+                            compilelock.release_lock()
+                        try:
+                            while True:
+                                try:
+                                    # The module should be returned by the last
+                                    # step of the compilation.
+                                    module = compile_steps.next()
+                                except StopIteration:
+                                    break
+                        finally:
+                            if lock_per_module:
+                                compilelock.get_lock()
+
+                        unmark_workdir(location)
                         # Obtain path to the '.so' module file.
                         name = module.__file__
 
@@ -1002,6 +1422,7 @@ class ModuleCache(object):
                             # Adding the KeyData file to this set means it is a
                             # versioned module.
                             self.loaded_key_pkl.add(key_pkl)
+                            self.append_to_index(location, module_hash)
                         elif config.cmodule.warn_no_version:
                             key_flat = flatten(key)
                             ops = [k for k in key_flat
@@ -1029,6 +1450,8 @@ class ModuleCache(object):
                     raise
 
             finally:
+                if module_lock is not None:
+                    module_lock.unlock()
                 # Release lock if needed.
                 if not keep_lock:
                     compilelock.release_lock()
@@ -1062,6 +1485,7 @@ class ModuleCache(object):
 
             self.stats[2] += 1
             rval = module
+            record_compile_phase('ModuleCache miss', time.time() - start_time)
         #_logger.debug('stats %s %i', self.stats, sum(self.stats))
         return rval
 
@@ -1161,6 +1585,132 @@ class ModuleCache(object):
                 _rmtree(parent, msg='old cache directory', level=logging.INFO,
                         ignore_nocleanup=True)
 
+            if too_old_to_use:
+                # Remove the deleted directories from the index.
+                self.write_index()
+
+        finally:
+            compilelock.release_lock()
+
+    def entry_sizes(self):
+        """
+        Return a list of pairs (entry, size) for all versioned modules known
+        to this cache, except those of the base directories.
+
+        The size is the disk space (in bytes) used by the module's directory.
+        A file with several hard links (e.g. a library shared by the modules
+        compiled in the same batch) counts for a fraction of its size in
+        each directory.
+        """
+        rval = []
+        for key_data in self.module_hash_to_key_data.itervalues():
+            if not (key_data.keys and list(key_data.keys)[0][0]):
+                # Unversioned modules are deleted at exit.
+                continue
+            if key_data.key_pkl in self.base_key_pkl:
+                # Modules of the base directories are not ours.
+                continue
+            entry = key_data.get_entry()
+            parent = os.path.dirname(entry)
+            size = 0
+            try:
+                for filename in os.listdir(parent):
+                    st = os.stat(os.path.join(parent, filename))
+                    size += st.st_size / max(st.st_nlink, 1)
+            except OSError:
+                # The module was deleted by another process.
+                continue
+            rval.append((entry, size))
+        return rval
+
+    def clear_lru(self, max_size=None):
+        """
+        Delete the least recently used versioned modules until their total
+        size is below `max_size`.
+
+        Modules loaded by this process are never deleted. The last access
+        time of a module is the one of its dynamic library (see
+        `last_access_time`).
+
+        :param max_size: Maximum size in bytes. Defaults to
+        `config.cmodule.max_cache_size` megabytes. 0 means no limit.
+
+        :returns: the number of deleted modules.
+        """
+        if max_size is None:
+            max_size = config.cmodule.max_cache_size * 1024 * 1024
+        if max_size <= 0:
+            return 0
+        n_deleted = 0
+        compilelock.get_lock()
+        try:
+            # Account for the modules added by other processes.
+            self.refresh()
+            entry_sizes = self.entry_sizes()
+            total_size = sum(size for entry, size in entry_sizes)
+            if total_size <= max_size:
+                return 0
+            entry_times = []
+            for entry, size in entry_sizes:
+                if entry in self.module_from_name:
+                    continue
+                try:
+                    entry_times.append((last_access_time(entry), entry, size))
+                except OSError:
+                    continue
+            entry_times.sort()
+            to_delete = set()
+            for _, entry, size in entry_times:
+                if total_size <= max_size:
+                    break
+                to_delete.add(entry)
+                total_size -= size
+            for module_hash, key_data in self.module_hash_to_key_data.items():
+                entry = key_data.get_entry()
+                if entry not in to_delete:
+                    continue
+                key_data.delete_keys_from(self.entry_from_key)
+                del self.module_hash_to_key_data[module_hash]
+                self.loaded_key_pkl.discard(key_data.key_pkl)
+                _rmtree(os.path.dirname(entry), msg='least recently used',
+                        level=logging.INFO, ignore_nocleanup=True)
+                n_deleted += 1
+            if n_deleted:
+                self.write_index()
+        finally:
+            compilelock.release_lock()
+        return n_deleted
+
+    def read_stats(self):
+        """
+        Return the counters of hits, loads and compilations issued by
+        `module_from_key`, summed over all processes that used this cache
+        (see `save_stats`).
+        """
+        try:
+            stats = map(int, open(self.stats_file).read().split())
+            if len(stats) == 3:
+                return stats
+        except (IOError, ValueError):
+            pass
+        return [0, 0, 0]
+
+    def save_stats(self):
+        """
+        Add the counters of this process (`self.stats`) to the ones saved in
+        the cache directory, and reset them.
+        """
+        if not any(self.stats):
+            return
+        compilelock.get_lock()
+        try:
+            stats = [a + b for a, b in zip(self.read_stats(), self.stats)]
+            tmp_file = '%s.%s.tmp' % (self.stats_file, os.getpid())
+            open(tmp_file, 'w').write('%s %s %s\n' % tuple(stats))
+            if sys.platform == 'win32' and os.path.exists(self.stats_file):
+                os.remove(self.stats_file)
+            os.rename(tmp_file, self.stats_file)
+            self.stats = [0, 0, 0]
         finally:
             compilelock.release_lock()
 
@@ -1193,8 +1743,9 @@ class ModuleCache(object):
 
     def clear_base_files(self):
         """
-        Remove base directories 'cuda_ndarray', 'cutils_ext', 'lazylinker_ext'
-        and 'scan_perform' if present.
+        Remove base directories 'cuda_ndarray', 'cutils_ext', 'lazylinker_ext',
+        'scan_perform', 'optimized_graphs' and 'precompiled_headers' if
+        present.
 
         Note that we do not delete them outright because it may not work on
         some systems due to these modules being currently in use. Instead we
@@ -1204,7 +1755,8 @@ class ModuleCache(object):
         compilelock.get_lock()
         try:
             for base_dir in ('cuda_ndarray', 'cutils_ext', 'lazylinker_ext',
-                    'scan_perform'):
+                    'scan_perform', 'optimized_graphs',
+                    'precompiled_headers'):
                 to_delete = os.path.join(self.dirname, base_dir + '.delete.me')
                 if os.path.isdir(to_delete):
                     try:
@@ -1320,6 +1872,8 @@ class ModuleCache(object):
         try:
             self.clear_old()
             self.clear_unversioned()
+            self.clear_lru()
+            self.save_stats()
         finally:
             compilelock.release_lock()
         _logger.debug('Time spent checking keys: %s',
@@ -1437,6 +1991,112 @@ def gcc_version():
     return gcc_version_str
 
 
+# Precompiled header of each set of compilation flags, as returned by
+# `gcc_precompiled_header`, for this process.
+_precompiled_headers = {}
+_precompiled_headers_lock = threading.Lock()
+# Time (in seconds) after which the precompilation of a header that g++
+# failed to compile is tried again.
+_precompiled_header_retry_delay = 24 * 3600
+
+
+def gcc_precompiled_header(cxxflags):
+    """
+    Return the path of a header including the headers included first by
+    all DynamicModules, precompiled by g++ with the flags `cxxflags`.
+
+    The precompiled header is stored in the 'precompiled_headers'
+    subdirectory of the compiledir, and built if it is not there yet. It is
+    identified by the version of g++ and `cxxflags`, which must be the flags
+    used to compile the modules (g++ ignores precompiled headers built with
+    incompatible flags).
+
+    Returns None if the header cannot be precompiled. When g++ fails to
+    compile it, a '.failed' file is left next to it, and no process tries
+    again with the same flags for `_precompiled_header_retry_delay`
+    seconds (or until that file is removed).
+    """
+    digest = hash_from_code('\n'.join([GCC_compiler.version_str()] +
+                                       list(cxxflags)))
+    _precompiled_headers_lock.acquire()
+    try:
+        if digest not in _precompiled_headers:
+            header_dir = os.path.join(config.compiledir,
+                                      'precompiled_headers')
+            header = os.path.join(header_dir, digest + '.h')
+            failed = os.path.join(header_dir, digest + '.failed')
+            if not os.path.exists(header + '.gch'):
+                try:
+                    failed_age = time.time() - os.path.getmtime(failed)
+                except OSError:
+                    failed_age = None
+                if (failed_age is not None and
+                        failed_age < _precompiled_header_retry_delay):
+                    header = None
+                else:
+                    header = _build_precompiled_header(header, cxxflags)
+            _precompiled_headers[digest] = header
+        return _precompiled_headers[digest]
+    finally:
+        _precompiled_headers_lock.release()
+
+
+def _build_precompiled_header(header, cxxflags):
+    """
+    Build the precompiled `header` for `gcc_precompiled_header`, and return
+    its path (or None if it cannot be built).
+
+    The files are built in a temporary directory, then moved in place, so
+    that other processes never see them partially written.
+    """
+    header_dir = os.path.dirname(header)
+    if not os.path.isdir(header_dir):
+        try:
+            os.makedirs(header_dir)
+        except OSError:
+            # Another process may have created it.
+            assert os.path.isdir(header_dir)
+    tmp_dir = tempfile.mkdtemp(dir=header_dir)
+    try:
+        tmp_header = os.path.join(tmp_dir, os.path.basename(header))
+        sio = StringIO.StringIO()
+        # Only the headers included first by all modules, in the same
+        # order: later includes may depend on what modules define before.
+        DynamicModule('theano_pch').print_includes(sio)
+        f = open(tmp_header, 'w')
+        try:
+            f.write(sio.getvalue())
+        finally:
+            f.close()
+        cmd = (['g++', '-x', 'c++-header'] + list(cxxflags) +
+               ['-o', tmp_header + '.gch', tmp_header])
+        _logger.debug('Precompiling header: %s', ' '.join(cmd))
+        try:
+            p = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+            compile_stderr = p.communicate()[1]
+            status = p.returncode
+        except OSError, e:
+            status, compile_stderr = None, str(e)
+        if status != 0:
+            _logger.warning('Could not precompile the module headers, they '
+                            'will be compiled with each module: %s',
+                            compile_stderr)
+            if status is not None and status > 0:
+                # g++ reported an error: do not try again with these flags
+                # for some time. The other failures (g++ not found or
+                # killed) may be transient, so the next process will try
+                # again.
+                f = open(header[:-len('.h')] + '.failed', 'w')
+                f.close()
+            return None
+        # The header must be in place before its precompiled version.
+        os.rename(tmp_header, header)
+        os.rename(tmp_header + '.gch', header + '.gch')
+        return header
+    finally:
+        _rmtree(tmp_dir, ignore_nocleanup=True)
+
+
 class GCC_compiler(object):
     @staticmethod
     def version_str():
@@ -1450,7 +2110,7 @@ class GCC_compiler(object):
     @staticmethod
     def compile_str(module_name, src_code, location=None,
                     include_dirs=None, lib_dirs=None, libs=None,
-                    preargs=None):
+                    preargs=None, py_module=True):
         """
         :param module_name: string (this has been embedded in the src_code
 
@@ -1470,7 +2130,12 @@ class GCC_compiler(object):
 
         :param preargs: a list of extra compiler arguments
 
-        :returns: dynamically-imported python module of the compiled code.
+        :param py_module: if False, the compiled library is not imported and
+        its path is returned instead. This is used to compile several modules
+        concurrently, leaving the import to the calling thread.
+
+        :returns: dynamically-imported python module of the compiled code
+        (or the path to the compiled library if `py_module` is False).
         """
         #TODO: Do not do the dlimport in this function
 
@@ -1543,13 +2208,18 @@ class GCC_compiler(object):
                 (module_name, get_lib_extension()))
 
         _logger.debug('Generating shared lib %s', lib_filename)
-        cmd = ['g++', get_gcc_shared_library_arg(), '-g']
+        cxxflags = [get_gcc_shared_library_arg(), '-g']
 
         if config.cmodule.remove_gxx_opt:
-            cmd.extend(p for p in preargs if not p.startswith('-O'))
+            cxxflags.extend(p for p in preargs if not p.startswith('-O'))
         else:
-            cmd.extend(preargs)
-        cmd.extend('-I%s' % idir for idir in include_dirs)
+            cxxflags.extend(preargs)
+        cxxflags.extend('-I%s' % idir for idir in include_dirs)
+        cmd = ['g++'] + cxxflags
+        if config.cmodule.precompiled_headers:
+            header = gcc_precompiled_header(cxxflags)
+            if header is not None:
+                cmd.extend(['-include', header])
         cmd.extend(['-o', lib_filename])
         cmd.append(cppfilename)
         cmd.extend(['-L%s' % ldir for ldir in lib_dirs])
@@ -1564,6 +2234,7 @@ class GCC_compiler(object):
                     "command line below:")
             print >> sys.stderr, ' '.join(cmd)
 
+        t0 = time.time()
         try:
             p = subprocess.Popen(cmd, stderr=subprocess.PIPE)
             compile_stderr = p.communicate()[1]
@@ -1571,6 +2242,7 @@ class GCC_compiler(object):
             # An exception can occur e.g. if `g++` is not found.
             print_command_line_error()
             raise
+        record_compile_phase('g++', time.time() - t0)
 
         status = p.returncode
 
@@ -1594,8 +2266,65 @@ class GCC_compiler(object):
 
         #touch the __init__ file
         file(os.path.join(location, "__init__.py"), 'w').close()
+        if not py_module:
+            return lib_filename
         return dlimport(lib_filename)
 
 
+def parallel_compile_str(compile_str, jobs, n_jobs=None):
+    """
+    Call `compile_str` on several modules, running up to `n_jobs`
+    compilations at the same time.
+
+    The compiler runs in a separate process, so we only need threads to
+    wait for it: the compiled libraries are not imported here, as the
+    import machinery and the module cache must be used from the calling
+    thread only.
+
+    :param compile_str: the compiler's `compile_str` function. It is called
+    with `py_module=False`.
+
+    :param jobs: a list of dictionaries of keyword arguments, one for each
+    module to compile.
+
+    :param n_jobs: the maximum number of concurrent compilations. Defaults
+    to `compile_jobs()`.
+
+    :returns: a list with one element per job, in the same order as `jobs`.
+    Each element is either the path to the compiled library, or the
+    exception raised while compiling it.
+    """
+    if n_jobs is None:
+        n_jobs = compile_jobs()
+    results = [None] * len(jobs)
+    # Iterating on a shared iterator is protected by this lock, so that
+    # every job is compiled exactly once.
+    next_job = iter(enumerate(jobs)).next
+    job_lock = threading.Lock()
+
+    def worker():
+        while True:
+            job_lock.acquire()
+            try:
+                try:
+                    idx, kwargs = next_job()
+                except StopIteration:
+                    return
+            finally:
+                job_lock.release()
+            try:
+                results[idx] = compile_str(py_module=False, **kwargs)
+            except Exception, e:
+                results[idx] = e
+
+    workers = [threading.Thread(target=worker)
+               for i in xrange(min(n_jobs, len(jobs)))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
+
+
 def icc_module_compile_str(*args):
     raise NotImplementedError()
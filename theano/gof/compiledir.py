@@ -1,5 +1,7 @@
 import cPickle
 import errno
+import imp
+import logging
 import os
 import platform
 import re
@@ -14,6 +16,8 @@ import theano
 from theano.configparser import config, AddConfigVar, ConfigParam, StrParam
 from theano.gof.utils import flatten
 
+_logger = logging.getLogger('theano.gof.compiledir')
+
 # Using the dummy file descriptors below is a workaround for a crash
 # experienced in an unusual Python 2.4.4 Windows environment with the default
 # None values.
@@ -262,3 +266,184 @@ def print_compiledir_content():
            " 1 op (was compiled with the C linker)" % more_than_one_ops)
     print ("Skipped %d files that contained 0 op "
            "(are they always theano.scalar ops?)" % zeros_op)
+
+
+def print_compiledir_stats(n_largest=10):
+    """
+    Print the number and size of the modules in the compiledir, the
+    counters of the module cache and the largest modules.
+    """
+    cache = theano.gof.cc.get_module_cache()
+    compiledir = cache.dirname
+    entry_sizes = cache.entry_sizes()
+    modules_size = sum(size for entry, size in entry_sizes)
+    total_size = 0
+    for root, dirs, files in os.walk(compiledir):
+        for filename in files:
+            try:
+                st = os.stat(os.path.join(root, filename))
+            except OSError:
+                continue
+            total_size += st.st_size / max(st.st_nlink, 1)
+    mb = 1024. * 1024.
+
+    print "Cache directory:", compiledir
+    print "Total size: %.1f MB" % (total_size / mb)
+    if config.cmodule.max_cache_size:
+        limit = '%d MB' % config.cmodule.max_cache_size
+    else:
+        limit = 'no limit'
+    print "%d versioned modules: %.1f MB (%s)" % (
+        len(entry_sizes), modules_size / mb, limit)
+    hits, loads, compiles = cache.read_stats()
+    print ("Module cache requests: %d hits (%d loaded from disk), "
+           "%d misses (compiled)" % (hits + loads, loads, compiles))
+    if hits + loads + compiles:
+        print "Hit rate: %.1f%%" % (
+            100. * (hits + loads) / (hits + loads + compiles))
+
+    if entry_sizes:
+        print
+        print "Largest modules:"
+        print "size (MB)/sub directory/Ops"
+        key_data_from_entry = dict(
+            (key_data.get_entry(), key_data)
+            for key_data in cache.module_hash_to_key_data.itervalues())
+        entry_sizes.sort(key=lambda t: t[1], reverse=True)
+        for entry, size in entry_sizes[:n_largest]:
+            ops = []
+            for obj in flatten(list(key_data_from_entry[entry].keys)[:1]):
+                if isinstance(obj, theano.gof.Op) and str(obj) not in ops:
+                    ops.append(str(obj))
+            print "%9.2f %s %s" % (
+                size / mb, os.path.basename(os.path.dirname(entry)),
+                ', '.join(ops))
+
+
+def _load_pickled_graphs(path):
+    pkl_file = open(path, 'rb')
+    try:
+        graphs = cPickle.load(pkl_file)
+    finally:
+        pkl_file.close()
+    if isinstance(graphs, (tuple, dict, theano.compile.Function)):
+        graphs = [graphs]
+    return list(graphs)
+
+
+def warm_cache_builders(manifests):
+    """
+    Return the graphs listed in `manifests`, as a list of pairs (name,
+    builder), where `builder` is a callable returning the graph.
+
+    A graph is either a pair (inputs, outputs), or a dictionary of keyword
+    arguments for `theano.function`. Each manifest is one of:
+        - A pickled file (ending in '.pkl') with a graph or a list of graphs.
+          The file may also contain compiled functions, that were compiled
+          when unpickled.
+        - A Python file (ending in '.py') or the name of a Python module,
+          which defines `theano_graphs`: a list of callables that take no
+          argument and return a graph.
+        - A text file listing other manifests, one per line. Empty lines and
+          lines starting with '#' are ignored, and relative paths are
+          relative to the directory of the text file.
+    """
+    rval = []
+    for manifest in manifests:
+        if manifest.endswith('.pkl'):
+            for i, graph in enumerate(_load_pickled_graphs(manifest)):
+                rval.append(('%s[%i]' % (manifest, i),
+                             lambda graph=graph: graph))
+            continue
+        elif manifest.endswith('.py'):
+            name = os.path.splitext(os.path.basename(manifest))[0]
+            module = imp.load_source('theano_cache_warm_%s' % name, manifest)
+        elif os.path.isfile(manifest):
+            dirname = os.path.dirname(manifest)
+            lines = [line.strip() for line in open(manifest)]
+            rval.extend(warm_cache_builders([
+                os.path.join(dirname, line) for line in lines
+                if line and not line.startswith('#')]))
+            continue
+        else:
+            module = __import__(manifest, {}, {}, ['theano_graphs'])
+        if not hasattr(module, 'theano_graphs'):
+            raise ValueError('Module %s does not define `theano_graphs`' %
+                             manifest)
+        for i, builder in enumerate(module.theano_graphs):
+            rval.append(('%s.%s' % (manifest,
+                                    getattr(builder, '__name__', i)),
+                         builder))
+    return rval
+
+
+def warm_graph(graph):
+    """
+    Optimize and compile `graph` (see `warm_cache_builders`).
+    """
+    if isinstance(graph, theano.compile.Function):
+        # It was compiled when unpickled.
+        return
+    if isinstance(graph, dict):
+        theano.function(**graph)
+    else:
+        inputs, outputs = graph
+        theano.function(inputs, outputs)
+
+
+def warm_cache(manifests, n_jobs=None, worker=None):
+    """
+    Optimize and compile the graphs listed in `manifests` (see
+    `warm_cache_builders`), so that the C modules they need are in the
+    module cache.
+
+    :param n_jobs: Number of processes compiling the graphs concurrently.
+    Each of them only uses one compilation job. Defaults to
+    `theano.gof.cmodule.compile_jobs()`.
+
+    :param worker: If not None, only compile the graphs with an index equal
+    to `worker` modulo `n_jobs`. This is used by the processes started when
+    `n_jobs` is more than 1.
+
+    :returns: the number of graphs that failed to compile.
+    """
+    builders = warm_cache_builders(manifests)
+    if n_jobs is None:
+        n_jobs = theano.gof.cmodule.compile_jobs()
+    n_jobs = max(min(n_jobs, len(builders)), 1)
+    if worker is None and n_jobs > 1:
+        # Optimization is mostly done in Python, so we use processes rather
+        # than threads. They lock modules independently of each other.
+        flags = ['cmodule.compile_jobs=1', 'cmodule.lock_mode=module']
+        if os.environ.get('THEANO_FLAGS'):
+            flags.insert(0, os.environ['THEANO_FLAGS'])
+        env = dict(os.environ)
+        env['THEANO_FLAGS'] = ','.join(flags)
+        code = ('import sys, theano.gof.compiledir as c; '
+                'sys.exit(min(c.warm_cache(sys.argv[3:], '
+                'int(sys.argv[1]), int(sys.argv[2])), 255))')
+        processes = [
+            subprocess.Popen([sys.executable, '-c', code, str(n_jobs),
+                              str(i)] + list(manifests), env=env)
+            for i in range(n_jobs)]
+        n_failed = 0
+        for p in processes:
+            returncode = p.wait()
+            if returncode < 0:
+                # Killed by a signal.
+                returncode = 1
+            n_failed += returncode
+        return n_failed
+
+    n_failed = 0
+    for i, (name, builder) in enumerate(builders):
+        if worker is not None and i % n_jobs != worker:
+            continue
+        try:
+            warm_graph(builder())
+        except Exception:
+            _logger.error('Failed to compile graph %s', name, exc_info=True)
+            n_failed += 1
+        else:
+            _logger.info('Compiled graph %s', name)
+    return n_failed
@@ -3,6 +3,7 @@
 
 from theano import config
 import compiledir
+from utils import record_compile_phase
 import os, random, time, atexit
 import socket # only used for gethostname()
 import logging
@@ -67,7 +68,9 @@ def get_lock(lock_dir=None, **kw):
     if get_lock.lock_is_enabled:
         # Only really try to acquire the lock if we do not have it already.
         if get_lock.n_lock == 0:
+            t0 = time.time()
             lock(get_lock.lock_dir, timeout=timeout_before_override, **kw)
+            record_compile_phase('lock wait', time.time() - t0)
             atexit.register(Unlocker.unlock, get_lock.unlocker)
             # Store time at which the lock was set.
             get_lock.start_time = time.time()
@@ -83,6 +86,32 @@ def get_lock(lock_dir=None, **kw):
                 get_lock.start_time = now
     get_lock.n_lock += 1
 
+def get_module_lock(module_hash, **kw):
+    """
+    Obtain the lock specific to the compilation of a given module.
+
+    This lock is used when `config.cmodule.lock_mode` is 'module': processes
+    compiling different modules do not wait for each other, but those that
+    need the exact same module wait for the first one to compile it.
+    Contrary to `get_lock`, this lock is not re-entrant.
+
+    :param module_hash: hash identifying the module (see
+    `cmodule.get_module_hash`).
+
+    :param kw: Additional arguments to be forwarded to the `lock` function when
+    acquiring the lock.
+
+    :returns: an `ExplicitUnlocker` whose `unlock` method releases the lock,
+    or None if locking was disabled through `set_lock_status`.
+    """
+    if not getattr(get_lock, 'lock_is_enabled', True):
+        return None
+    lock_dir = os.path.join(config.compiledir, 'lock_dir_%s' % module_hash)
+    t0 = time.time()
+    lock(lock_dir, timeout=timeout_before_override, **kw)
+    record_compile_phase('module lock wait', time.time() - t0)
+    return ExplicitUnlocker(lock_dir)
+
 def release_lock():
     """
     Release lock on compilation directory.
@@ -186,7 +215,7 @@ def lock(tmp_dir, timeout=120, min_wait=5, max_wait=10, verbosity=1):
                         msg = "process '%s'" % read_owner.split('_')[0]
                         _logger.warning("Overriding existing lock by dead %s "
                                 "(I am process '%s')", msg, my_pid)
-                    get_lock.unlocker.unlock()
+                    ExplicitUnlocker(tmp_dir).unlock()
                     continue
                 if last_owner == read_owner:
                     if (timeout is not None and
@@ -199,7 +228,7 @@ def lock(tmp_dir, timeout=120, min_wait=5, max_wait=10, verbosity=1):
                                 msg = "process '%s'" % read_owner.split('_')[0]
                             _logger.warning("Overriding existing lock by %s "
                                     "(I am process '%s')", msg, my_pid)
-                        get_lock.unlocker.unlock()
+                        ExplicitUnlocker(tmp_dir).unlock()
                         continue
                 else:
                     last_owner = read_owner
@@ -296,3 +325,15 @@ class Unlocker(object):
             self.os.rmdir(self.tmp_dir)
         except Exception:
             pass
+
+
+class ExplicitUnlocker(Unlocker):
+    """
+    Unlocker that only releases the lock when `unlock` is called.
+
+    Contrary to `Unlocker`, the lock is not released when this object is
+    garbage collected, since another process may own it by then.
+    """
+
+    def __del__(self):
+        pass
@@ -8,7 +8,7 @@ if sys.version_info[:2] >= (2,5):
 import theano
 import toolbox
 import graph
-from theano.gof.python25 import deque
+from theano.gof.python25 import any, deque
 
 from fg import InconsistencyError
 
@@ -238,45 +238,201 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         self.view_o = {}  # variable -> set of variables that use this one as a direct input
         #clients: how many times does an apply use a given variable
         self.clients = {} # variable -> apply -> ninputs
-        self.stale_droot = True
+
+        # droot, impact and root_destroyer are updated incrementally: only
+        # the roots in dirty_roots, and the destroyers in new_destroyers,
+        # are looked at again. dirty_roots is None when everything must be
+        # recomputed.
+        self.droot = {}
+        self.impact = {}
+        self.root_destroyer = {}
+        self.dirty_roots = None
+        self.new_destroyers = set()
+        # destroyer -> set of the Apply instances that must be computed
+        # before it, and the reverse mapping.
+        self.ords = {}
+        self.ords_successors = {}
+        # To check for cycles, validate() only looks at the orderings of the
+        # destroyers in `unchecked` and at the nodes that fgraph.topo_order
+        # moved since the last check (see _check_cycles).
+        self.unchecked = set()
+        self.checked_version = None
+        self.checked_moves = 0
 
         self.debug_all_apps = set()
         if self.do_imports_on_attach:
             toolbox.Bookkeeper.on_attach(self, fgraph)
 
     def refresh_droot_impact(self):
-        if self.stale_droot:
-            self.droot, self.impact, self.root_destroyer = self._build_droot_impact()
-            self.stale_droot = False
+        self._update()
         return self.droot, self.impact, self.root_destroyer
 
-    def _build_droot_impact(self):
-        droot = {}   # destroyed view + nonview variables -> foundation
-        impact = {}  # destroyed nonview variable -> it + all views of it
-        root_destroyer = {} # root -> destroyer apply
+    def _mark(self, r):
+        """Mark the root of `r` as changed, if some Apply destroys it."""
+        if self.dirty_roots is not None:
+            root = getroot(r, self.view_i)
+            if root in self.impact:
+                self.dirty_roots.add(root)
+
+    def _set_ords(self, app, prereqs):
+        """Set the Apply instances that must be computed before `app`."""
+        for p in self.ords.pop(app, ()):
+            successors = self.ords_successors[p]
+            successors.remove(app)
+            if not successors:
+                del self.ords_successors[p]
+        if prereqs:
+            self.ords[app] = prereqs
+            for p in prereqs:
+                self.ords_successors.setdefault(p, set()).add(app)
+            self.unchecked.add(app)
+
+    def _update(self):
+        """
+        Update droot, impact, root_destroyer and the orderings for the
+        changes of the graph since the last call.
 
-        for app in self.destroyers:
-            for output_idx, input_idx_list in app.op.destroy_map.items():
-                if len(input_idx_list) != 1:
-                    raise NotImplementedError()
-                input_idx = input_idx_list[0]
-                input = app.inputs[input_idx]
-                input_root = getroot(input, self.view_i)
-                if input_root in droot:
-                    raise InconsistencyError("Multiple destroyers of %s" % input_root)
-                droot[input_root] = input_root
-                root_destroyer[input_root] = app
-                #input_impact = set([input_root])
-                #add_impact(input_root, self.view_o, input_impact)
-                input_impact = get_impact(input_root, self.view_o)
-                for v in input_impact:
-                    assert v not in droot
-                    droot[v] = input_root
-
-                impact[input_root] = input_impact
-                impact[input_root].add(input_root)
-
-        return droot, impact, root_destroyer
+        Only the destroyers of the roots that were touched by the changes,
+        and the new destroyers, are considered again.
+
+        Raise InconsistencyError when
+        a) attempting to destroy indestructable variable, or
+        b) attempting to destroy a value multiple times, or
+        c) an Apply destroys (illegally) one of its own inputs by aliasing
+        """
+        try:
+            if self.dirty_roots is None:
+                self.droot = {}
+                self.impact = {}
+                self.root_destroyer = {}
+                for app in self.ords.keys():
+                    self._set_ords(app, None)
+                self.checked_version = None
+                todo = set(self.destroyers)
+            else:
+                if not self.dirty_roots and not self.new_destroyers:
+                    return
+                todo = set(self.new_destroyers)
+                for root in self.dirty_roots:
+                    for v in self.impact.pop(root):
+                        del self.droot[v]
+                    app = self.root_destroyer.pop(root)
+                    self._set_ords(app, None)
+                    todo.add(app)
+                # Some of them may have been pruned since.
+                todo &= self.destroyers
+            self.dirty_roots = set()
+            self.new_destroyers = set()
+
+            # CHECK for multiple destructions
+            new_roots = []
+            for app in todo:
+                for output_idx, input_idx_list in app.op.destroy_map.items():
+                    if len(input_idx_list) != 1:
+                        raise NotImplementedError()
+                    input_idx = input_idx_list[0]
+                    input = app.inputs[input_idx]
+                    input_root = getroot(input, self.view_i)
+                    if input_root in self.droot:
+                        raise InconsistencyError(
+                                "Multiple destroyers of %s" % input_root)
+                    input_impact = get_impact(input_root, self.view_o)
+                    for v in input_impact:
+                        assert v not in self.droot
+                        self.droot[v] = input_root
+                    self.droot[input_root] = input_root
+                    self.root_destroyer[input_root] = app
+                    input_impact.add(input_root)
+                    self.impact[input_root] = input_impact
+                    new_roots.append(input_root)
+
+            # check for destruction of constants
+            for root in new_roots:
+                illegal_destroy = [r for r in self.impact[root] if \
+                        getattr(r.tag, 'indestructible', False) or \
+                        isinstance(r, graph.Constant)]
+                if illegal_destroy:
+                    raise InconsistencyError(
+                            "Attempting to destroy indestructible variables:"
+                            " %s" % illegal_destroy)
+
+            for app in todo:
+                self._set_ords(app, self._destroyer_orderings(app))
+        except Exception:
+            # Start from scratch next time.
+            self.dirty_roots = None
+            raise
+
+    def _destroyer_orderings(self, app):
+        """
+        Return the set of Apply instances that must be computed before the
+        destroyer `app`.
+        """
+        droot, impact = self.droot, self.impact
+        rval = set()
+        # for each destroyed input...
+        for output_idx, input_idx_list in app.op.destroy_map.items():
+            destroyed_idx = input_idx_list[0]
+            destroyed_variable = app.inputs[destroyed_idx]
+            root = droot[destroyed_variable]
+            root_impact = impact[root]
+            # we generally want to put all clients of things which depend on root
+            # as pre-requisites of app.
+            # But, app is itself one such client!
+            # App will always be a client of the node we're destroying
+            # (destroyed_variable, but the tricky thing is when it is also a client of
+            # *another variable* viewing on the root.  Generally this is illegal, (e.g.,
+            # add_inplace(x, x.T).  In some special cases though, the in-place op will
+            # actually be able to work properly with multiple destroyed inputs (e.g,
+            # add_inplace(x, x).  An Op that can still work in this case should declare
+            # so via the 'destroyhandler_tolerate_same' attribute or
+            # 'destroyhandler_tolerate_aliased' attribute.
+            #
+            # destroyhandler_tolerate_same should be a list of pairs of the form
+            # [(idx0, idx1), (idx0, idx2), ...]
+            # The first element of each pair is the input index of a destroyed
+            # variable.
+            # The second element of each pair is the index of a different input where
+            # we will permit exactly the same variable to appear.
+            # For example, add_inplace.tolerate_same might be [(0,1)] if the destroyed
+            # input is also allowed to appear as the second argument.
+            #
+            # destroyhandler_tolerate_aliased is the same sort of list of
+            # pairs.
+            # op.destroyhandler_tolerate_aliased = [(idx0, idx1)] tells the
+            # destroyhandler to IGNORE an aliasing between a destroyed
+            # input idx0 and another input idx1.
+            # This is generally a bad idea, but it is safe in some
+            # cases, such as
+            # - the op reads from the aliased idx1 before modifying idx0
+            # - the idx0 and idx1 are guaranteed not to overlap (e.g.
+            #   they are pointed at different rows of a matrix).
+            #
+
+            #CHECK FOR INPUT ALIASING
+            # OPT: pre-compute this on import
+            tolerate_same = getattr(app.op, 'destroyhandler_tolerate_same', [])
+            tolerated = set(idx1 for idx0, idx1 in tolerate_same
+                    if idx0 == destroyed_idx)
+            tolerated.add(destroyed_idx)
+            tolerate_aliased = getattr(app.op, 'destroyhandler_tolerate_aliased', [])
+            ignored = set(idx1 for idx0, idx1 in tolerate_aliased
+                    if idx0 == destroyed_idx)
+            for i, input in enumerate(app.inputs):
+                if i in ignored:
+                    continue
+                if input in root_impact \
+                        and (i not in tolerated or input is not destroyed_variable):
+                    raise InconsistencyError("Input aliasing: %s (%i, %i)"
+                            % (app, destroyed_idx, i))
+
+            # add the rule: app must be preceded by all other Apply instances that
+            # depend on destroyed_input
+            for r in root_impact:
+                assert not [a for a,c in self.clients[r].items() if not c]
+                rval.update([a for a,c in self.clients[r].items() if c])
+        rval.discard(app)
+        return rval
 
     def on_detach(self, fgraph):
         if fgraph is not self.fgraph:
@@ -285,7 +441,11 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         del self.view_i
         del self.view_o
         del self.clients
-        del self.stale_droot
+        del self.droot
+        del self.impact
+        del self.root_destroyer
+        del self.ords
+        del self.ords_successors
         assert self.fgraph.destroyer_handler is self
         delattr(self.fgraph, 'destroyers')
         delattr(self.fgraph, 'destroy_handler')
@@ -298,9 +458,13 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         self.debug_all_apps.add(app)
         #print 'DH IMPORT', app, id(app), id(self), len(self.debug_all_apps)
 
+        for input in app.inputs:
+            self._mark(input)
+
         # If it's a destructive op, add it to our watch list
         if getattr(app.op, 'destroy_map', {}):
             self.destroyers.add(app)
+            self.new_destroyers.add(app)
 
         # add this symbol to the forward and backward maps
         for o_idx, i_idx_list in getattr(app.op, 'view_map', {}).items():
@@ -319,19 +483,21 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         for i, output in enumerate(app.outputs):
             self.clients.setdefault(output, {})
 
-        self.stale_droot = True
-
     def on_prune(self, fgraph, app):
         """Remove Apply instance from set which must be computed"""
         if app not in self.debug_all_apps: raise ProtocolError("prune without import")
         self.debug_all_apps.remove(app)
 
+        for input in app.inputs:
+            self._mark(input)
+
         #UPDATE self.clients
         for i, input in enumerate(set(app.inputs)):
             del self.clients[input][app]
 
         if getattr(app.op, 'destroy_map', {}):
             self.destroyers.remove(app)
+            self.new_destroyers.discard(app)
 
         # Note: leaving empty client dictionaries in the struct.
         # Why? It's a pain to remove them. I think they aren't doing any harm, they will be
@@ -351,8 +517,6 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
             if not self.view_o[i]:
                 del self.view_o[i]
 
-        self.stale_droot = True
-
     def on_change_input(self, fgraph, app, i, old_r, new_r):
         """app.inputs[i] changed from old_r to new_r """
         if app == 'output':
@@ -362,6 +526,10 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         else:
             if app not in self.debug_all_apps: raise ProtocolError("change without import")
 
+            # The outputs of app that view old_r now view new_r.
+            self._mark(old_r)
+            self._mark(new_r)
+
             #UPDATE self.clients
             self.clients[old_r][app] -= 1
             if self.clients[old_r][app] == 0:
@@ -389,8 +557,6 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
 
                     self.view_o.setdefault(new_r,set()).add(output)
 
-        self.stale_droot = True
-
     def validate(self, fgraph):
         """Return None
 
@@ -399,30 +565,63 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         b) orderings cannot be topologically sorted.
 
         """
-        #print '\nVALIDATE'
         if self.destroyers:
+            self._update()
             try:
-                ords = self.orderings(fgraph)
-            except Exception, e:
-                #print 'orderings failed with:', type(e), e.args
-                raise
-            #print 'orderings:', ords
-            try:
-                ### graph.io_toposort(fgraph.inputs, fgraph.outputs, ords)
-                _dfs_toposort(fgraph.inputs, fgraph.outputs, ords)
+                topo_order = getattr(fgraph, 'topo_order', None)
+                if topo_order is None:
+                    _dfs_toposort(fgraph.inputs, fgraph.outputs, self.ords)
+                else:
+                    self._check_cycles(fgraph, topo_order)
             except ValueError, e:
-                #print 'not passing.', ords
                 if 'cycles' in str(e):
                     raise InconsistencyError("Dependency graph contains cycles")
                 else:
                     raise
-            #print 'passing...', ords
         else:
             #James's Conjecture:
             #If there are no destructive ops, then there can be no cycles.
             pass
         return True
 
+    def _check_cycles(self, fgraph, topo_order):
+        """
+        Raise ValueError if the graph, with the orderings, contains cycles.
+
+        If the positions maintained by `topo_order` (a toolbox.TopoOrder)
+        satisfy the orderings, there is no cycle. An ordering that was
+        satisfied at the last check can only become unsatisfied if one of
+        its nodes was moved, so only the orderings that changed and those of
+        the moved nodes are checked. If one of them is not satisfied, the
+        whole graph is sorted again.
+        """
+        checked_version = self.checked_version
+        self.checked_version = None
+        # This sorts the graph if its last change introduced a cycle.
+        topo_order.refresh()
+        if checked_version != topo_order.version:
+            apps = self.ords.keys()
+        else:
+            apps = set(self.unchecked)
+            for node in topo_order.moved[self.checked_moves:]:
+                apps.add(node)
+                apps.update(self.ords_successors.get(node, ()))
+
+        position = topo_order.position
+        for app in apps:
+            prereqs = self.ords.get(app)
+            if prereqs:
+                p_app = position[app]
+                if any(position[p] > p_app for p in prereqs):
+                    order = graph.io_toposort(fgraph.inputs, fgraph.outputs,
+                                              self.ords)
+                    topo_order.set_order(order)
+                    break
+
+        self.unchecked = set()
+        self.checked_version = topo_order.version
+        self.checked_moves = len(topo_order.moved)
+
     def orderings(self, fgraph):
         """Return orderings induced by destructive operations.
 
@@ -432,95 +631,8 @@ class DestroyHandlerHelper2(toolbox.Bookkeeper):
         c) an Apply destroys (illegally) one of its own inputs by aliasing
 
         """
-        rval = {}
-
         if self.destroyers:
-            # BUILD DATA STRUCTURES
-            # CHECK for multiple destructions during construction of variables
-
-            droot, impact, __ignore = self.refresh_droot_impact()
-            #print "droot", droot
-            #print "impact", impact
-            #print "view_i", self.view_i
-            #print "view_o", self.view_o
-
-            # check for destruction of constants
-            illegal_destroy = [r for r in droot if \
-                    getattr(r.tag,'indestructible', False) or \
-                    isinstance(r, graph.Constant)]
-            if illegal_destroy:
-                #print 'destroying illegally'
-                raise InconsistencyError("Attempting to destroy indestructible variables: %s" %
-                        illegal_destroy)
-
-            # add destroyed variable clients as computational dependencies
-            for app in self.destroyers:
-                # for each destroyed input...
-                for output_idx, input_idx_list in app.op.destroy_map.items():
-                    destroyed_idx = input_idx_list[0]
-                    destroyed_variable = app.inputs[destroyed_idx]
-                    root = droot[destroyed_variable]
-                    root_impact = impact[root]
-                    # we generally want to put all clients of things which depend on root
-                    # as pre-requisites of app.
-                    # But, app is itself one such client!
-                    # App will always be a client of the node we're destroying
-                    # (destroyed_variable, but the tricky thing is when it is also a client of
-                    # *another variable* viewing on the root.  Generally this is illegal, (e.g.,
-                    # add_inplace(x, x.T).  In some special cases though, the in-place op will
-                    # actually be able to work properly with multiple destroyed inputs (e.g,
-                    # add_inplace(x, x).  An Op that can still work in this case should declare
-                    # so via the 'destroyhandler_tolerate_same' attribute or
-                    # 'destroyhandler_tolerate_aliased' attribute.
-                    #
-                    # destroyhandler_tolerate_same should be a list of pairs of the form
-                    # [(idx0, idx1), (idx0, idx2), ...]
-                    # The first element of each pair is the input index of a destroyed
-                    # variable.
-                    # The second element of each pair is the index of a different input where
-                    # we will permit exactly the same variable to appear.
-                    # For example, add_inplace.tolerate_same might be [(0,1)] if the destroyed
-                    # input is also allowed to appear as the second argument.
-                    #
-                    # destroyhandler_tolerate_aliased is the same sort of list of
-                    # pairs.
-                    # op.destroyhandler_tolerate_aliased = [(idx0, idx1)] tells the
-                    # destroyhandler to IGNORE an aliasing between a destroyed
-                    # input idx0 and another input idx1.
-                    # This is generally a bad idea, but it is safe in some
-                    # cases, such as
-                    # - the op reads from the aliased idx1 before modifying idx0
-                    # - the idx0 and idx1 are guaranteed not to overlap (e.g.
-                    #   they are pointed at different rows of a matrix).
-                    #
-
-                    #CHECK FOR INPUT ALIASING
-                    # OPT: pre-compute this on import
-                    tolerate_same = getattr(app.op, 'destroyhandler_tolerate_same', [])
-                    tolerated = set(idx1 for idx0, idx1 in tolerate_same
-                            if idx0 == destroyed_idx)
-                    tolerated.add(destroyed_idx)
-                    tolerate_aliased = getattr(app.op, 'destroyhandler_tolerate_aliased', [])
-                    ignored = set(idx1 for idx0, idx1 in tolerate_aliased
-                            if idx0 == destroyed_idx)
-                    #print 'tolerated', tolerated
-                    #print 'ignored', ignored
-                    for i, input in enumerate(app.inputs):
-                        if i in ignored:
-                            continue
-                        if input in root_impact \
-                                and (i not in tolerated or input is not destroyed_variable):
-                            raise InconsistencyError("Input aliasing: %s (%i, %i)"
-                                    % (app, destroyed_idx, i))
-
-                    # add the rule: app must be preceded by all other Apply instances that
-                    # depend on destroyed_input
-                    root_clients = set()
-                    for r in root_impact:
-                        assert not [a for a,c in self.clients[r].items() if not c]
-                        root_clients.update([a for a,c in self.clients[r].items() if c])
-                    root_clients.remove(app)
-                    if root_clients:
-                        rval[app] = root_clients
-
-        return rval
+            self._update()
+            return dict((app, set(prereqs))
+                        for app, prereqs in self.ords.iteritems())
+        return {}
@@ -124,6 +124,9 @@ class FunctionGraph(utils.object2):
         self.inputs = list(inputs)
         self.outputs = outputs
 
+        # Added first, so that the order is up to date when the callbacks
+        # of the other features are called.
+        self.extend(toolbox.TopoOrder())
         for f in features:
             self.extend(f)
         self.extend(toolbox.ReplaceValidate())
@@ -555,6 +558,9 @@ class FunctionGraph(utils.object2):
         this FunctionGraph as sole argument. It should return a dictionary of
         {node: predecessors} where predecessors is a list of nodes
         that should be computed before the key node.
+
+        The order is maintained by the toolbox.TopoOrder feature as the
+        graph changes, and is only recomputed when needed.
         """
         if len(self.nodes) < 2:
             # optimization
@@ -562,6 +568,9 @@ class FunctionGraph(utils.object2):
             # This special case happens a lot because the OpWiseCLinker produces
             # 1-element graphs.
             return list(self.nodes)
+        topo_order = getattr(self, 'topo_order', None)
+        if topo_order is not None:
+            return list(topo_order.toposort())
         fg = self
         ords = self.orderings()
         order = graph.io_toposort(fg.inputs, fg.outputs, ords)
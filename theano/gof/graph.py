@@ -10,6 +10,7 @@ __docformat__ = "restructuredtext en"
 
 
 from copy import copy
+import gc
 
 import theano
 import warnings
@@ -21,6 +22,47 @@ is_same_graph_with_merge = None
 equal_computations = None
 
 
+# Apply and Variable use __slots__ to keep large graphs small: their usual
+# attributes are stored in the instance, without a __dict__ (one is only
+# created when other attributes are set). Their `tag` is also only created
+# when it is first used.
+
+def _get_tag(self):
+    tag = self._tag
+    if tag is None:
+        tag = self._tag = utils.scratchpad()
+    return tag
+
+
+def _set_tag(self, tag):
+    self._tag = tag
+
+
+def _slots_getstate(self):
+    state = dict(getattr(self, '__dict__', {}))
+    for cls in type(self).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if name in ('__dict__', '__weakref__'):
+                continue
+            try:
+                # Read the slot itself, even if a subclass defines a
+                # property with the same name (e.g. Constant.owner).
+                state[name] = cls.__dict__[name].__get__(self, cls)
+            except AttributeError:
+                # This slot is not set.
+                pass
+    return state
+
+
+def _slots_setstate(self, state):
+    # This also accepts the state of the instances pickled before the use of
+    # __slots__, which contains 'tag' instead of '_tag'.
+    if '_tag' not in state:
+        self._tag = None
+    for name, value in state.iteritems():
+        setattr(self, name, value)
+
+
 class Apply(utils.object2):
     """
     An :term:`Apply` instance is a node in an expression graph which represents the application
@@ -47,6 +89,8 @@ class Apply(utils.object2):
     call (or expression instance) whereas `Op` is theano's version of a function definition.
 
     """
+    __slots__ = ['op', 'inputs', 'outputs', '_tag', 'fgraph', 'deps',
+                 '__dict__', '__weakref__']
 
     def __init__(self, op, inputs, outputs):
         """Initialize attributes
@@ -69,7 +113,7 @@ class Apply(utils.object2):
         """
         self.op = op
         self.inputs = []
-        self.tag = utils.scratchpad()
+        self._tag = None
 
         if not isinstance(inputs, (list, tuple)):
             raise TypeError("The inputs of an Apply must be a list or tuple")
@@ -96,6 +140,11 @@ class Apply(utils.object2):
             else:
                 raise TypeError("The 'outputs' argument to Apply must contain Variable instances with no owner, not %s" % output)
 
+    tag = property(_get_tag, _set_tag,
+                   doc="scratchpad for extra information on this node")
+    __getstate__ = _slots_getstate
+    __setstate__ = _slots_setstate
+
     def default_output(self):
         """Returns the default output for this node.
 
@@ -161,7 +210,8 @@ class Apply(utils.object2):
             tags are copied from self to the returned instance.
         """
         cp = self.__class__(self.op, self.inputs, [output.clone() for output in self.outputs])
-        cp.tag = copy(self.tag)
+        if self._tag is not None:
+            cp._tag = copy(self._tag)
         return cp
 
     def clone_with_new_inputs(self, inputs, strict=True):
@@ -188,7 +238,7 @@ class Apply(utils.object2):
         remake_node = False
         new_inputs = inputs[:]
         for i, (curr, new) in enumerate(zip(self.inputs, new_inputs)):
-            if not curr.type == new.type:
+            if curr.type is not new.type and not curr.type == new.type:
                 if strict:
                     # If compatible, casts new into curr.type
                     new_inputs[i] = curr.type.filter_variable(new)
@@ -196,7 +246,8 @@ class Apply(utils.object2):
                     remake_node = True
         if remake_node:
             new_node = self.op.make_node(*new_inputs)
-            new_node.tag = copy(self.tag).__update__(new_node.tag)
+            if self._tag is not None:
+                new_node.tag = copy(self._tag).__update__(new_node.tag)
         else:
             new_node = self.clone()
             new_node.inputs = new_inputs
@@ -288,7 +339,9 @@ class Variable(utils.object2):
     together with each Variable's `owner` field to determine which inputs are necessary to compute the function's outputs.
 
     """
-    #__slots__ = ['type', 'owner', 'index', 'name']
+    __slots__ = ['type', 'owner', 'index', 'name', '_tag', 'fgraph', 'clients',
+                 '__dict__', '__weakref__']
+
     def __init__(self, type, owner=None, index=None, name=None):
         """Initialize type, owner, index, name.
 
@@ -306,7 +359,7 @@ class Variable(utils.object2):
         :param name: a string for pretty-printing and debugging
 
         """
-        self.tag = utils.scratchpad()
+        self._tag = None
         self.type = type
         if owner is not None and not isinstance(owner, Apply):
             raise TypeError("owner must be an Apply instance", owner)
@@ -318,6 +371,11 @@ class Variable(utils.object2):
             raise TypeError("name must be a string", name)
         self.name = name
 
+    tag = property(_get_tag, _set_tag,
+                   doc="scratchpad for extra information on this variable")
+    __getstate__ = _slots_getstate
+    __setstate__ = _slots_setstate
+
     def __str__(self):
         """WRITEME"""
         if self.name is not None:
@@ -345,7 +403,8 @@ class Variable(utils.object2):
         """
         #return copy(self)
         cp = self.__class__(self.type, None, None, self.name)
-        cp.tag = copy(self.tag)
+        if self._tag is not None:
+            cp._tag = copy(self._tag)
         return cp
 
     def __lt__(self, other):
@@ -388,7 +447,8 @@ class Constant(Variable):
 
     Constant nodes make eligible numerous optimizations: constant inlining in C code, constant folding, etc.
     """
-    #__slots__ = ['data']
+    __slots__ = ['data']
+
     def __init__(self, type, data, name=None):
         """Initialize self.
 
@@ -424,7 +484,8 @@ class Constant(Variable):
         We suppose that the data will never change.
         """
         cp = self.__class__(self.type, self.data, self.name)
-        cp.tag = copy(self.tag)
+        if self._tag is not None:
+            cp._tag = copy(self._tag)
         return cp
 
     def __set_owner(self, value):
@@ -473,17 +534,24 @@ def stack_search(start, expand, mode='bfs', build_inv=False):
     else:
         start_pop = start.pop
     expand_inv = {}
+    # Local names, as this loop runs once per node of big graphs.
+    add = rval_set.add
+    append = rval_list.append
+    extend = start.extend
     while start:
         l = start_pop()
         if id(l) not in rval_set:
-            rval_list.append(l)
-            rval_set.add(id(l))
+            append(l)
+            add(id(l))
             expand_l = expand(l)
             if expand_l:
                 if build_inv:
                     for r in expand_l:
-                        expand_inv.setdefault(r, []).append(l)
-                start.extend(expand_l)
+                        try:
+                            expand_inv[r].append(l)
+                        except KeyError:
+                            expand_inv[r] = [l]
+                extend(expand_l)
     assert len(rval_list) == len(rval_set)
     if build_inv:
         return rval_list, expand_inv
@@ -641,39 +709,61 @@ def clone_get_equiv(inputs, outputs,
     if memo is None:
         memo = {}
 
-    # clone the inputs if necessary
-    for input in inputs:
-        if copy_inputs_and_orphans:
-            cpy = input.clone()
-            cpy.owner = None
-            cpy.index = None
-            memo.setdefault(input, cpy)
-        else:
-            memo.setdefault(input, input)
-
-    # go through the inputs -> outputs graph cloning as we go
-    for apply in io_toposort(inputs, outputs):
-        for input in apply.inputs:
-            if input not in memo:
-                if copy_inputs_and_orphans:
-                    cpy = input.clone()
+    gc_enabled = _disable_gc()
+    try:
+        # clone the inputs if necessary
+        for input in inputs:
+            if copy_inputs_and_orphans:
+                cpy = input.clone()
+                cpy.owner = None
+                cpy.index = None
+                memo.setdefault(input, cpy)
+            else:
+                memo.setdefault(input, input)
+
+        # go through the inputs -> outputs graph cloning as we go
+        for apply in io_toposort(inputs, outputs):
+            new_inputs = []
+            for input in apply.inputs:
+                try:
+                    new_inputs.append(memo[input])
+                except KeyError:
+                    if copy_inputs_and_orphans:
+                        cpy = input.clone()
+                    else:
+                        cpy = input
                     memo[input] = cpy
-                else:
-                    memo[input] = input
+                    new_inputs.append(cpy)
 
-        new_apply = apply.clone_with_new_inputs([memo[i] for i in apply.inputs])
-        memo.setdefault(apply, new_apply)
-        for output, new_output in zip(apply.outputs, new_apply.outputs):
-            memo.setdefault(output, new_output)
+            new_apply = apply.clone_with_new_inputs(new_inputs)
+            memo.setdefault(apply, new_apply)
+            for output, new_output in zip(apply.outputs, new_apply.outputs):
+                memo.setdefault(output, new_output)
 
-    # finish up by cloning any remaining outputs (it can happen)
-    for output in outputs:
-        if output not in memo:
-            memo[output] = output.clone()
+        # finish up by cloning any remaining outputs (it can happen)
+        for output in outputs:
+            if output not in memo:
+                memo[output] = output.clone()
+    finally:
+        if gc_enabled:
+            gc.enable()
 
     return memo
 
 
+def _disable_gc():
+    """
+    Disable the cyclic garbage collector, and return True if it was enabled.
+
+    The functions that go through a whole graph disable it while they run:
+    they allocate many objects but free none, and each collection would go
+    through all the nodes of the graph.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    return enabled
+
+
 def general_toposort(r_out, deps, debug_print=False):
     """WRITEME
 
@@ -691,30 +781,43 @@ def general_toposort(r_out, deps, debug_print=False):
     def _deps(io):
         if io not in deps_cache:
             d = deps(io)
-            if d:
-                deps_cache[io] = list(d)
-            else:
-                deps_cache[io] = d
+            if d and not isinstance(d, list):
+                d = list(d)
+            deps_cache[io] = d
             return d
         else:
             return deps_cache[io]
 
     assert isinstance(r_out, (tuple, list, deque))
 
-    reachable, clients = stack_search(deque(r_out), _deps, 'dfs', True)
-    sources = deque([r for r in reachable if not deps_cache.get(r, None)])
-
-    rset = set()
-    rlist = []
-    while sources:
-        node = sources.popleft()
-        if node not in rset:
-            rlist.append(node)
-            rset.add(node)
-            for client in clients.get(node, []):
-                deps_cache[client] = [a for a in deps_cache[client] if a is not node]
-                if not deps_cache[client]:
-                    sources.append(client)
+    gc_enabled = _disable_gc()
+    try:
+        reachable, clients = stack_search(deque(r_out), _deps, 'dfs', True)
+        sources = deque([r for r in reachable if not deps_cache.get(r, None)])
+
+        # Number of dependencies of each node that are not in rlist yet. A
+        # node that depends several times on the same node is its client as
+        # many times, so the count reaches 0 when all its dependencies are
+        # in rlist.
+        n_deps = {}
+        for r, d in deps_cache.iteritems():
+            if d:
+                n_deps[r] = len(d)
+
+        rset = set()
+        rlist = []
+        while sources:
+            node = sources.popleft()
+            if node not in rset:
+                rlist.append(node)
+                rset.add(node)
+                for client in clients.get(node, ()):
+                    n_deps[client] -= 1
+                    if not n_deps[client]:
+                        sources.append(client)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
     if len(rlist) != len(reachable):
         if debug_print:
@@ -734,6 +837,19 @@ def io_toposort(i, o, orderings=None):
     #the inputs are used only here in the function that decides what 'predecessors' to explore
     iset = set(i)
 
+    if not orderings:
+        # The common case, with fewer tests per node.
+        def deps(obj):
+            if obj in iset:
+                return []
+            if isinstance(obj, Apply):
+                return obj.inputs
+            if obj.owner:
+                return [obj.owner]
+            return []
+        topo = general_toposort(o, deps)
+        return [o for o in topo if isinstance(o, Apply)]
+
     def deps(obj):
         rval = []
         if obj not in iset:
@@ -275,6 +275,33 @@ class CLinkerOp(CLinkerObject):
         raise utils.MethodNotDefined("c_support_code_apply",
                 type(self), self.__class__.__name__)
 
+    def c_code_gil_free(self, node):
+        """Optional: Return True if the code returned by c_code for `node`
+        can run without holding the Python GIL.
+
+        Such code may only work on the data buffers of its inputs and
+        outputs (numpy buffers, BLAS calls, ...): it must not allocate,
+        incref or decref Python objects nor set a Python error. The
+        `CLinker` releases the GIL before that code and takes it back
+        after it, so other Python threads (and other Theano functions)
+        can run meanwhile.
+
+        If the code needs the GIL for a short section (for instance to
+        raise an error), it can use %(acquire_gil)s and %(release_gil)s
+        from `sub`. %(fail)s takes the GIL back before jumping to the
+        cleanup code, but the Python error must be set while holding it.
+
+        Ops whose c_code only releases the GIL around part of its work
+        do not need to override this: %(release_gil)s and %(acquire_gil)s
+        are available to every Op, and the `CLinker` takes the GIL back
+        after the code or on failure.
+
+        Changing the value returned here changes the generated code, so
+        c_code_cache_version must be updated accordingly.
+
+        """
+        return False
+
 
 class PureOp(object):
     """
@@ -409,12 +409,43 @@ class _metadict:
         return "(%s, %s)" % (self.d, self.l)
 
 
+# op class -> whether its __hash__ is defined along with its __eq__
+_hash_follows_eq_cache = {}
+
+
+def _hash_follows_eq(op_class):
+    """
+    Return False if `op_class` redefines __eq__ without redefining
+    __hash__, so that equal instances can have different hashes.
+    """
+    try:
+        return _hash_follows_eq_cache[op_class]
+    except KeyError:
+        rval = True
+        for cls in op_class.__mro__:
+            if '__hash__' in cls.__dict__:
+                break
+            if '__eq__' in cls.__dict__:
+                _logger.warning('%s defines __eq__ but not __hash__: its '
+                                'nodes are merged without hashing them.',
+                                op_class)
+                rval = False
+                break
+        _hash_follows_eq_cache[op_class] = rval
+        return rval
+
+
 class MergeFeature(object):
     """
     Keeps track of variables in fgraph that cannot be merged together.
 
     That way, the MergeOptimizer can remember the result of the last merge
     pass on the fgraph.
+
+    The distinct nodes are indexed by their op and the identity of their
+    inputs, so a new or changed node is compared only with the nodes that
+    compute the same thing, and is scheduled for merging as soon as it is
+    imported or its inputs change.
     """
     def on_attach(self, fgraph):
         assert not hasattr(fgraph, 'merge_feature')
@@ -430,6 +461,10 @@ class MergeFeature(object):
         ## For all variables
         # Set of distinct (not mergeable) nodes
         self.nodes_seen = set()
+        # (op, ids of the inputs) -> nodes of nodes_seen with that key
+        self.node_table = {}
+        # node -> its key in node_table
+        self.node_key = {}
 
         # Each element of scheduled is a list of list of (out, new_out) pairs.
         # Each list of pairs represent the substitution needed to replace all
@@ -454,7 +489,7 @@ class MergeFeature(object):
         # If inputs to node change, it is not guaranteed that it is distinct
         # from the other nodes in nodes_seen
         if node in self.nodes_seen:
-            self.nodes_seen.discard(node)
+            self.forget_node(node)
             self.process_node(fgraph, node)
 
         if isinstance(new_r, graph.Constant):
@@ -468,7 +503,7 @@ class MergeFeature(object):
         self.process_node(fgraph, node)
 
     def on_prune(self, fgraph, node):
-        self.nodes_seen.discard(node)
+        self.forget_node(node)
         for c in node.inputs:
             if isinstance(c, graph.Constant) and (len(c.clients) <= 1):
                 # This was the last node using this constant
@@ -495,6 +530,16 @@ class MergeFeature(object):
             self.const_sig_inv[sig] = c
             self.seen_constants.add(id(c))
 
+    def forget_node(self, node):
+        """Remove node from the distinct nodes."""
+        self.nodes_seen.discard(node)
+        key = self.node_key.pop(node, None)
+        if key is not None:
+            same = self.node_table[key]
+            same.remove(node)
+            if not same:
+                del self.node_table[key]
+
     def process_node(self, fgraph, node):
         """Check if a node can be merged, and queue that replacement."""
         if node in self.nodes_seen:
@@ -502,11 +547,21 @@ class MergeFeature(object):
 
         # These asserts ensure that the fgraph has set the clients field properly.
         # The clients should at least contain `node` itself!
+        key = None
         if node.inputs:
             assert len(node.inputs[0].clients) > 0
             assert (node, 0) in node.inputs[0].clients
-            merge_candidates = [c for (c, i) in node.inputs[0].clients
-                                if c in self.nodes_seen]
+            if _hash_follows_eq(type(node.op)):
+                key = (node.op, tuple(map(id, node.inputs)))
+                try:
+                    merge_candidates = self.node_table.get(key, [])
+                except TypeError:
+                    key = None
+            if key is None:
+                # node.op is unhashable, or its hash does not match its
+                # __eq__: look at the other clients of the first input.
+                merge_candidates = [c for (c, i) in node.inputs[0].clients
+                                    if c in self.nodes_seen]
         else:
             merge_candidates = []
 
@@ -540,6 +595,9 @@ class MergeFeature(object):
             self.scheduled.append(replacement_candidates)
         else:
             self.nodes_seen.add(node)
+            if key is not None:
+                self.node_table.setdefault(key, []).append(node)
+                self.node_key[node] = key
 
 
 class MergeOptimizer(Optimizer):
@@ -707,6 +765,20 @@ class LocalOptimizer(object):
         raise utils.MethodNotDefined("transform",
                 type(self), self.__class__.__name__)
 
+    def tracks(self):
+        """
+        Return the ops this optimization can transform, or None if it may
+        transform any node.
+
+        The return value is a list of tracks. A track is either an Op
+        instance or Op subclass, or a list [op, child_op, ...] describing
+        the root of the subgraph to transform and the ops of its inputs.
+        EquilibriumOptimizer only calls `transform` on the nodes whose op is
+        equal to, or an instance of, one of the ops mentioned in the tracks.
+        A track that is empty or starts with None matches any node.
+        """
+        return None
+
     def add_requirements(self, fgraph):
         """
         If this local optimization wants to add some requirements to the fgraph,
@@ -1390,6 +1462,29 @@ class ChangeTracker:
         fgraph.change_tracker = self
 
 
+def _tracked_ops(lopt):
+    """
+    Return the list of ops (Op instances and Op subclasses) whose nodes
+    `lopt` can transform, or None if it can transform any node.
+    """
+    tracks = getattr(lopt, 'tracks', None)
+    if tracks is None:
+        return None
+    tracks = tracks()
+    if not tracks:
+        return None
+    ops = []
+    for track in tracks:
+        if not isinstance(track, (list, tuple)):
+            track = [track]
+        if len(track) == 0 or track[0] is None:
+            return None
+        # Some optimizations list alternative root ops in a single track,
+        # so every op of the track is considered as a possible root.
+        ops.extend(o for o in track if o is not None)
+    return ops
+
+
 class EquilibriumOptimizer(NavigatorOptimizer):
     def __init__(self,
                  optimizers,
@@ -1424,6 +1519,58 @@ class EquilibriumOptimizer(NavigatorOptimizer):
         assert self.max_use_ratio is not None, (
                 'max_use_ratio has to be a number')
 
+    def _build_tracks_index(self):
+        """
+        Index the local optimizers by the ops they track.
+
+        Sets self._lopts_by_op (Op instance -> optimizers), self._lopts_by_type
+        (Op subclass -> optimizers) and self._lopts_all (the optimizers that
+        can transform any node). Each optimizer appears in them as
+        (position in self.local_optimizers, optimizer), so that the
+        optimizers are always tried in their original order.
+        """
+        self._lopts_by_op = {}
+        self._lopts_by_type = {}
+        self._lopts_all = []
+        for i, lopt in enumerate(self.local_optimizers):
+            ops = _tracked_ops(lopt)
+            if ops is not None:
+                try:
+                    for o in ops:
+                        if isinstance(o, type):
+                            self._lopts_by_type.setdefault(o, set()).add(
+                                    (i, lopt))
+                        else:
+                            self._lopts_by_op.setdefault(o, set()).add(
+                                    (i, lopt))
+                except TypeError:
+                    # An unhashable op; apply this optimizer to every node.
+                    ops = None
+            if ops is None:
+                self._lopts_all.append((i, lopt))
+
+    def local_optimizers_for(self, op):
+        """
+        Return the local optimizers that can transform a node whose op is
+        `op`, in the order they appear in self.local_optimizers.
+        """
+        lopts = set(self._lopts_all)
+        by_equality = not _hash_follows_eq(type(op))
+        if not by_equality:
+            try:
+                lopts.update(self._lopts_by_op.get(op, ()))
+            except TypeError:
+                by_equality = True
+        if by_equality:
+            # An unhashable op, or one whose hash does not match its __eq__:
+            # look for it by equality.
+            for o, o_lopts in self._lopts_by_op.iteritems():
+                if o == op:
+                    lopts.update(o_lopts)
+        for cls in type(op).__mro__:
+            lopts.update(self._lopts_by_type.get(cls, ()))
+        return [lopt for i, lopt in sorted(lopts)]
+
     def add_requirements(self, fgraph):
         super(EquilibriumOptimizer, self).add_requirements(fgraph)
         fgraph.extend(ChangeTracker())
@@ -1449,6 +1596,9 @@ class EquilibriumOptimizer(NavigatorOptimizer):
         for lopt in self.local_optimizers:
             process_count.setdefault(lopt, 0)
             time_lopts.setdefault(lopt, 0)
+        self._build_tracks_index()
+        # (type(op), op) -> local optimizers to try on the nodes of that op
+        lopts_for_op = {}
 
         while changed and not max_use_abort:
             t0 = time.time()
@@ -1468,7 +1618,12 @@ class EquilibriumOptimizer(NavigatorOptimizer):
                 assert node in fgraph.outputs
 
             topo_t0 = time.time()
-            q = deque(graph.io_toposort(fgraph.inputs, start_from))
+            # The nodes are processed from the end of `q`. `q_set` holds the
+            # nodes that are still to be processed, so that the pruner
+            # doesn't have to search `q`: the entries of `q` that are not in
+            # `q_set` (pruned or duplicated nodes) are skipped.
+            q = graph.io_toposort(fgraph.inputs, start_from)
+            q_set = set(q)
             io_toposort_timing.append(time.time() - topo_t0)
 
             nb_nodes.append(len(q))
@@ -1478,21 +1633,32 @@ class EquilibriumOptimizer(NavigatorOptimizer):
             def importer(node):
                 if node is not current_node:
                     q.append(node)
+                    q_set.add(node)
 
             def pruner(node):
                 if node is not current_node:
-                    try:
-                        q.remove(node)
-                    except ValueError:
-                        pass
+                    q_set.discard(node)
 
             u = self.attach_updater(fgraph, importer, pruner)
             try:
                 while q:
                     node = q.pop()
+                    if node not in q_set:
+                        continue
+                    q_set.remove(node)
                     current_node = node
 
-                    for lopt in self.local_optimizers:
+                    op_key = (type(node.op), node.op)
+                    try:
+                        lopts = lopts_for_op[op_key]
+                    except KeyError:
+                        lopts = self.local_optimizers_for(node.op)
+                        lopts_for_op[op_key] = lopts
+                    except TypeError:
+                        # unhashable op
+                        lopts = self.local_optimizers_for(node.op)
+
+                    for lopt in lopts:
                         t_lopt = time.time()
                         lopt_change = self.process_node(fgraph, node, lopt)
                         time_lopts[lopt] += time.time() - t_lopt
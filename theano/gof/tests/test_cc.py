@@ -1,12 +1,15 @@
 
+import os
+import random
 import unittest
 
+from theano.gof import graph
 from theano.gof.link import PerformLinker
 from theano.gof.cc import *
 from theano.gof.type import Type
 from theano.gof.graph import Variable, Apply, Constant
 from theano.gof.op import Op
-from theano.gof import fg
+from theano.gof import cc, fg
 
 
 def as_variable(x):
@@ -226,6 +229,46 @@ def test_clinker_dups_inner():
     assert fn(1.0, 2.0, 3.0) == 8.0
 
 
+def test_clinker_cmodule_key_memo():
+    # Versions are memoized per (op, types): similar nodes share them, and
+    # the keys are not affected.
+    x, y, z = inputs()
+    keys = []
+    for a, b in [(x, y), (y, z)]:
+        node = add.make_node(a, b)
+        env = Env(*graph.clone(node.inputs, node.outputs))
+        keys.append(CLinker().accept(env).cmodule_key())
+    assert keys[0] == keys[1]
+    memo_key = (add, (tdouble, tdouble), (tdouble,))
+    assert memo_key in cc._node_cache_versions
+
+    # The memo is bounded.
+    orig_max = cc._node_cache_versions_max
+    cc._node_cache_versions.pop((mul, (tdouble, tdouble), (tdouble,)), None)
+    cc._node_cache_versions_max = len(cc._node_cache_versions)
+    try:
+        node = mul.make_node(x, y)
+        cc._node_cache_version(node)
+        assert memo_key not in cc._node_cache_versions
+        assert len(cc._node_cache_versions) == 1
+    finally:
+        cc._node_cache_versions_max = orig_max
+
+
+def test_clinker_cache_hit_no_code_gen():
+    # When the module is already in the cache, no C code is generated.
+    x, y, z = inputs()
+    e = add(x, y)
+    CLinker().accept(Env(*graph.clone([x, y], [e]))).make_function()
+    lnk = CLinker().accept(Env(*graph.clone([x, y], [e])))
+
+    def code_gen():
+        raise AssertionError('code_gen should not be called')
+    lnk.code_gen = code_gen
+    fn = lnk.make_function()
+    assert fn(2.0, 7.0) == 9
+
+
 ######################
 # Test OpWiseCLinker #
 ######################
@@ -248,6 +291,73 @@ def test_opwiseclinker_constant():
     assert res == 15.3
 
 
+class AddConst(MyOp):
+    # Each instance generates different C code, so that the modules it needs
+    # are never in the cache.
+    def __init__(self, cst):
+        MyOp.__init__(self, 2, 'AddConst%s' % cst)
+        self.cst = cst
+
+    def c_code(self, node, name, inp, out, sub):
+        x, y = inp
+        z, = out
+        cst = self.cst
+        return "%(z)s = %(x)s + %(y)s + %(cst)s;" % locals()
+
+    def impl(self, x, y):
+        return x + y + self.cst
+
+
+def test_precompile_nodes():
+    x, y, z = inputs()
+    e = AddConst(1)(AddConst(2)(x, y), AddConst(3)(y, z))
+    env = Env([x, y, z], [e])
+    orig_compile_jobs = config.cmodule.compile_jobs
+    try:
+        config.cmodule.compile_jobs = 2
+        precompile_nodes(env.toposort(), [], force_c_code=True)
+    finally:
+        config.cmodule.compile_jobs = orig_compile_jobs
+    # All modules should now be in the cache, so building the thunks should
+    # not compile anything.
+    cache = get_module_cache()
+    n_compiled = cache.stats[2]
+    fn = OpWiseCLinker().accept(env).make_function()
+    assert cache.stats[2] == n_compiled
+    assert fn(1.0, 2.0, 3.0) == 14.0
+
+
+def test_precompile_nodes_batch():
+    x, y, z = inputs()
+    # A random constant, so that the modules are not in the cache yet.
+    cst = random.randint(0, 1 << 30)
+    ops = [AddConst(cst + i) for i in range(3)]
+    e = ops[0](ops[1](x, y), ops[2](y, z))
+    env = Env([x, y, z], [e])
+    orig_compile_jobs = config.cmodule.compile_jobs
+    orig_compile_batch_size = config.cmodule.compile_batch_size
+    try:
+        config.cmodule.compile_jobs = 1
+        config.cmodule.compile_batch_size = 3
+        precompile_nodes(env.toposort(), [], force_c_code=True)
+    finally:
+        config.cmodule.compile_jobs = orig_compile_jobs
+        config.cmodule.compile_batch_size = orig_compile_batch_size
+    # The three modules are cached individually, but compiled in a single
+    # library.
+    cache = get_module_cache()
+    modules = set()
+    for node in env.toposort():
+        key = CLinker().accept(Env(*graph.clone(node.inputs, node.outputs))
+                               ).cmodule_key()
+        modules.add(os.stat(cache.entry_from_key[key]).st_ino)
+    assert len(modules) == 1
+    n_compiled = cache.stats[2]
+    fn = OpWiseCLinker().accept(env).make_function()
+    assert cache.stats[2] == n_compiled
+    assert fn(1.0, 2.0, 3.0) == 8.0 + 3 * cst + 3
+
+
 class MyExc(Exception):
     pass
 
@@ -326,3 +436,61 @@ def test_fail_error():
         print 'Yay, TEST PASSED'
         return  # test passed
     assert 0  # test failed
+
+
+################################
+# Test ops that release the GIL #
+################################
+
+class AddNoGil(Add):
+    def c_code_gil_free(self, node):
+        return True
+add_nogil = AddNoGil()
+
+
+class AddFailNoGil(Binary):
+    def c_code_gil_free(self, node):
+        return True
+
+    def c_code(self, node, name, inp, out, sub):
+        x, y = inp
+        z, = out
+        return """%(z)s = %(x)s + %(y)s;
+            if (%(z)s > 0) {
+                %(acquire_gil)s
+                PyErr_SetString(PyExc_RuntimeError, "failing here");
+                %(fail)s;
+            }""" % dict(sub, x=x, y=y, z=z)
+
+    def impl(self, x, y):
+        return x + y
+add_fail_nogil = AddFailNoGil()
+
+
+def test_clinker_gil_free():
+    x, y, z = inputs()
+    e = add(add_nogil(x, y), z)
+    lnk = CLinker().accept(Env([x, y, z], [e]))
+    assert 'PyEval_SaveThread' in lnk.code_gen()
+    fn = lnk.make_function()
+    assert fn(1.0, 2.0, 3.0) == 6.0
+
+    # The nodes run without the GIL are marked in the key.
+    key = CLinker().accept(
+            Env(*graph.clone([x, y], [add_nogil(x, y)]))).cmodule_key()
+    assert key[1][-1][-1] == 'gil_free'
+
+
+def test_clinker_gil_free_fail():
+    x, y, z = inputs()
+    e = add_fail_nogil(x, y)
+    fn = CLinker().accept(Env([x, y], [e])).make_function()
+    assert fn(-2.0, 1.0) == -1.0
+    try:
+        fn(2.0, 1.0)
+    except RuntimeError:
+        pass
+    else:
+        assert 0
+    # The GIL was taken back: the function can be called again.
+    assert fn(-2.0, 1.0) == -1.0
@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import time
+
+from nose.plugins.skip import SkipTest
+
+from theano import config
+from theano.gof import compilelock
+from theano.gof import cmodule
+from theano.gof.cmodule import KeyData, ModuleCache
+
+
+def make_entry(dirname, name, module_hash):
+    """
+    Create a fake versioned cache entry and return its key.
+    """
+    location = os.path.join(dirname, name)
+    os.mkdir(location)
+    module = os.path.join(location, 'mod.so')
+    open(module, 'w').close()
+    key = ((1,), ('CLinker.cmodule_key', 'md5:%s' % name))
+    KeyData(keys=set([key]), module_hash=module_hash,
+            key_pkl=os.path.join(location, 'key.pkl'),
+            entry=module).save_pkl()
+    return key
+
+
+def test_module_index():
+    dirname = tempfile.mkdtemp()
+    # Like the real compiledir, which is not empty.
+    open(os.path.join(dirname, '__init__.py'), 'w').close()
+    try:
+        key_a = make_entry(dirname, 'tmpa', 'hash_a')
+        # Without index, the whole directory is walked and the index built.
+        cache = ModuleCache(dirname)
+        assert key_a in cache.entry_from_key
+        assert open(cache.index_file).read() == 'tmpa hash_a\n'
+
+        # New entries are only found through the index.
+        key_b = make_entry(dirname, 'tmpb', 'hash_b')
+        cache.refresh()
+        assert key_b not in cache.entry_from_key
+        cache.append_to_index(os.path.join(dirname, 'tmpb'), 'hash_b')
+        cache.refresh()
+        assert key_b in cache.entry_from_key
+
+        # Another process sees both entries.
+        other_cache = ModuleCache(dirname)
+        assert key_a in other_cache.entry_from_key
+        assert key_b in other_cache.entry_from_key
+
+        # A corrupted index is rebuilt.
+        key_c = make_entry(dirname, 'tmpc', 'hash_c')
+        open(cache.index_file, 'a').write('garbage\n')
+        cache.refresh()
+        assert key_c in cache.entry_from_key
+        assert open(cache.index_file).read() == (
+                'tmpa hash_a\ntmpb hash_b\ntmpc hash_c\n')
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_workdir_not_removed():
+    # The directory of a module being compiled (without holding the global
+    # lock) is not removed by a refresh walking the cache.
+    dirname = tempfile.mkdtemp()
+    open(os.path.join(dirname, '__init__.py'), 'w').close()
+    try:
+        cache = ModuleCache(dirname)
+        location = cmodule.dlimport_workdir(dirname)
+        cache.refresh(rebuild_index=True)
+        assert os.path.isdir(location)
+        cmodule.unmark_workdir(location)
+        assert not os.listdir(location)
+        cache.refresh(rebuild_index=True)
+        assert not os.path.exists(location)
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_clear_lru():
+    dirname = tempfile.mkdtemp()
+    open(os.path.join(dirname, '__init__.py'), 'w').close()
+    try:
+        keys = []
+        now = time.time()
+        # tmp1 is the least recently used module, then tmp0 and tmp2.
+        for name, age in (('tmp0', 2000), ('tmp1', 3000), ('tmp2', 1000)):
+            keys.append(make_entry(dirname, name, 'hash_' + name))
+            module = os.path.join(dirname, name, 'mod.so')
+            open(module, 'w').write('x' * 10000)
+            os.utime(module, (now - age, now - age))
+        cache = ModuleCache(dirname)
+        entry_sizes = cache.entry_sizes()
+        assert len(entry_sizes) == 3
+        total_size = sum(size for entry, size in entry_sizes)
+        assert total_size > 30000
+
+        assert cache.clear_lru(total_size) == 0
+        assert cache.clear_lru(total_size - 1) == 1
+        assert keys[1] not in cache.entry_from_key
+        assert not os.path.exists(os.path.join(dirname, 'tmp1'))
+        assert cache.clear_lru(1) == 2
+        assert not cache.entry_from_key
+        assert open(cache.index_file).read() == ''
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_save_stats():
+    dirname = tempfile.mkdtemp()
+    try:
+        cache = ModuleCache(dirname, do_refresh=False)
+        assert cache.read_stats() == [0, 0, 0]
+        cache.stats = [3, 2, 1]
+        cache.save_stats()
+        assert cache.stats == [0, 0, 0]
+        other_cache = ModuleCache(dirname, do_refresh=False)
+        other_cache.stats = [1, 0, 1]
+        other_cache.save_stats()
+        assert cache.read_stats() == [4, 2, 2]
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_module_lock():
+    lock_dir = os.path.join(config.compiledir, 'lock_dir_test_module_lock')
+    unlocker = compilelock.get_module_lock('test_module_lock')
+    try:
+        assert os.path.isdir(lock_dir)
+        # The global lock is independent.
+        compilelock.get_lock()
+        compilelock.release_lock()
+    finally:
+        unlocker.unlock()
+    assert not os.path.exists(lock_dir)
+
+
+def test_precompiled_header():
+    orig_precompiled_headers = config.cmodule.precompiled_headers
+    location = tempfile.mkdtemp(dir=config.compiledir)
+    try:
+        config.cmodule.precompiled_headers = True
+        header = cmodule.gcc_precompiled_header(
+                ['-g'] + ['-I%s' % d for d in cmodule.std_include_dirs()])
+        if header is None:
+            raise SkipTest('Cannot build precompiled headers')
+        assert os.path.exists(header + '.gch')
+        # A module without functions.
+        mod = cmodule.DynamicModule('test_pch_%s' %
+                                    os.path.basename(location))
+        module = cmodule.GCC_compiler.compile_str(
+                mod.name, mod.code(), location=location)
+        assert module.__name__.endswith(mod.name)
+    finally:
+        config.cmodule.precompiled_headers = orig_precompiled_headers
+        shutil.rmtree(location)
+
+
+def test_precompiled_header_failed():
+    # A flag that g++ rejects.
+    flags = ['-fno-such-flag-%s' % os.getpid()]
+    digest = cmodule.hash_from_code('\n'.join(
+            [cmodule.GCC_compiler.version_str()] + flags))
+    failed = os.path.join(config.compiledir, 'precompiled_headers',
+                          digest + '.failed')
+    try:
+        assert cmodule.gcc_precompiled_header(flags) is None
+        if not os.path.exists(failed):
+            raise SkipTest('g++ is not available')
+        # g++ is tried again once the failure is old enough.
+        old = time.time() - cmodule._precompiled_header_retry_delay - 1
+        os.utime(failed, (old, old))
+        del cmodule._precompiled_headers[digest]
+        assert cmodule.gcc_precompiled_header(flags) is None
+        assert os.path.getmtime(failed) > old
+    finally:
+        cmodule._precompiled_headers.pop(digest, None)
+        if os.path.exists(failed):
+            os.remove(failed)
+
+
+def test_base_compiledirs():
+    base_dirname = tempfile.mkdtemp()
+    dirname = tempfile.mkdtemp()
+    for d in (base_dirname, dirname):
+        open(os.path.join(d, '__init__.py'), 'w').close()
+    mod = cmodule.DynamicModule('test_base_%s' %
+                                os.path.basename(base_dirname))
+
+    def compile_steps(location):
+        src_code = mod.code()
+        yield src_code
+        yield cmodule.GCC_compiler.compile_str(mod.name, src_code,
+                                               location=location)
+    key = ((1,), ('CLinker.cmodule_key', 'md5:a'))
+    try:
+        # Warm the base directory.
+        base_cache = ModuleCache(base_dirname, base_dirnames=[])
+        base_cache.module_from_key(key, compile_steps)
+        base_files = sorted(os.listdir(base_dirname))
+        base_key_pkl = os.path.join(
+                os.path.dirname(base_cache.entry_from_key[key]), 'key.pkl')
+        base_key_pkl_data = open(base_key_pkl, 'rb').read()
+
+        cache = ModuleCache(dirname, base_dirnames=[base_dirname])
+        assert cache.entry_from_key[key].startswith(base_dirname)
+        module = cache.module_from_key(key)
+        assert module.__file__.startswith(base_dirname)
+        assert cache.stats == [0, 1, 0]
+        # A new key for the same module is not saved in the base directory.
+        other_key = ((1,), ('CLinker.cmodule_key', 'md5:b'))
+        assert cache.module_from_key(other_key, compile_steps) is module
+        assert open(base_key_pkl, 'rb').read() == base_key_pkl_data
+        # Modules of the base directory are neither indexed nor deleted.
+        cache.refresh()
+        assert open(cache.index_file).read() == ''
+        assert cache.entry_sizes() == []
+        cache.clear_old(age_thresh_del=-1)
+        assert sorted(os.listdir(base_dirname)) == base_files
+        assert key in cache.entry_from_key
+    finally:
+        shutil.rmtree(base_dirname)
+        shutil.rmtree(dirname)
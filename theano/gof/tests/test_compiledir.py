@@ -0,0 +1,56 @@
+import cPickle
+import os
+import shutil
+import tempfile
+
+import theano
+from theano import tensor
+from theano.gof import compiledir
+
+builder_code = """
+from theano import tensor
+
+
+def vector_graph():
+    x = tensor.dvector('x')
+    return [x], tensor.exp(x) * 2 + 1
+
+
+def broken_graph():
+    raise ValueError('broken graph')
+
+theano_graphs = [vector_graph, broken_graph]
+"""
+
+
+def test_warm_cache():
+    dirname = tempfile.mkdtemp()
+    try:
+        builders = os.path.join(dirname, 'builders.py')
+        open(builders, 'w').write(builder_code)
+        x = tensor.dmatrix('x')
+        y = tensor.dmatrix('y')
+        cPickle.dump([([x, y], x * y + 3),
+                      dict(inputs=[x], outputs=tensor.log(x).sum())],
+                     open(os.path.join(dirname, 'graphs.pkl'), 'wb'), -1)
+        manifest = os.path.join(dirname, 'manifest.txt')
+        open(manifest, 'w').write('# Graphs to compile\n'
+                                  'builders.py\n\ngraphs.pkl\n')
+        names = [name for name, builder in
+                 compiledir.warm_cache_builders([manifest])]
+        assert names == [
+            os.path.join(dirname, 'builders.py.vector_graph'),
+            os.path.join(dirname, 'builders.py.broken_graph'),
+            os.path.join(dirname, 'graphs.pkl[0]'),
+            os.path.join(dirname, 'graphs.pkl[1]')]
+        assert compiledir.warm_cache([manifest], n_jobs=1) == 1
+        cache = theano.gof.cc.get_module_cache()
+        cache.refresh()
+        entries = set(entry for entry, size in cache.entry_sizes())
+        # The modules are now in the cache, so the processes do not compile
+        # them again.
+        assert compiledir.warm_cache([manifest], n_jobs=2) == 1
+        cache.refresh()
+        assert set(entry for entry, size in cache.entry_sizes()) == entries
+    finally:
+        shutil.rmtree(dirname)
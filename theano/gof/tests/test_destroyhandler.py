@@ -399,3 +399,29 @@ def test_value_repl_2():
 
 
 
+
+def test_usage_loop_after_consistent():
+    # The loop goes through an ordering that was already checked.
+    x, y, z = inputs()
+    w = MyVariable('w')
+    aip = add_in_place(x, y)
+    d = dot(x, w)
+    g = Env([x, y, z, w], [aip, d])
+    consistent(g)
+    g.replace(w, aip)
+    inconsistent(g)
+    g.replace(aip, add(y, z))
+    consistent(g)
+
+def test_many_destroyers():
+    # Each inplace change is validated on its own, and the incremental
+    # validation agrees with a full check of the graph.
+    x, y, z = inputs()
+    e = x
+    for i in xrange(50):
+        e = add(e, sigmoid(y))
+    g = Env([x, y, z], [e])
+    OpSubOptimizer(add, add_in_place).optimize(g)
+    consistent(g)
+    assert len(g.destroy_handler.destroyers) == 50
+    destroyhandler._dfs_toposort(g.inputs, g.outputs, g.orderings())
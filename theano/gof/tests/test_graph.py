@@ -1,3 +1,4 @@
+import cPickle
 import unittest
 
 from theano import tensor
@@ -135,6 +136,17 @@ class TestClone(X):
         assert new[0].owner.inputs[1] is r5 # the inputs are not copied
         assert new[0].owner.inputs[0].type == node.outputs[0].type and new[0].owner.inputs[0] is not node.outputs[0] # check that we copied deeper too
 
+    def test_tag(self):
+        # The tags are only created when they are used, and are copied.
+        r1, r2 = MyVariable(1), MyVariable(2)
+        node = MyOp.make_node(r1, r2)
+        r1.tag.test = 1
+        assert r2._tag is None
+        new_r1, new_r2 = clone([r1, r2], node.outputs)[0]
+        assert new_r1.tag.test == 1
+        assert new_r1.tag is not r1.tag
+        assert new_r2._tag is None
+
     def test_not_destructive(self):
         # Checks that manipulating a cloned graph leaves the original unchanged.
         r1, r2, r5 = MyVariable(1), MyVariable(2), MyVariable(5)
@@ -290,3 +302,32 @@ class TestIsSameGraph(unittest.TestCase):
                                     ({y: x, t: z}, True))),
             ],
             debug=False)
+
+
+##################
+# representation #
+##################
+
+class TestSlots:
+
+    def test_attributes(self):
+        r1, r2 = MyVariable(1), MyVariable(2)
+        node = MyOp.make_node(r1, r2)
+        # Other attributes than those in __slots__ can still be set.
+        node.other = 1
+        r1.other = 2
+        assert node.other == 1 and r1.other == 2
+        assert not hasattr(r2, 'fgraph')
+
+    def test_pickle(self):
+        x = tensor.scalar('x')
+        node = (x + 2).owner
+        node.tag.test = 3
+        for protocol in (0, 2):
+            out = cPickle.loads(cPickle.dumps(node.outputs[0], protocol))
+            assert out.owner.op == node.op
+            assert out.owner.tag.test == 3
+            new_x, new_c = out.owner.inputs
+            assert new_x.name == 'x' and new_x.owner is None
+            assert new_x.type == x.type
+            assert new_c.data == 2 and new_c.owner is None
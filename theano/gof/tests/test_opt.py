@@ -353,6 +353,41 @@ class TestMergeOptimizer:
         strg = str(g)
         assert strg == '[Op1(y, y)]' or strg == '[Op1(z, z)]'
 
+    def test_merge_chain(self):
+        # Two copies of a long chain are merged in a single pass.
+        x, y, z = inputs()
+        e1, e2 = x, x
+        for i in xrange(100):
+            e1 = op2(e1, y)
+            e2 = op2(e2, y)
+        g = Env([x, y, z], [op1(e1, e2)])
+        MergeOptimizer().optimize(g)
+        assert len(g.nodes) == 101
+        assert not g.merge_feature.scheduled
+
+    def test_merge_imported(self):
+        # A node imported after a merge pass is scheduled right away.
+        x, y, z = inputs()
+        e = op1(op2(x, y), z)
+        g = Env([x, y, z], [e])
+        MergeOptimizer().optimize(g)
+        assert not g.merge_feature.scheduled
+        g.replace(z, op2(x, y))
+        assert g.merge_feature.scheduled
+        MergeOptimizer().optimize(g)
+        assert str(g) == "[Op1(*1 -> Op2(x, y), *1)]"
+
+    def test_merge_eq_without_hash(self):
+        # An op that redefines __eq__ but not __hash__ is still merged.
+        class EqOp(MyOp):
+            def __eq__(self, other):
+                return type(self) == type(other)
+        x, y, z = inputs()
+        e = op1(EqOp('OpE')(x, y), EqOp('OpE')(x, y))
+        g = Env([x, y, z], [e])
+        MergeOptimizer().optimize(g)
+        assert str(g) == "[Op1(*1 -> OpE(x, y), *1)]"
+
 
 class TestEquilibrium(object):
 
@@ -409,3 +444,53 @@ class TestEquilibrium(object):
             _logger.setLevel(oldlevel)
         print 'after', g
         assert str(g) == '[Op1(x, y)]'
+
+    def test_tracks_dispatch(self):
+        # Local optimizers are only tried on the nodes of the ops they track.
+        x, y, z = map(MyVariable, 'xyz')
+        e = op3(op1(op2(x, y)), op2(z, z))
+        g = Env([x, y, z], [e])
+        seen = {}
+
+        def counting(name, *tracks):
+            seen[name] = []
+
+            @local_optimizer(*tracks)
+            def lopt(node):
+                seen[name].append(node.op)
+                return False
+            return lopt
+        opt = EquilibriumOptimizer(
+            [counting('op2', [op2]),
+             counting('op1_or_op3', [op1, op3]),
+             counting('path', [op3, op1]),
+             counting('all', [None]),
+             counting('class', [MyOp]),
+             PatternSub((op1, 'x'), (op4, 'x'))],
+            max_use_ratio=10)
+        opt.optimize(g)
+        assert str(g) == '[Op3(Op4(Op2(x, y)), Op2(z, z))]'
+        assert set(seen['op2']) == set([op2])
+        assert set(seen['op1_or_op3']) == set([op1, op3])
+        assert set(seen['path']) == set([op1, op3])
+        assert set(seen['all']) == set([op1, op2, op3, op4])
+        assert set(seen['class']) == set([op1, op2, op3, op4])
+        # Two passes (the second one changes nothing), each visiting the
+        # two op2 nodes once.
+        assert len(seen['op2']) == 4
+
+    def test_tracks_eq_without_hash(self):
+        # An op that redefines __eq__ but not __hash__ is found by equality.
+        class EqOp(MyOp):
+            def __eq__(self, other):
+                return type(self) == type(other)
+        x, y, z = map(MyVariable, 'xyz')
+        g = Env([x, y, z], [op1(EqOp('OpE')(x, y))])
+
+        @local_optimizer([EqOp('OpE')])
+        def to_op2(node):
+            if node.op == EqOp('OpE'):
+                return [op2(*node.inputs)]
+        opt = EquilibriumOptimizer([to_op2], max_use_ratio=10)
+        opt.optimize(g)
+        assert str(g) == '[Op1(Op2(x, y))]'
@@ -86,3 +86,62 @@ class TestNodeFinder:
 
 
 
+
+
+class TestTopoOrder:
+
+    def check_order(self, g):
+        order = g.toposort()
+        assert set(order) == g.nodes
+        index = dict((node, i) for i, node in enumerate(order))
+        for node in order:
+            for input in node.inputs:
+                if input.owner is not None:
+                    assert index[input.owner] < index[node]
+        return order
+
+    def test_change_input(self):
+        x, y, z = inputs()
+        e1 = sigmoid(x)
+        e2 = sigmoid(y)
+        e = add(add(e1, e2), z)
+        g = Env([x, y, z], [e])
+        order = self.check_order(g)
+        assert g.toposort() == order
+        # Make the first sigmoid depend on the second one.
+        first, second = [n for n in order if n.op is sigmoid]
+        g.change_input(first, 0, second.outputs[0])
+        order = self.check_order(g)
+        assert order.index(second) < order.index(first)
+        new_e = dot(add(x, y), z)
+        g.replace(e, new_e)
+        self.check_order(g)
+
+    def test_cycle(self):
+        x, y, z = inputs()
+        e1 = sigmoid(x)
+        e2 = sigmoid(e1)
+        g = Env([x, y, z], [add(e2, z)])
+        self.check_order(g)
+        g.change_input(e1.owner, 0, e2)
+        try:
+            g.toposort()
+            assert False
+        except ValueError:
+            pass
+        g.change_input(e1.owner, 0, x)
+        self.check_order(g)
+
+    def test_orderings(self):
+        x, y, z = inputs()
+        e1 = sigmoid(x)
+        e2 = sigmoid(y)
+        g = Env([x, y, z], [add(e1, e2)])
+        first, second = [n for n in self.check_order(g) if n.op is sigmoid]
+
+        class Orderings:
+            def orderings(self, fgraph):
+                return {first: [second]}
+        g.extend(Orderings())
+        order = self.check_order(g)
+        assert order.index(second) < order.index(first)
@@ -313,3 +313,107 @@ def test_vm_gc():
     f = theano.function([x], [pp + pp],
                         mode=mode)
     f([1, 2, 3])
+
+
+def test_plan_storage():
+    x = tensor.vector('x')
+    a = tensor.exp(x) * 2
+    b = tensor.tanh(a) + x
+    c = tensor.exp(b) * a
+    out = tensor.log(c) + b
+    x_val = numpy.asarray([.1, .2, .3], dtype=theano.config.floatX)
+
+    orig_plan_storage = theano.config.vm.plan_storage
+    try:
+        for use_cloop in [False, True]:
+            n_cells = []
+            for plan in [False, True]:
+                theano.config.vm.plan_storage = plan
+                linker = vm.VM_Linker(allow_gc=False, use_cloop=use_cloop)
+                f = function([x], out, mode=Mode(optimizer=None,
+                                                 linker=linker))
+                # The result is the same, and stays so on the next calls.
+                for i in range(2):
+                    assert numpy.allclose(f(x_val), f(x_val))
+                    assert numpy.allclose(f(x_val), numpy.log(
+                        numpy.exp(numpy.tanh(numpy.exp(x_val) * 2) + x_val) *
+                        numpy.exp(x_val) * 2) +
+                        numpy.tanh(numpy.exp(x_val) * 2) + x_val)
+                cells = set()
+                for thunk in f.fn.thunks:
+                    cells.update(id(cell) for cell in thunk.outputs)
+                n_cells.append(len(cells))
+            assert n_cells[1] < n_cells[0], n_cells
+    finally:
+        theano.config.vm.plan_storage = orig_plan_storage
+
+
+def test_cvm_order():
+    x = tensor.vector('x')
+    a = tensor.exp(x)
+    b = tensor.tanh(x)
+    fgraph = theano.gof.FunctionGraph([x], [a + b, b * 2])
+    order = fgraph.toposort()
+    run_order = vm.cvm_order(order, fgraph.outputs, fgraph.orderings())
+    assert set(run_order) == set(order)
+    # The first output is computed first, with its inputs in order.
+    assert [node.op for node in run_order[:3]] == [
+        a.owner.op, b.owner.op, fgraph.outputs[0].owner.op]
+
+
+class RaiseOp(theano.Op):
+    def __eq__(self, other):
+        return type(self) == type(other)
+
+    def __hash__(self):
+        return hash(type(self))
+
+    def make_node(self, x):
+        return theano.Apply(self, [x], [x.type()])
+
+    def perform(self, node, inputs, outputs):
+        raise ValueError('RaiseOp')
+
+
+def test_parallel():
+    x = tensor.vector('x')
+    # Independent branches, that the optimizer makes inplace.
+    outs = [tensor.exp(x * i) + tensor.tanh(x) * i for i in range(1, 6)]
+    out = outs[0]
+    for o in outs[1:]:
+        out = out + o
+    x_val = numpy.asarray([.1, .2, .3], dtype=theano.config.floatX)
+
+    f_ref = function([x], [out, outs[-1]], mode=Mode(linker='vm'))
+    ref = f_ref(x_val)
+
+    orig_n_threads = theano.config.vm.n_threads
+    try:
+        theano.config.vm.n_threads = 3
+        for allow_gc in [True, False]:
+            linker = vm.VM_Linker(allow_gc=allow_gc, parallel=True)
+            f = function([x], [out, outs[-1]], mode=Mode(linker=linker))
+            assert isinstance(f.fn, vm.Parallel)
+            for i in range(3):
+                res = f(x_val)
+                assert all(numpy.allclose(r, e) for r, e in zip(res, ref))
+            # With gc, only the storage of the inputs and outputs is kept.
+            kept = [node for node, thunk in zip(f.fn.nodes, f.fn.thunks)
+                    if thunk.outputs[0][0] is not None]
+            if allow_gc:
+                assert all(node.outputs[0] in f.maker.fgraph.outputs
+                           for node in kept)
+            else:
+                assert len(kept) == len(f.fn.nodes)
+
+        # Errors are raised in the calling thread.
+        f = function([x], [RaiseOp()(x * 2), tensor.exp(x)],
+                     mode=Mode(linker=vm.VM_Linker(parallel=True)))
+        try:
+            f(x_val)
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        theano.config.vm.n_threads = orig_n_threads
@@ -1,7 +1,7 @@
 import sys
 import time
 
-from theano.gof.python25 import partial
+from theano.gof.python25 import any, partial
 
 import graph
 
@@ -224,6 +224,201 @@ class NodeFinder(dict, Bookkeeper):
         return all
 
 
+class TopoOrder(Bookkeeper):
+    """
+    Maintain a topological order of the nodes of a FunctionGraph while it
+    is modified, so that FunctionGraph.toposort doesn't have to sort the
+    whole graph again on each call.
+
+    Each node has an integer position, larger than the positions of the
+    owners of its inputs. Imported nodes are put after all the other
+    nodes. When on_change_input adds an edge that goes against the
+    positions, only the nodes between the two ends of the new edge are
+    reordered, with the online algorithm of Pearce and Kelly ("A dynamic
+    topological sort algorithm for directed acyclic graphs", 2006).
+
+    The positions only account for the dependencies between the nodes,
+    and are what node_order() returns. toposort() returns the same order
+    as graph.io_toposort with the orderings() of the other features, as
+    the result of compiling a graph must not depend on the changes that
+    built it. It is kept until the graph or the list of features changes,
+    so the orderings() of the features must only depend on the graph.
+
+    Features that keep their own orderings satisfied by the positions can
+    use `version`, which changes when all the nodes get new positions, and
+    `moved`, the list of the nodes moved since then.
+    """
+
+    def __init__(self):
+        self.fgraph = None
+
+    def on_attach(self, fgraph):
+        if hasattr(fgraph, 'topo_order'):
+            raise AlreadyThere("TopoOrder is already present or in conflict"
+                               " with another plugin.")
+        if self.fgraph is not None:
+            raise Exception("A TopoOrder instance can only serve one"
+                            " FunctionGraph.")
+        self.fgraph = fgraph
+        # node -> position
+        self.position = {}
+        self.next_position = 0
+        # The nodes sorted by position, or None if it must be recomputed
+        self.order = None
+        # False when the positions are not a topological order, because the
+        # last change introduced a cycle.
+        self.valid = True
+        self.version = 0
+        self.moved = []
+        # The last result of toposort(), and the features it was computed
+        # with. None when the graph changed since.
+        self.last_toposort = None
+        self.last_features = None
+        fgraph.topo_order = self
+        Bookkeeper.on_attach(self, fgraph)
+
+    def on_detach(self, fgraph):
+        if self.fgraph is not fgraph:
+            raise Exception("This TopoOrder instance was not attached to the"
+                            " provided fgraph.")
+        self.fgraph = None
+        del fgraph.topo_order
+        self.position = {}
+        self.order = None
+        self.moved = []
+        self.last_toposort = None
+
+    def on_import(self, fgraph, node):
+        self.position[node] = self.next_position
+        self.next_position += 1
+        if self.order is not None:
+            self.order.append(node)
+        self.last_toposort = None
+
+    def on_prune(self, fgraph, node):
+        del self.position[node]
+        self.order = None
+        self.last_toposort = None
+
+    def on_change_input(self, fgraph, node, i, r, new_r, reason=None):
+        self.last_toposort = None
+        if node == 'output' or not self.valid:
+            return
+        x = new_r.owner
+        if x is None or x not in self.position:
+            return
+        if self.position[x] < self.position[node]:
+            return
+        self.order = None
+        if x is node or not self._reorder(x, node):
+            self.valid = False
+
+    def _reorder(self, x, y):
+        """
+        Update the positions for the new edge x -> y, where x is after y.
+
+        Return False if the edge introduces a cycle.
+        """
+        pos = self.position
+        lower, upper = pos[y], pos[x]
+
+        # The nodes that depend on y, and are not after x
+        forward = [y]
+        seen = set(forward)
+        stack = [y]
+        while stack:
+            for out in stack.pop().outputs:
+                for client, i in out.clients:
+                    if client == 'output' or client in seen:
+                        continue
+                    if client is x:
+                        return False
+                    p = pos.get(client)
+                    if p is not None and p < upper:
+                        seen.add(client)
+                        forward.append(client)
+                        stack.append(client)
+
+        # The nodes x depends on, and are not before y
+        backward = [x]
+        seen = set(backward)
+        stack = [x]
+        while stack:
+            for input in stack.pop().inputs:
+                owner = input.owner
+                if owner is None or owner in seen:
+                    continue
+                p = pos.get(owner)
+                if p is not None and p > lower:
+                    seen.add(owner)
+                    backward.append(owner)
+                    stack.append(owner)
+
+        # Give the positions of both sets to the backward nodes first, then
+        # to the forward nodes, keeping the relative order inside each set.
+        key = pos.__getitem__
+        forward.sort(key=key)
+        backward.sort(key=key)
+        moved = backward + forward
+        positions = sorted(map(key, moved))
+        for node, p in zip(moved, positions):
+            pos[node] = p
+        self.moved.extend(moved)
+        if len(self.moved) > 2 * len(pos) + 1000:
+            # Don't let the log grow forever: its users will consider that
+            # all the nodes moved.
+            self.version += 1
+            self.moved = []
+        return True
+
+    def set_order(self, order):
+        """Make `order`, a topological order of all the nodes, current."""
+        self.position = dict((node, i) for i, node in enumerate(order))
+        self.next_position = len(order)
+        self.order = list(order)
+        self.valid = True
+        self.version += 1
+        self.moved = []
+
+    def refresh(self):
+        """
+        Make sure the positions are a topological order, by sorting the
+        whole graph if the last change introduced a cycle.
+
+        Raise ValueError if the graph contains a cycle.
+        """
+        if not self.valid:
+            fgraph = self.fgraph
+            self.set_order(graph.io_toposort(fgraph.inputs, fgraph.outputs))
+
+    def node_order(self):
+        """
+        Return the nodes sorted by position, which only accounts for the
+        dependencies between the nodes. The list must not be modified.
+        """
+        self.refresh()
+        if self.order is None:
+            self.order = sorted(self.position, key=self.position.__getitem__)
+        return self.order
+
+    def toposort(self):
+        """
+        Return a topological order of the nodes that also satisfies the
+        orderings of the features of the FunctionGraph. The list must not
+        be modified.
+        """
+        fgraph = self.fgraph
+        if (self.last_toposort is not None and
+                self.last_features == fgraph._features):
+            return self.last_toposort
+
+        order = graph.io_toposort(fgraph.inputs, fgraph.outputs,
+                                  fgraph.orderings())
+        self.last_toposort = order
+        self.last_features = list(fgraph._features)
+        return order
+
+
 class PrintListener(object):
 
     def __init__(self, active=True):
@@ -11,7 +11,7 @@ from theano import config
 ########
 # Type #
 ########
-from theano.gof.op import CLinkerObject
+from theano.gof.op import CLinkerObject, Op
 
 class CLinkerType(CLinkerObject):
     """Interface specification for Types that can be arguments to a `CLinkerOp`.
@@ -316,7 +316,11 @@ class PureType(object):
             A pretty string for printing and debugging.
 
         """
-        return utils.add_tag_trace(self.make_variable(name))
+        variable = self.make_variable(name)
+        # Like Op.__call__, don't store the trace while optimizing.
+        if Op.add_stack_trace_on_call:
+            utils.add_tag_trace(variable)
+        return variable
 
     def values_eq(self, a, b):
         """
@@ -330,3 +330,23 @@ def flatten(a):
         return l
     else:
         return [a]
+
+
+# Objects recording where the time goes while functions are being compiled,
+# typically `theano.compile.profiling.CompileProfile` instances. They must
+# have a `record(phase, elapsed)` method. Profilers are pushed by the code
+# compiling a function, and the code doing the work reports its phases with
+# `record_compile_phase`, so that gof does not need to know about them.
+compile_profilers = []
+
+
+def record_compile_phase(phase, elapsed=0.0):
+    """
+    Report to the active compile profilers that `phase` took `elapsed`
+    seconds (of wall time).
+
+    Events that are simply counted (e.g. cache hits) can use the default
+    `elapsed` of 0.
+    """
+    for profiler in compile_profilers:
+        profiler.record(phase, elapsed)
@@ -3,9 +3,14 @@ VMs that run Theano graph computations.
 A VM is not actually different from a Linker, we just decided
 VM was a better name at some point
 """
+import cc
+import collections
+import graph
 import link
 import logging
+import Queue
 import sys
+import threading
 import time
 import warnings
 
@@ -14,7 +19,9 @@ from theano.gof.python25 import all
 import theano
 config = theano.config
 
-from theano.configparser import config, AddConfigVar, BoolParam, ConfigParam
+from theano.configparser import (config, AddConfigVar, BoolParam,
+                                 ConfigParam, IntParam)
+from theano.misc.cpucount import cpuCount
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +31,10 @@ AddConfigVar('profile',
 AddConfigVar('profile_optimizer',
         "If VM should collect optimizer profile information",
         BoolParam(False))
+AddConfigVar('profile_compile',
+        "If theano.function should record the time spent in each phase of "
+        "the compilation in Function.maker.compile_profile",
+        BoolParam(False))
 
 
 def filter_vm_lazy(val):
@@ -44,9 +55,157 @@ AddConfigVar('vm.lazy',
              " Loop/LoopGC and Stack.",
          ConfigParam('None', filter_vm_lazy))
 
+AddConfigVar('vm.plan_storage',
+             "Useful only for the vm linkers, when allow_gc is False. If True,"
+             " intermediate results whose lifetimes do not overlap share"
+             " their storage, so that they reuse the same buffers.",
+             BoolParam(False))
+
+AddConfigVar('vm.n_threads',
+             "Useful only for the parallel vm linkers (pvm and pvm_nogc). "
+             "Number of threads, including the calling one, that run the "
+             "thunks of independent nodes. 0 means to use the number of "
+             "detected CPU cores.",
+             IntParam(0, lambda i: i >= 0),
+             in_c_key=False)
+
 raise_with_op = link.raise_with_op
 
 
+def cvm_order(nodes, outputs, orderings):
+    """
+    Return the order in which the CVM runs `nodes` to compute `outputs`,
+    when none of their thunks is lazy.
+
+    The CVM computes each output recursively: the prerequisites of a node
+    given by `orderings` (ordered like in `VM_Linker.make_vm`), then its
+    inputs, then the node itself.
+    """
+    vars_idx = {}
+    for node in nodes:
+        for v in node.inputs + node.outputs:
+            vars_idx.setdefault(v, len(vars_idx))
+
+    def deps(node):
+        prereqs = set()
+        for prereq_node in orderings.get(node, []):
+            prereqs.update(prereq_node.outputs)
+        return (sorted(prereqs, key=vars_idx.__getitem__) +
+                list(node.inputs))
+
+    order = []
+    done = set()
+    for output in outputs:
+        if output.owner is None or output.owner in done:
+            continue
+        stack = [(output.owner, iter(deps(output.owner)))]
+        while stack:
+            node, node_deps = stack[-1]
+            for v in node_deps:
+                if v.owner is not None and v.owner not in done:
+                    stack.append((v.owner, iter(deps(v.owner))))
+                    break
+            else:
+                stack.pop()
+                done.add(node)
+                order.append(node)
+    return order
+
+
+def _same_shape(shape1, shape2):
+    """
+    Return True if the symbolic shapes are known to be equal, False if they
+    are known to be different, and None otherwise.
+    """
+    if shape1 is None or shape2 is None or len(shape1) != len(shape2):
+        return None
+    rval = True
+    for d1, d2 in zip(shape1, shape2):
+        if d1 is d2:
+            continue
+        if (isinstance(d1, graph.Constant) and
+                isinstance(d2, graph.Constant)):
+            if d1.data != d2.data:
+                return False
+        else:
+            rval = None
+    return rval
+
+
+def plan_storage(order, fgraph, no_recycling=()):
+    """
+    Return a dict that maps variables to the variable whose storage they
+    share.
+
+    `order` is the order in which the nodes are run. The buffer of a
+    variable (with its views, and the variables that destroy it) is live
+    from the node that computes it to the last node that uses it. A
+    variable computed after that reuses its storage cell if it has the same
+    type, and if its shape is not known to be different (the variables with
+    the same known shape are tried first). Most ops then write their output
+    in the buffer found in that cell, instead of allocating a new one.
+
+    The inputs and outputs of `fgraph`, the variables in `no_recycling` and
+    the views are never planned.
+    """
+    shape_feature = getattr(fgraph, 'shape_feature', None)
+    shape_of = getattr(shape_feature, 'shape_of', {})
+
+    # root[v] is the variable that owns the buffer of v, and end[r] is the
+    # position of the last node that uses the buffer of r.
+    root = {}
+    end = {}
+    views = set()
+    pinned = set()
+    for i, node in enumerate(order):
+        for input in node.inputs:
+            end[root.get(input, input)] = i
+        view_map = getattr(node.op, 'view_map', {})
+        destroy_map = getattr(node.op, 'destroy_map', {})
+        for k, output in enumerate(node.outputs):
+            aliased = view_map.get(k, []) + destroy_map.get(k, [])
+            if aliased:
+                views.add(output)
+                roots = set(root.get(node.inputs[j], node.inputs[j])
+                            for j in aliased)
+                if len(roots) > 1:
+                    pinned.update(roots)
+                root[output] = roots.pop()
+            else:
+                root[output] = output
+            end[root[output]] = max(end.get(root[output], i), i)
+    for v in fgraph.inputs + fgraph.outputs + list(no_recycling):
+        pinned.add(root.get(v, v))
+
+    reuse = {}
+    arena_of = {}  # variable -> first variable of its storage cell
+    free = {}  # type -> variables whose storage cell is free
+    released = {}  # position -> variables whose cell is free after it
+    for i, node in enumerate(order):
+        for output in node.outputs:
+            if output in views or output in pinned:
+                continue
+            candidates = free.get(output.type, [])
+            best = None
+            for v in candidates:
+                same = _same_shape(shape_of.get(v), shape_of.get(output))
+                if same:
+                    best = v
+                    break
+                if same is None and best is None:
+                    best = v
+            if best is None:
+                arena_of[output] = output
+            else:
+                candidates.remove(best)
+                arena_of[output] = arena_of[best]
+                reuse[output] = arena_of[best]
+            released.setdefault(end[output], []).append(output)
+        for v in released.pop(i, ()):
+            free.setdefault(v.type, []).append(v)
+    return reuse
+
+
 class VM(object):
     """
     A VM object's __call__ method evaluates a Theano program.
@@ -237,13 +396,15 @@ class Stack(VM):
 
     def __init__(self, nodes, thunks, pre_call_clear,
                  storage_map, compute_map, fgraph, allow_gc,
-                 dependencies=None, callback=None):
+                 dependencies=None, callback=None, outputs=None):
         super(Stack, self).__init__(nodes, thunks, pre_call_clear)
 
+        if outputs is None:
+            outputs = fgraph.outputs
         self.allow_gc = allow_gc
         self.message = ""
-        self.base_apply_stack = [o.owner for o in fgraph.outputs if o.owner]
-        self.outputs = fgraph.outputs
+        self.base_apply_stack = [o.owner for o in outputs if o.owner]
+        self.outputs = outputs
         self.storage_map = storage_map
         self.apply_time = {}
         self.outputs_size = {}
@@ -257,24 +418,26 @@ class Stack(VM):
             node_idx[node] = i
             self.apply_time[node] = 0
             self.outputs_size[node] = []
-            # XXX: inconsistent style - why modify node here rather
-            #      than track destroy_dependencies with dictionary like
-            #      storage_map?
-            #
-            # destroy_dependencies
-            # --------------------
-            # The destroy_dependencies is a list of variables that are implicit
-            # dependencies induced by a destroy_map (compare node.inputs which
-            # are *explicit* dependencies). The variables in
-            # destroy_dependencies would be impossible to compute after the
-            # current `node` runs, because node.thunk() is going to destroy a
-            # common input variable needed by whatever node owns each variable
-            # in destroy_depenencies.
-
-            node.destroy_dependencies = []
-            if node in ords:
-                for prereq in ords[node]:
-                    node.destroy_dependencies += prereq.outputs
+
+        # destroy_dependencies
+        # --------------------
+        # destroy_dependencies[node] is a list of variables that are implicit
+        # dependencies induced by a destroy_map (compare node.inputs which
+        # are *explicit* dependencies). The variables in
+        # destroy_dependencies would be impossible to compute after the
+        # current `node` runs, because node.thunk() is going to destroy a
+        # common input variable needed by whatever node owns each variable
+        # in destroy_depenencies.
+        # It is kept in the VM rather than in the nodes, as the VMs of a
+        # function group share nodes. Only the prerequisites run by this VM
+        # are kept: the others read the variable for another VM.
+        self.destroy_dependencies = {}
+        for node in self.nodes:
+            deps = []
+            for prereq in ords.get(node, ()):
+                if prereq in node_idx:
+                    deps += prereq.outputs
+            self.destroy_dependencies[node] = deps
 
         self.dependencies = dependencies
 
@@ -336,7 +499,8 @@ class Stack(VM):
             current_apply = apply_stack.pop()
             current_inputs = current_apply.inputs
             current_outputs = current_apply.outputs
-            current_deps = current_inputs + current_apply.destroy_dependencies
+            current_deps = (current_inputs +
+                            self.destroy_dependencies[current_apply])
 
             computed_ins = all(compute_map[v][0] for v in current_deps)
             computed_outs = all(compute_map[v][0] for v in current_outputs)
@@ -483,23 +647,207 @@ class Stack(VM):
                     storage_map[v][0] = None
 
 
-try:
-    import lazylinker_c
+class _ThreadPool(object):
+    """
+    Daemon threads that call the functions given to `submit`.
+    """
+    def __init__(self, n_threads):
+        self.tasks = Queue.Queue()
+        for i in xrange(n_threads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            self.tasks.get()()
+
+    def submit(self, fn):
+        self.tasks.put(fn)
+
+
+# Map a number of threads to the _ThreadPool shared by all the Parallel VMs
+# that use that many threads.
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def get_thread_pool(n_threads):
+    """
+    Return the pool of `n_threads` threads shared by the Parallel VMs.
+    """
+    _thread_pools_lock.acquire()
+    try:
+        if n_threads not in _thread_pools:
+            _thread_pools[n_threads] = _ThreadPool(n_threads)
+        return _thread_pools[n_threads]
+    finally:
+        _thread_pools_lock.release()
+
+
+class Parallel(VM):
+    """
+    Run the thunks of independent nodes at the same time, in a pool of
+    threads.
+
+    A node is run as soon as the nodes computing its inputs are done, and
+    the nodes that must run before it (see `FunctionGraph.orderings`, e.g.
+    the ones that read an input it destroys). The calling thread runs
+    nodes too, and it is the only one that updates the scheduling state
+    and collects garbage: the other threads only take nodes from the
+    deque of ready nodes and put back their results.
+
+    Threads only run at the same time while the thunks release the GIL,
+    see `CLinkerOp.c_code_gil_free`. Lazy thunks are not supported.
+    """
+    def __init__(self, nodes, thunks, pre_call_clear,
+                 storage_map, fgraph, allow_gc, n_threads, outputs=None):
+        super(Parallel, self).__init__(nodes, thunks, pre_call_clear)
+        if outputs is None:
+            outputs = fgraph.outputs
+
+        if n_threads > 1:
+            self.pool = get_thread_pool(n_threads - 1)
+        else:
+            self.pool = None
+
+        node_idx = dict((node, i) for i, node in enumerate(nodes))
+        ords = fgraph.orderings()
+        # successors[i] are the indices of the nodes that wait for node i,
+        # and n_preds[i] is the number of nodes that node i waits for.
+        self.successors = successors = [[] for node in nodes]
+        self.n_preds = n_preds = [0] * len(nodes)
+        for i, node in enumerate(nodes):
+            preds = set(node_idx[v.owner] for v in node.inputs
+                        if v.owner in node_idx)
+            preds.update(node_idx[p] for p in ords.get(node, ())
+                         if p in node_idx)
+            for j in preds:
+                successors[j].append(i)
+            n_preds[i] = len(preds)
+        self.roots = [i for i, n in enumerate(n_preds) if not n]
+
+        # Garbage collection: the storage gc_storage[k] is emptied when the
+        # n_users[k] nodes that use it are done. clear_after[i] are the
+        # indices in gc_storage of the inputs of node i.
+        self.gc_storage = []
+        self.n_users = []
+        self.clear_after = [[] for node in nodes]
+        if allow_gc:
+            outputs = set(outputs)
+            gc_idx = {}
+            for i, node in enumerate(nodes):
+                for v in set(node.inputs):
+                    if v.owner not in node_idx or v in outputs:
+                        continue
+                    if v not in gc_idx:
+                        gc_idx[v] = len(self.gc_storage)
+                        self.gc_storage.append(storage_map[v])
+                        self.n_users.append(0)
+                    self.n_users[gc_idx[v]] += 1
+                    self.clear_after[i].append(gc_idx[v])
+
+    def __call__(self):
+        for cont in self.pre_call_clear:
+            cont[0] = None
+
+        thunks = self.thunks
+        successors = self.successors
+        clear_after = self.clear_after
+        gc_storage = self.gc_storage
+        n_preds = list(self.n_preds)
+        n_users = list(self.n_users)
+        pool = self.pool
+        # Nodes ready to run, and the (index, exc_info, run time) of the
+        # nodes that ran.
+        ready = collections.deque()
+        done = Queue.Queue()
+
+        def run(i):
+            t0 = time.time()
+            try:
+                thunks[i]()
+            except:
+                done.put((i, sys.exc_info(), 0))
+            else:
+                done.put((i, None, time.time() - t0))
+
+        def work():
+            try:
+                i = ready.popleft()
+            except IndexError:
+                # The calling thread (or another one) ran it.
+                return
+            run(i)
+
+        def push(i):
+            ready.append(i)
+            if pool is not None:
+                pool.submit(work)
+
+        for i in self.roots:
+            push(i)
+        # Number of nodes that are ready or running.
+        n_pending = len(self.roots)
+        while n_pending:
+            # Run a node here instead of waiting, unless the pool took them
+            # all. This also prevents a deadlock when a thunk calls another
+            # function that uses this pool.
+            try:
+                i = ready.pop()
+            except IndexError:
+                pass
+            else:
+                run(i)
+            i, exc_info, dt = done.get()
+            n_pending -= 1
+            if exc_info is not None:
+                # Wait for the running nodes, and do not run the others.
+                while True:
+                    try:
+                        ready.pop()
+                    except IndexError:
+                        break
+                    n_pending -= 1
+                while n_pending:
+                    done.get()
+                    n_pending -= 1
+                raise_with_op(self.nodes[i], exc_info)
+            if self.time_thunks:
+                self.call_counts[i] += 1
+                self.call_times[i] += dt
+            for k in clear_after[i]:
+                n_users[k] -= 1
+                if not n_users[k]:
+                    gc_storage[k][0] = None
+            for j in successors[i]:
+                n_preds[j] -= 1
+                if not n_preds[j]:
+                    push(j)
+                    n_pending += 1
+
+
+# The C implementation of the VM, see `get_cvm`.
+CVM = None
+
+
+def get_cvm():
+    """
+    Return the CVM class, the VM implemented in C by `lazylinker_c`.
+
+    `lazylinker_c` is only imported, and compiled if needed, when a VM with
+    the C loop is first created: this takes the compilation lock and can
+    take several seconds, which we do not want to pay in `import theano`.
+    """
+    global CVM
+    if CVM is None:
+        import lazylinker_c
 
-    class CVM(lazylinker_c.CLazyLinker, VM):
-        def __init__(self, *args, **kwargs):
-            lazylinker_c.CLazyLinker.__init__(self, *args, **kwargs)
-            # skip VM.__init__
-except ImportError:
-    pass
-except OSError:
-    # OSError happens when g++ is not installed.  In that case, we
-    # already changed the default linker to something else then CVM.
-    # Currently this is the py linker.
-    # Here we assert that the default linker is not cvm.
-    assert not [x for x in theano.configparser._config_var_list
-                if x.fullname == 'linker'][0].default.startswith('cvm')
-    pass
+        class CVM(lazylinker_c.CLazyLinker, VM):
+            def __init__(self, *args, **kwargs):
+                lazylinker_c.CLazyLinker.__init__(self, *args, **kwargs)
+                # skip VM.__init__
+    return CVM
 
 
 class VM_Linker(link.LocalLinker):
@@ -508,7 +856,7 @@ class VM_Linker(link.LocalLinker):
     """
 
     def __init__(self, allow_gc=None, use_cloop=False, callback=None,
-                 lazy=None):
+                 lazy=None, parallel=False):
         """
         allow_gc - force the virtual machine to clean up unnecessary
             references, in order to allow garbage collection on
@@ -527,6 +875,10 @@ class VM_Linker(link.LocalLinker):
             version. If lazy is True or False, we force the version used
             between Loop/LoopGC and Stack.
 
+        parallel - use the Parallel VM, that runs independent nodes at the
+            same time in config.vm.n_threads threads. The graphs with lazy
+            nodes are run by the sequential VMs. Ignored if callback is set.
+
         """
         # Note: if more parameters are added to __init__, make sure to forward
         # them in the "type(self)(...)" call in the "accept" method below.
@@ -537,6 +889,7 @@ class VM_Linker(link.LocalLinker):
         self.use_cloop = use_cloop
         self.callback = callback
         self.lazy = lazy
+        self.parallel = parallel
         self.updated_vars = {}
 
     def accept(self, fgraph, no_recycling=None):
@@ -559,7 +912,8 @@ class VM_Linker(link.LocalLinker):
                     allow_gc=self.allow_gc,
                     use_cloop=self.use_cloop,
                     callback=self.callback,
-                    lazy=self.lazy
+                    lazy=self.lazy,
+                    parallel=self.parallel
                     ).accept(fgraph, no_recycling)
         self.fgraph = fgraph
         self.no_recycling = no_recycling
@@ -573,7 +927,7 @@ class VM_Linker(link.LocalLinker):
         # admittedly confusing, and it could use some cleaning up. The base
         # Linker object should probably go away completely.
 
-    def compute_gc_dependencies(self, variables):
+    def compute_gc_dependencies(self, variables, nodes=None):
         """
         Returns dict: variable K -> list of variables [v1, v2, v3, ...]
         for each K in variables.
@@ -589,6 +943,8 @@ class VM_Linker(link.LocalLinker):
         Parameters
         ----------
         variables - iterable over the variables used in a graph computation.
+        nodes - if not None, the set of nodes run by the computation. The
+            clients that are not in it are ignored.
 
 
         N.B. gc means garbage collection
@@ -606,7 +962,8 @@ class VM_Linker(link.LocalLinker):
                 ls = []
                 is_output = 0
                 for cl in k.clients:
-                    if cl[0] is not 'output':
+                    if cl[0] is not 'output' and (nodes is None or
+                                                  cl[0] in nodes):
                         ls += cl[0].outputs
                 dependencies[k] += ls
         return dependencies
@@ -616,23 +973,46 @@ class VM_Linker(link.LocalLinker):
             post_thunk_clear,
             computed,
             compute_map,
-            updated_vars
+            updated_vars,
+            outputs=None
             ):
+        """
+        Return a VM that runs `thunks`, the thunks of `nodes`.
+
+        outputs - the variables computed by the VM, followed by the new
+            values of the variables in `updated_vars`. None means the
+            outputs of self.fgraph. `nodes` must contain all the nodes
+            needed to compute them.
+        """
+        if outputs is None:
+            outputs = self.fgraph.outputs
 
         pre_call_clear = [storage_map[v] for v in self.no_recycling]
+        # The VMs of a function group only run some nodes of self.fgraph.
+        node_set = set(nodes)
 
         if self.callback is not None:
             if self.use_cloop:
                 logger.warn('CLoop does not support callback, using Stack VM.')
             deps = None
             if self.allow_gc:
-                deps = self.compute_gc_dependencies(storage_map)
+                deps = self.compute_gc_dependencies(storage_map, node_set)
             vm = Stack(
                     nodes, thunks, pre_call_clear,
                     storage_map, compute_map,
                     self.fgraph, self.allow_gc,
                     dependencies=deps,
-                    callback=self.callback)
+                    callback=self.callback,
+                    outputs=outputs)
+        elif self.parallel and not [th for th in thunks if th.lazy]:
+            n_threads = config.vm.n_threads
+            if n_threads == 0:
+                # cpuCount() returns -1 when it is unable to detect the cores.
+                n_threads = max(cpuCount(), 1)
+            vm = Parallel(
+                    nodes, thunks, pre_call_clear,
+                    storage_map, self.fgraph, self.allow_gc,
+                    n_threads, outputs=outputs)
         elif self.use_cloop:
             # create a map from nodes to ints and vars to ints
             nodes_idx = {}
@@ -641,7 +1021,7 @@ class VM_Linker(link.LocalLinker):
                 nodes_idx[node] = i
                 for v in node.inputs + node.outputs:
                     vars_idx.setdefault(v, len(vars_idx))
-            for v in self.fgraph.inputs + self.fgraph.outputs:
+            for v in self.fgraph.inputs + list(outputs):
                 vars_idx.setdefault(v, len(vars_idx))
 
             nodes_idx_inv = {}
@@ -662,7 +1042,8 @@ class VM_Linker(link.LocalLinker):
                 assert type(compute_map_list[0]) is list
 
             if self.allow_gc:
-                dependency_map = self.compute_gc_dependencies(storage_map)
+                dependency_map = self.compute_gc_dependencies(vars_idx,
+                                                              node_set)
                 dependency_map_list = [
                     [vars_idx[d] for d in dependency_map[vars_idx_inv[i]]]
                     for i in xrange(len(vars_idx_inv))]
@@ -692,7 +1073,7 @@ class VM_Linker(link.LocalLinker):
                     var_owner[i] = nodes_idx[var.owner]
 
             is_lazy_list = [int(th.lazy) for th in thunks]
-            output_vars = [vars_idx[v] for v in self.fgraph.outputs]
+            output_vars = [vars_idx[v] for v in outputs]
 
             # builds the list of prereqs induced by e.g. destroy_handler
             ords = self.fgraph.orderings()
@@ -702,8 +1083,9 @@ class VM_Linker(link.LocalLinker):
                 node_output_size.append(0)
                 prereq_var_idxs = []
                 for prereq_node in ords.get(node, []):
-                    prereq_var_idxs.extend(
-                            [vars_idx[v] for v in prereq_node.outputs])
+                    if prereq_node in nodes_idx:
+                        prereq_var_idxs.extend(
+                                [vars_idx[v] for v in prereq_node.outputs])
                 prereq_var_idxs = list(set(prereq_var_idxs))
                 prereq_var_idxs.sort()  # TODO: why sort?
                 node_prereqs.append(prereq_var_idxs)
@@ -722,7 +1104,7 @@ class VM_Linker(link.LocalLinker):
                     update_storage.append(update_in_from_out[oidx])
 
             c0 = sys.getrefcount(node_n_inputs)
-            vm = CVM(
+            vm = get_cvm()(
                     nodes,
                     thunks,
                     pre_call_clear,
@@ -767,12 +1149,14 @@ class VM_Linker(link.LocalLinker):
             else:
                 deps = None
                 if self.allow_gc:
-                    deps = self.compute_gc_dependencies(storage_map)
+                    deps = self.compute_gc_dependencies(storage_map,
+                                                        node_set)
                 vm = Stack(
                         nodes, thunks, pre_call_clear,
                         storage_map, compute_map,
                         self.fgraph, self.allow_gc,
-                        dependencies=deps
+                        dependencies=deps,
+                        outputs=outputs
                         )
         return vm
 
@@ -780,6 +1164,88 @@ class VM_Linker(link.LocalLinker):
                  output_storage=None,
                 ):
         fgraph = self.fgraph
+        (order, thunks, input_storage, output_storage, storage_map,
+         compute_map) = self._make_thunks(
+                 input_storage, output_storage,
+                 plan=config.vm.plan_storage and not self.allow_gc)
+
+        computed, post_thunk_clear = self._post_thunk_clear(
+                order, storage_map, fgraph.outputs)
+
+        vm = self.make_vm(order, thunks,
+                input_storage, output_storage, storage_map,
+                post_thunk_clear,
+                computed,
+                compute_map,
+                self.updated_vars
+                )
+
+        return (vm,
+                [link.Container(input, storage)
+                 for input, storage in zip(fgraph.inputs, input_storage)],
+                [link.Container(output, storage, True)
+                 for output, storage in zip(fgraph.outputs, output_storage)],
+                thunks,
+                order)
+
+    def make_all_subsets(self, subsets, input_storage=None):
+        """
+        Make one VM for each subset of the outputs of self.fgraph.
+
+        The thunks and the storage of all the VMs are shared: each VM only
+        runs the thunks of the nodes needed to compute its outputs.
+
+        subsets - list of pairs (outputs, updated_vars). `outputs` is a list
+            of outputs of self.fgraph, that ends with the new values of the
+            variables in `updated_vars`. `updated_vars` maps inputs of
+            self.fgraph to their new value, like in `accept_var_updates`.
+
+        Returns the list of VMs, the input containers, a list of output
+        containers for each subset, the thunks and the order of the nodes.
+        """
+        fgraph = self.fgraph
+        (order, thunks, input_storage, output_storage, storage_map,
+         compute_map) = self._make_thunks(input_storage, None)
+        thunk_of = dict(zip(order, thunks))
+
+        vms = []
+        output_containers = []
+        for outputs, updated_vars in subsets:
+            # The nodes needed to compute `outputs`. The nodes of the other
+            # subsets that must run before a node that destroys one of their
+            # inputs are not run: the VM only orders the destroyers after
+            # the readers of its own subset, as each VM recomputes the
+            # variables it reads.
+            needed = set()
+            stack = [o.owner for o in outputs if o.owner]
+            while stack:
+                node = stack.pop()
+                if node not in needed:
+                    needed.add(node)
+                    stack.extend(i.owner for i in node.inputs if i.owner)
+            nodes = [node for node in order if node in needed]
+            computed, post_thunk_clear = self._post_thunk_clear(
+                    nodes, storage_map, outputs)
+            vms.append(self.make_vm(nodes, [thunk_of[node] for node in nodes],
+                    input_storage, [storage_map[o] for o in outputs],
+                    storage_map,
+                    post_thunk_clear,
+                    computed,
+                    compute_map,
+                    updated_vars,
+                    outputs=outputs))
+            output_containers.append([link.Container(o, storage_map[o], True)
+                                      for o in outputs])
+
+        return (vms,
+                [link.Container(input, storage)
+                 for input, storage in zip(fgraph.inputs, input_storage)],
+                output_containers,
+                thunks,
+                order)
+
+    def _make_thunks(self, input_storage, output_storage, plan=False):
+        fgraph = self.fgraph
         order = list(fgraph.toposort())
         no_recycling = self.no_recycling
 
@@ -789,12 +1255,62 @@ class VM_Linker(link.LocalLinker):
         for k in storage_map:
             compute_map[k] = [k.owner is None]
 
+        # The thunks keep the storage cells of their variables, so the
+        # storage is planned before making them.
+        reuse = {}
+        if plan:
+            run_order = self._run_order(order)
+            if run_order is not None:
+                reuse = plan_storage(run_order, fgraph, no_recycling)
+                for v, arena in reuse.iteritems():
+                    storage_map[v] = storage_map[arena]
+                logger.debug('plan_storage: %i of %i variables share the '
+                             'storage of another one',
+                             len(reuse), len(storage_map))
+
+        cc.precompile_nodes(order, no_recycling)
         thunks = [node.op.make_thunk(node,
                     storage_map,
                     compute_map,
                     no_recycling)
                         for node in order]
 
+        if reuse and [th for th in thunks if th.lazy]:
+            # Lazy thunks are not run in the planned order: make the thunks
+            # again, with a storage cell for each variable.
+            for v in reuse:
+                storage_map[v] = [None]
+            thunks = [node.op.make_thunk(node,
+                        storage_map,
+                        compute_map,
+                        no_recycling)
+                            for node in order]
+        return (order, thunks, input_storage, output_storage, storage_map,
+                compute_map)
+
+    def _run_order(self, order):
+        """
+        Return the order in which the VM made by make_vm will run the nodes
+        of self.fgraph, if they are not lazy, or None if it is not known
+        in advance.
+        """
+        if self.callback is not None:
+            # The Stack VM is used.
+            return None
+        if self.parallel:
+            # The nodes do not run in a known order.
+            return None
+        if self.use_cloop:
+            return cvm_order(order, self.fgraph.outputs,
+                             self.fgraph.orderings())
+        lazy = self.lazy
+        if lazy is None:
+            lazy = config.vm.lazy
+        if lazy:
+            return None
+        return order
+
+    def _post_thunk_clear(self, order, storage_map, outputs):
         computed, last_user = link.gc_helper(order)
         if self.allow_gc:
             post_thunk_clear = []
@@ -802,25 +1318,10 @@ class VM_Linker(link.LocalLinker):
                 clear_after_this_thunk = []
                 for input in node.inputs:
                     if ((input in computed)
-                            and (input not in fgraph.outputs)
+                            and (input not in outputs)
                             and (node == last_user[input])):
                         clear_after_this_thunk.append(storage_map[input])
                 post_thunk_clear.append(clear_after_this_thunk)
         else:
             post_thunk_clear = None
-
-        vm = self.make_vm(order, thunks,
-                input_storage, output_storage, storage_map,
-                post_thunk_clear,
-                computed,
-                compute_map,
-                self.updated_vars
-                )
-
-        return (vm,
-                [link.Container(input, storage)
-                 for input, storage in zip(fgraph.inputs, input_storage)],
-                [link.Container(output, storage, True)
-                 for output, storage in zip(fgraph.outputs, output_storage)],
-                thunks,
-                order)
+        return computed, post_thunk_clear
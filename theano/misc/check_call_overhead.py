@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Measure the time taken by a call to a small Theano function, with and
+# without Function.trust_input, and by Function.map.
+
+import sys
+import time
+from optparse import OptionParser
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+
+def build(n_inputs, linker):
+    """
+    Compile a function that sums `n_inputs` vectors, and return it with
+    values for its inputs.
+    """
+    inputs = [T.vector('x%i' % i) for i in xrange(n_inputs)]
+    f = theano.function(inputs, sum(inputs),
+                        mode=theano.Mode(linker=linker))
+    values = [numpy.ones(10, dtype=theano.config.floatX)
+              for i in xrange(n_inputs)]
+    return f, values
+
+
+def time_calls(f, values, n_calls):
+    """Return the average time taken by a call to `f`, in microseconds."""
+    t0 = time.time()
+    for i in xrange(n_calls):
+        f(*values)
+    return (time.time() - t0) / n_calls * 1e6
+
+
+def time_map(f, values, n_calls):
+    """
+    Return the average time taken by a call to `f` made by `f.map`, and by a
+    list comprehension that calls `f`, in microseconds.
+    """
+    args = [values] * n_calls
+    t0 = time.time()
+    f.map(args, stack=False)
+    t_map = (time.time() - t0) / n_calls * 1e6
+    t0 = time.time()
+    [f(*v) for v in args]
+    t_list = (time.time() - t0) / n_calls * 1e6
+    return t_map, t_list
+
+
+parser = OptionParser(
+        usage='%prog <options>\nMeasure the overhead of calling a small '
+        'Theano function')
+parser.add_option('-n', '--calls', type='int', default=100000,
+                  help='Number of calls to time')
+parser.add_option('-i', '--inputs', type='int', default=3,
+                  help='Number of inputs of the function')
+parser.add_option('-l', '--linker', default='cvm',
+                  help='Linker of the function')
+
+
+if __name__ == "__main__":
+    options, arguments = parser.parse_args(sys.argv)
+    f, values = build(options.inputs, options.linker)
+    f(*values)
+    # The time of the computation itself, that no call can avoid.
+    t_fn = time_calls(f.fn, [], options.calls)
+    t_call = time_calls(f, values, options.calls)
+    t_map, t_list = time_map(f, values, options.calls)
+    f.trust_input = True
+    t_trusted = time_calls(f, values, options.calls)
+    t_map_trusted, t_list_trusted = time_map(f, values, options.calls)
+
+    print '%i inputs, linker %s, %i calls' % (options.inputs, options.linker,
+                                             options.calls)
+    print 'f.fn():                %7.2f us' % t_fn
+    print 'f(...):                %7.2f us' % t_call
+    print 'f(...), trust_input:   %7.2f us' % t_trusted
+    print 'list comprehension:    %7.2f us' % t_list
+    print 'f.map:                 %7.2f us' % t_map
+    print 'list comp., trusted:   %7.2f us' % t_list_trusted
+    print 'f.map, trust_input:    %7.2f us' % t_map_trusted
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Measure the memory used by large graphs, and the time taken to build,
+# clone and toposort them.
+
+import resource
+import sys
+import time
+from optparse import OptionParser
+
+import theano
+import theano.tensor as T
+from theano.gof import graph
+
+
+def max_rss():
+    """Return the peak memory used by this process, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes on Mac OS X, in KB elsewhere.
+        rss /= 1024
+    return rss / 1024.
+
+
+def build(n_nodes, width):
+    """
+    Build a graph of about `n_nodes` Apply nodes, made of `width` chains
+    of elemwise operations that are summed at the end.
+    """
+    x = T.vector('x')
+    y = T.vector('y')
+    outs = []
+    for i in xrange(width):
+        h = x
+        for j in xrange(n_nodes // (2 * width)):
+            h = h * y + x
+        outs.append(h)
+    return [x, y], [sum(outs)]
+
+
+parser = OptionParser(
+        usage='%prog <options>\nMeasure the memory and time taken by large '
+        'graphs')
+parser.add_option('-n', '--nodes', type='int', default=200000,
+                  help='Number of Apply nodes of the graph')
+parser.add_option('-w', '--width', type='int', default=100,
+                  help='Number of independent chains in the graph')
+parser.add_option('--no-trace', action='store_true', default=False,
+                  help='Do not store the stack trace of the nodes created '
+                  '(this is done when building user graphs)')
+
+
+if __name__ == "__main__":
+    options, arguments = parser.parse_args(sys.argv)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * options.nodes))
+    if options.no_trace:
+        theano.gof.Op.add_stack_trace_on_call = False
+
+    rss0 = max_rss()
+    t0 = time.time()
+    inputs, outputs = build(options.nodes, options.width)
+    t1 = time.time()
+    rss1 = max_rss()
+    topo = graph.io_toposort(inputs, outputs)
+    t2 = time.time()
+    equiv = graph.clone_get_equiv(inputs, outputs)
+    t3 = time.time()
+    rss3 = max_rss()
+    del equiv
+    graph.stack_search(graph.deque(outputs),
+                       lambda r: r.owner and r.owner.inputs, 'dfs')
+    t4 = time.time()
+
+    print '%i Apply nodes, %i chains' % (len(topo), options.width)
+    print 'build:        %7.3fs  %7.1f MB' % (t1 - t0, rss1 - rss0)
+    print 'io_toposort:  %7.3fs' % (t2 - t1)
+    print 'clone:        %7.3fs  %7.1f MB' % (t3 - t2, rss3 - rss1)
+    print 'stack_search: %7.3fs' % (t4 - t3)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Measure the time taken by `import theano`, and check that the modules that
+# should only be imported (or compiled) on first use are not imported by it.
+
+import os
+import subprocess
+import sys
+from optparse import OptionParser
+
+# Modules that `import theano` must not import. The compiled helper modules
+# (cutils_ext, lazylinker_ext, scan_perform) are only loaded by them.
+LAZY_MODULES = [
+        'theano.scan_module',
+        'theano.sparse',
+        'theano.gof.cutils',
+        'theano.gof.lazylinker_c',
+        'theano.scan_module.scan_perform_ext',
+        ]
+
+_import_code = """
+import sys
+import time
+t0 = time.time()
+import theano
+t1 = time.time()
+print 'import_time', t1 - t0
+print 'loaded', ' '.join([m for m in %r if m in sys.modules])
+""" % (LAZY_MODULES,)
+
+
+def import_theano():
+    """
+    Import theano in a new process.
+
+    :return: a tuple (time taken by `import theano`, list of the
+             LAZY_MODULES it imported)
+    """
+    # Make sure the new process imports this version of Theano.
+    theano_root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+            [theano_root] + [p for p in [env.get('PYTHONPATH')] if p])
+    p = subprocess.Popen([sys.executable, '-c', _import_code],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=env)
+    out, err = p.communicate()
+    if p.returncode:
+        raise Exception('import theano failed', err)
+    # Importing theano may print other things (e.g. warnings).
+    info = dict(line.split(' ', 1) for line in out.split('\n')
+                if line.startswith('import_time ') or
+                line.startswith('loaded '))
+    return float(info['import_time']), info['loaded'].split()
+
+
+parser = OptionParser(
+        usage='%prog <options>\nMeasure the time taken by import theano')
+parser.add_option('-n', '--runs', type='int', default=5,
+                  help='Number of imports to time (the first one, that may '
+                  'compile things, is not counted)')
+
+
+if __name__ == "__main__":
+    options, arguments = parser.parse_args(sys.argv)
+    # The first import may compile things or fill the file system caches.
+    import_theano()
+    times = []
+    eager = set()
+    for i in xrange(options.runs):
+        t, loaded = import_theano()
+        times.append(t)
+        eager.update(loaded)
+    times.sort()
+    print 'import theano: min %.3fs, median %.3fs, max %.3fs (%i runs)' % (
+            times[0], times[len(times) // 2], times[-1], len(times))
+    if eager:
+        print 'ERROR: these modules should not be imported by import theano:'
+        for m in sorted(eager):
+            print '   ', m
+        sys.exit(1)
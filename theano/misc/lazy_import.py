@@ -0,0 +1,66 @@
+"""
+Helpers to defer the import of parts of Theano until they are first used.
+
+This keeps `import theano` fast for programs that do not need them.
+"""
+import sys
+import types
+
+
+def _import(module_name):
+    __import__(module_name)
+    return sys.modules[module_name]
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for the module `name`, which is imported on first access to
+    one of its attributes.
+
+    Once imported, Python sets the real module as an attribute of its parent
+    package, in place of this placeholder. References to the placeholder
+    taken before (e.g. by `from theano import scan_module`) keep working,
+    as it forwards all attribute accesses to the real module.
+    """
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+
+    def __getattr__(self, attr):
+        # Only called for attributes that are not found in the placeholder.
+        return getattr(_import(self.__name__), attr)
+
+    def __repr__(self):
+        return "<lazily imported module '%s'>" % self.__name__
+
+
+class LazyFunction(object):
+    """
+    Placeholder for the function `name` of the module `module_name`, which
+    is imported on the first call.
+
+    The docstring of the placeholder is the one of the real function, so
+    reading it (e.g. with `help`) also imports the module.
+    """
+
+    def __init__(self, module_name, name):
+        self.module_name = module_name
+        self.__name__ = name
+
+    def function(self):
+        """Return the real function, importing its module if needed."""
+        return getattr(_import(self.module_name), self.__name__)
+
+    def __call__(self, *args, **kwargs):
+        return self.function()(*args, **kwargs)
+
+    __doc__ = property(lambda self: self.function().__doc__)
+
+    def __get__(self, obj, objtype=None):
+        # Being a non-data descriptor makes `inspect.isroutine` true, so
+        # that pydoc documents the placeholder like a function.
+        return self
+
+    def __repr__(self):
+        return "<lazily imported function %s.%s>" % (self.module_name,
+                                                     self.__name__)
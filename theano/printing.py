@@ -81,7 +81,7 @@ def debugprint(obj, depth=-1, print_type=False,
     elif isinstance(obj, gof.Apply):
         results_to_print.extend(obj.outputs)
     elif isinstance(obj, Function):
-        results_to_print.extend(obj.maker.fgraph.outputs)
+        results_to_print.extend(obj.maker.output_variables)
         order = obj.maker.fgraph.toposort()
     elif isinstance(obj, (list, tuple)):
         results_to_print.extend(obj)
@@ -5,6 +5,7 @@ import os
 import re
 import subprocess
 import sys
+import time
 import warnings
 
 from theano.gof.cc import hash_from_file
@@ -12,6 +13,7 @@ from theano.gof.cmodule import (std_libs, std_lib_dirs,
                                 std_include_dirs, dlimport,
                                 get_lib_extension, local_bitwidth)
 from theano.gof.python25 import any
+from theano.gof.utils import record_compile_phase
 
 _logger = logging.getLogger("theano.sandbox.cuda.nvcc_compiler")
 _logger.setLevel(logging.WARN)
@@ -298,6 +300,7 @@ class NVCC_compiler(object):
         #register and shared-mem requirements
         _logger.debug('Running cmd %s', ' '.join(cmd))
         orig_dir = os.getcwd()
+        t0 = time.time()
         try:
             os.chdir(location)
             p = subprocess.Popen(
@@ -305,6 +308,7 @@ class NVCC_compiler(object):
             nvcc_stdout, nvcc_stderr = p.communicate()[:2]
         finally:
             os.chdir(orig_dir)
+        record_compile_phase('nvcc', time.time() - t0)
 
         for eline in nvcc_stderr.split('\n'):
             if not eline:
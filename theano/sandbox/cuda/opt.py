@@ -1181,7 +1181,7 @@ def local_inplace_gemv(node):
         return [gpu_gemv_inplace(*node.inputs)]
 
 
-@local_optimizer([gpu_gemm_no_inplace])
+@local_optimizer([gpu_ger_no_inplace])
 def local_inplace_ger(node):
     if node.op == gpu_ger_no_inplace:
         return [gpu_ger_inplace(*node.inputs)]
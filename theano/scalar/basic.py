@@ -759,6 +759,11 @@ class ScalarOp(Op):
     def c_code_cache_version(self):
         return (4,)
 
+    def c_code_gil_free(self, node):
+        # The C code of scalar ops only works on C scalars. Subclasses
+        # whose c_code uses the Python C-API must return False.
+        return True
+
 
 class UnaryScalarOp(ScalarOp):
     nin = 1
@@ -2635,6 +2640,10 @@ class Composite(ScalarOp):
 
         return self._c_code % d
 
+    def c_code_gil_free(self, node):
+        return all(subnode.op.c_code_gil_free(subnode)
+                   for subnode in self.fgraph.toposort())
+
     def c_code_cache_version(self):
         rval = [3]
         for x in self.fgraph.toposort():
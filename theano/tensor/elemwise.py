@@ -1012,8 +1012,22 @@ class Elemwise(Op):
         return decl, checks, alloc, loop
 
     def c_code(self, node, nodename, inames, onames, sub):
-        code = "\n".join(self._c_all(node, nodename, inames, onames, sub))
-        return code
+        decl, checks, alloc, loop = self._c_all(node, nodename, inames,
+                                                onames, sub)
+        scalar_node = Apply(self.scalar_op,
+                [Scalar(dtype=input.type.dtype)() for input in node.inputs],
+                [Scalar(dtype=output.type.dtype)() for output in node.outputs])
+        if ('release_gil' in sub and
+                self.scalar_op.c_code_gil_free(scalar_node)):
+            # The loop only touches the data buffers, so other threads
+            # can run meanwhile. Releasing the GIL is not worth it for
+            # small outputs.
+            loop = """
+            if (PyArray_SIZE(%(z)s) >= 4096) {%(release_gil)s}
+            %(loop)s
+            %(acquire_gil)s
+            """ % dict(sub, z=onames[0], loop=loop)
+        return "\n".join((decl, checks, alloc, loop))
 
     def c_headers(self):
         return ['<vector>', '<algorithm>']
@@ -1027,7 +1041,7 @@ class Elemwise(Op):
         return support_code
 
     def c_code_cache_version_apply(self, node):
-        version = [6]  # the version corresponding to the c code in this Op
+        version = [7]  # the version corresponding to the c code in this Op
 
         # now we insert versions for the ops on which we depend...
         scalar_node = Apply(self.scalar_op,
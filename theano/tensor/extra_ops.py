@@ -444,7 +444,7 @@ class FillDiagonal(gof.Op):
     def __eq__(self, other):
         return type(self) == type(other)
 
-    def __hash_(self):
+    def __hash__(self):
         return hash(type(self))
 
     def __str__(self):
@@ -130,7 +130,7 @@ def broadcast_like(value, template, fgraph, dtype=None):
 
 
 theano.configparser.AddConfigVar('tensor.insert_inplace_optimizer_validate_nb',
-        "-1: auto, if graph have less then 500 nodes 1, else 10",
+        "Number of inplace changes between two validations. -1: auto (1)",
         theano.configparser.IntParam(-1),
         in_c_key=False)
 
@@ -154,32 +154,14 @@ def inplace_elemwise_optimizer_op(OP):
           x + y + z -> x += y += z
           (x + y) * (x * y) -> (x += y) *= (x * y) or (x + y) *= (x *= y)
         """
-        # We should not validate too often as this takes too much time to
-        # execute!
-        # It is the _dfs_toposort() fct in theano/gof/destroyhandler.py
-        # that takes so much time.
-        # Should we try to use another lib that does toposort?
-        #   igraph: http://igraph.sourceforge.net/
-        #   networkx: https://networkx.lanl.gov/
-        # Should we try to use cython?
-        #   Compiling only that fct is not enough, should we try to add the
-        #   deque class too?
-        #   And init the deque and other list to an upper bound number of
-        #   elements?
-        # Maybe Theano should do online toposort as in
-        #   http://code.google.com/p/acyclic
-        #
-        # The next longest optimizer is the canonizer phase.
-        # Then I think it is the [io_?]toposort (need to validate) so check if
-        # the solution is also applicable there.
+        # The DestroyHandler validates incrementally, using the topological
+        # order maintained by the FunctionGraph, so validating each change
+        # is cheap, and no change is reverted because of another one.
 
         # We execute `validate` after this number of change.
         check_each_change = config.tensor.insert_inplace_optimizer_validate_nb
         if check_each_change == -1:
-            if len(fgraph.nodes) > 500:
-                check_each_change = 10
-            else:
-                check_each_change = 1
+            check_each_change = 1
 
         nb_change_no_validate = 0
         chk = fgraph.checkpoint()
@@ -1136,7 +1118,7 @@ def local_shape_to_shape_i(node):
 
 @register_specialize
 @register_canonicalize
-@gof.local_optimizer([T._shape])
+@gof.local_optimizer([Shape_i])
 def local_track_shape_i(node):
     try:
         shape_feature = node.fgraph.shape_feature
@@ -1330,7 +1312,7 @@ def local_remove_useless_assert(node):
             return [assert_(node.inputs[0], *cond)]
 
 
-@gof.local_optimizer([T.Alloc])
+@gof.local_optimizer([T.Elemwise])
 def local_alloc_elemwise(node):
     """
     elemwise(alloc(x, shp), ..., y.TensorType(BROADCAST CONDITION))
@@ -2274,7 +2256,7 @@ def local_mul_switch_sink(node):
 
 
 @register_canonicalize
-@gof.local_optimizer([T.true_div])
+@gof.local_optimizer([T.true_div, T.int_div, T.floor_div])
 def local_div_switch_sink(node):
     """
     This optimization makes the folowing changes in the graph:
@@ -73,7 +73,7 @@ class MaxAndArgmaxOptimizer(Optimizer):
 register_uncanonicalize(MaxAndArgmaxOptimizer(),name='MaxAndArgmaxOptimizer')
 
 @register_uncanonicalize
-@gof.local_optimizer([T._shape])
+@gof.local_optimizer([T.neg])
 def local_max_to_min(node):
     """
     change -(max(-x)) to min
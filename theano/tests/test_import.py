@@ -0,0 +1,24 @@
+import theano
+from theano.misc.check_import_time import import_theano
+
+
+def test_lazy_imports():
+    # `import theano` must not import the modules that are only needed on
+    # first use (see theano/misc/check_import_time.py to time it).
+    import_time, loaded = import_theano()
+    assert not loaded, loaded
+
+
+def test_lazy_scan():
+    x = theano.tensor.vector('x')
+    out, updates = theano.scan(lambda v: v * 2, sequences=x)
+    f = theano.function([x], out, updates=updates)
+    assert list(f([1, 2])) == [2, 4]
+    assert isinstance(theano.scan_module.scan_op.Scan, type)
+
+
+def test_lazy_scan_doc():
+    # The lazy functions have the docstrings of the real ones.
+    for name in ['scan', 'map', 'reduce', 'foldl', 'foldr', 'clone']:
+        doc = getattr(theano, name).__doc__
+        assert doc == getattr(theano.scan_module, name).__doc__, name